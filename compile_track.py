@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+""" Compiles the track's rails and bases JSON files to the binary track model
+    file loaded by Track (see lib_track.TrackModel). Track recompiles a stale
+    model on its own, so this is only needed to build one ahead of time, as
+    on deployment. Files default to those in app_config.dat.
+    Ex: `./compile_track.py [rails.json bases.json track.bin]`
+
+    Author: Dustin Fast, 2018
+"""
+
+import sys
+from timeit import default_timer
+
+from lib_track import compile_track_model, TrackModel
+from lib_track import TRACK_RAILS, TRACK_BASES, TRACK_MODEL
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (1, 4):
+        print('Usage: ./compile_track.py [rails_file bases_file model_file]')
+        sys.exit(1)
+    files = sys.argv[1:] or [TRACK_RAILS, TRACK_BASES, TRACK_MODEL]
+
+    model = compile_track_model(*files)
+    start = default_timer()
+    TrackModel.load(files[2])
+    print('Compiled %s: %d mileposts, %d bases, %d coverage sets.' %
+          (files[2], len(model.markers), len(model.bases), len(model.cov_sets)))
+    print('Loads in %.2f ms.' % ((default_timer() - start) * 1000))
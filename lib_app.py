@@ -3,8 +3,14 @@
     Author: Dustin Fast, 2018
 """
 
+import os
+import sys
+import atexit
+import signal
 import logging
 import logging.handlers
+from threading import Thread, Event, Lock
+from collections import deque
 from subprocess import check_output
 from ConfigParser import RawConfigParser
 
@@ -15,10 +21,21 @@ config.read('app_config.dat')
 APP_NAME = config.get('application', 'app_name')
 REFRESH_TIME = int(config.get('application', 'refresh_time'))
 WEB_EXPIRE = int(config.get('application', 'web_expire'))
+SANDBOX_POOL = int(config.get('application', 'sandbox_pool'))
+SANDBOX_MAX = int(config.get('application', 'sandbox_max'))
+SANDBOX_PORTS = int(config.get('application', 'sandbox_ports'))
 
 LOG_LEVEL = int(config.get('logging', 'level'))
 LOG_SIZE = int(config.get('logging', 'max_file_size')) 
 LOG_FILES = config.get('logging', 'num_files')
+LOG_ASYNC = bool(int(config.get('logging', 'async')))
+LOG_BATCH_SIZE = int(config.get('logging', 'batch_size'))
+LOG_FLUSH_TIME = float(config.get('logging', 'flush_time'))
+
+# Our log formats use none of these record attributes, so skip gathering them
+logging.logThreads = 0
+logging.logProcesses = 0
+logging.logMultiprocessing = 0
 
 # Module level loggers, Declared here and defined at the end of this file.
 track_log = None
@@ -63,6 +80,10 @@ class Logger(logging.Logger):
                 console_handler.setLevel(level + 10)
                 console_handler.setFormatter(console_fmt)
                 self.addHandler(console_handler)
+
+            # If async, log through a queue to a background writer instead
+            if LOG_ASYNC:
+                self.handlers = [AsyncHandler(self.handlers)]
         except:
             self.level = 0
             self.parent = None
@@ -75,6 +96,145 @@ class Logger(logging.Logger):
         else:
             print(s)
 
+
+class AsyncHandler(logging.Handler):
+    """ A log handler that queues records for a LogWriter thread to write to
+        the given handlers, in batches, so the logging thread never waits on
+        a lock or the file system. Records are formatted by the writer, so
+        hot paths should pass msg args lazily, ex: log.info('%s sent', addr).
+    """
+    def __init__(self, handlers):
+        logging.Handler.__init__(self, min([h.level for h in handlers]))
+        self.handlers = handlers
+        self.records = deque()
+        self.ready = Event()  # Set when a full batch is queued
+        self.writer = None
+        self.pid = None  # Of the process self.writer belongs to
+        self.writer_lock = Lock()
+
+    def handle(self, record):
+        """ Queues the given record. Unlike logging.Handler.handle, takes no
+            lock - deque appends are thread-safe.
+        """
+        if self.pid != os.getpid():
+            with self.writer_lock:
+                if self.pid != os.getpid():
+                    self._start_writer()  # First record, or first since fork
+        self.records.append(record)
+        if len(self.records) >= LOG_BATCH_SIZE:
+            self.ready.set()
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+    def flush(self):
+        """ Writes all queued records now, from the calling thread.
+        """
+        if self.writer:
+            self.writer.write_batch()
+
+    def _start_writer(self):
+        """ Starts this process's writer. Records queued before a fork belong
+            to the parent, so the child drops its copies of them, and its
+            copies of locks the parent's writer may have held.
+        """
+        if self.pid is not None:
+            self.records.clear()
+            self.ready = Event()
+            for handler in self.handlers:
+                handler.createLock()
+        self.pid = os.getpid()
+        self.writer = LogWriter(self)
+        self.writer.start()
+
+
+class LogWriter(Thread):
+    """ Writes the records queued by the given AsyncHandler to its handlers
+        every LOG_BATCH_SIZE records or LOG_FLUSH_TIME seconds, whichever is
+        first. Each stream handler gets one write and flush per batch.
+    """
+    def __init__(self, async_handler):
+        Thread.__init__(self)
+        self.daemon = True
+        self.async_handler = async_handler
+
+    def run(self):
+        while True:
+            self.async_handler.ready.wait(LOG_FLUSH_TIME)
+            self.async_handler.ready.clear()
+            self.write_batch()
+
+    def write_batch(self):
+        """ Writes all records queued so far.
+        """
+        records = []
+        queued = self.async_handler.records
+        try:
+            while True:
+                records.append(queued.popleft())
+        except IndexError:
+            pass
+
+        if records:
+            for handler in self.async_handler.handlers:
+                self._write(handler, records)
+
+    @staticmethod
+    def _write(handler, records):
+        """ Writes the given records, less any below the given handler's level,
+            to the handler.
+        """
+        records = [r for r in records if r.levelno >= handler.level]
+        if not records:
+            return
+
+        if not isinstance(handler, logging.StreamHandler):
+            for record in records:
+                handler.handle(record)
+            return
+
+        handler.acquire()
+        try:
+            data = ''.join([handler.format(r) + '\n' for r in records])
+            if handler.stream is None:
+                handler.stream = handler._open()
+            if isinstance(handler, logging.handlers.RotatingFileHandler) \
+                    and handler.maxBytes > 0:
+                handler.stream.seek(0, 2)
+                if handler.stream.tell() + len(data) >= handler.maxBytes:
+                    handler.doRollover()
+            handler.stream.write(data)
+            handler.flush()
+        except Exception:
+            handler.handleError(records[0])
+        finally:
+            handler.release()
+
+
+def _flush_logs():
+    """ Writes any log records still queued for async handlers. Registered to
+        run at exit, as LogWriters are daemon threads.
+    """
+    for logger in [track_log, broker_log, bos_log]:
+        for handler in logger.handlers if logger else []:
+            handler.flush()
+
+
+def flushes_logs(run):
+    """ Decorates the given run method, or target, of a multiprocessing child
+        to write the child's queued log records once it returns, raises, or
+        is terminated, as atexit handlers never run in children.
+    """
+    def run_child(*args, **kwargs):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            return run(*args, **kwargs)
+        finally:
+            _flush_logs()
+    return run_child
+
+
 def dep_install(module_name):
     """ Prompts user to install the given module. Application quits on deny.
     """
@@ -97,3 +257,4 @@ def dep_install(module_name):
 track_log = Logger('log_track', False)
 broker_log = Logger('log_broker', False)
 bos_log = Logger('log_bos', False)
+atexit.register(_flush_logs)
@@ -9,17 +9,26 @@
     Author: Dustin Fast, 2018
 """
 
+import os
 import Queue
 import socket
+import asyncore
 import datetime
-from time import sleep
+import mmap
+import select
+import shutil
+from bisect import bisect_left
+from ast import literal_eval
+from json import dumps, loads
+from time import sleep, time
 from binascii import crc32
-from threading import Thread
-from struct import pack, unpack
+from threading import Thread, Lock, Condition
+from collections import deque, OrderedDict
+from struct import Struct
 from multiprocessing import Process
 from ConfigParser import RawConfigParser
 
-from lib_app import broker_log
+from lib_app import broker_log, flushes_logs
 from lib_app import REFRESH_TIME
 
 # Import conf data
@@ -29,21 +38,196 @@ BROKER = config.get('messaging', 'broker')
 BOS_EMP = config.get('messaging', 'bos_emp_addr')
 SEND_PORT = int(config.get('messaging', 'send_port'))
 FETCH_PORT = int(config.get('messaging', 'fetch_port'))
+SUBSCRIBE_PORT = int(config.get('messaging', 'subscribe_port'))
+STATS_PORT = int(config.get('messaging', 'stats_port'))
 MAX_MSG_SIZE = int(config.get('messaging', 'max_msg_size'))
 NET_TIMEOUT = float(config.get('messaging', 'network_timeout'))
+SEND_BATCH_WAIT = float(config.get('messaging', 'send_batch_wait'))
 MSG_INTERVAL = float(config.get('messaging', 'msg_interval'))
 LOCO_EMP_PREFIX = config.get('messaging', 'loco_emp_prefix')
+BROKER_MODE = config.get('messaging', 'broker_mode')
+LISTEN_BACKLOG = int(config.get('messaging', 'listen_backlog'))
+CLIENT_POOL_SIZE = int(config.get('messaging', 'client_pool_size'))
+HEX_WIRE = bool(int(config.get('messaging', 'hex_wire')))
+PAYLOAD_CODEC = config.get('messaging', 'payload_codec')
+FETCH_BATCH_SIZE = int(config.get('messaging', 'fetch_batch_size'))
+MAX_FETCH_WAIT = float(config.get('messaging', 'max_fetch_wait'))
+MSG_EXPIRE_TIME = float(config.get('messaging', 'msg_expire_time'))
+QUEUE_MAX_SIZE = int(config.get('messaging', 'queue_max_size'))
+QUEUE_OVERFLOW = config.get('messaging', 'queue_overflow')
+COALESCE_MSG_TYPES = set([int(t) for t in config.get(
+    'messaging', 'coalesce_msg_types').split(',') if t.strip()])
+BROKER_SHARDS = int(config.get('messaging', 'broker_shards'))
+WRITE_AHEAD_LOG = bool(int(config.get('messaging', 'write_ahead_log')))
+WAL_DIR = config.get('messaging', 'wal_dir')
+WAL_SEGMENT_SIZE = int(config.get('messaging', 'wal_segment_size'))
+WAL_SYNC_COUNT = int(config.get('messaging', 'wal_sync_count'))
+WAL_SYNC_INTERVAL = float(config.get('messaging', 'wal_sync_interval'))
+
+# EMP common header size, i.e. the bytes needed to determine a msg's size
+EMP_COMMON_SIZE = 9
+
+# Precompiled EMP msg layouts, noting that
+#   B = unsigned char, 8 bits
+#   H = unsigned short, 16 bits
+#   I = unsigned int, 32 bits
+#   i = signed int, 32 bits
+# EMP_HEADER is the "Common Header" and the fixed-size "Variable Header"
+# fields. Its I field is the 24 bit msg body size and 8 bit variable header
+# size, together. EMP_SIZES is that same field alone, and EMP_FIELDS the
+# fields needed to decode a msg: its type, version, and that same field.
+EMP_HEADER = Struct('>BHBBIHH')
+EMP_SIZES = Struct('>5xI')
+EMP_FIELDS = Struct('>xHBxI')
+EMP_CRC = Struct('>i')
+EMP_HEADER_SIZE = EMP_HEADER.size
+EMP_CRC_SIZE = EMP_CRC.size
+_unpack_fields_from = EMP_FIELDS.unpack_from  # Bound once, for decoding
+_unpack_crc = EMP_CRC.unpack
+EMP_VERSION = 4  # EMP header version
+EMP_TTL = 120    # Network time-to-live, in seconds
+EMP_QOS = 0      # Quality of service, 0 = no preference
+
+# Framed (async broker mode) transport: Each frame is its data's length, as a
+# 32 bit unsigned int, followed by the data.
+FRAME_HEADER = Struct('>I')
+FRAMED = BROKER_MODE == 'async'
+
+# Write-ahead log records: Each is its op, msg seq num, enqueue time (appends
+# only), and data length, followed by the data (the raw msg, appends only).
+WAL_RECORD = Struct('>BQdI')
+WAL_APPEND = 1
+WAL_RELEASE = 2
+
+# Broker metrics: Msg age histogram bucket upper bounds, in seconds, and the
+# counters kept by each broker (see BrokerMetrics).
+AGE_BUCKETS = (.001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60)
+METRIC_COUNTERS = ('send_requests',
+                   'fetch_requests',
+                   'subscribe_requests',
+                   'send_failures',
+                   'crc_failures',
+                   'connections_opened',
+                   'connections_closed')
 
 # Set default timeout for all sockets, including importers of this library
 socket.setdefaulttimeout(NET_TIMEOUT)
 
 
+class ReprCodec(object):
+    """ The original payload codec - A payload's python literal string form.
+        Decoding is restricted to literals, so is safe to use on any input.
+    """
+    version = 1  # EMP msg version denoting this codec
+
+    @staticmethod
+    def supports(msg_type, payload):
+        return True
+
+    @staticmethod
+    def encode(msg_type, payload):
+        return str(payload)
+
+    @staticmethod
+    def decode(msg_type, data):
+        return literal_eval(data)
+
+
+class JSONCodec(object):
+    """ A payload codec encoding payloads as JSON.
+    """
+    version = 2  # EMP msg version denoting this codec
+
+    @staticmethod
+    def supports(msg_type, payload):
+        return True
+
+    @staticmethod
+    def encode(msg_type, payload):
+        return dumps(payload, separators=(',', ':'))
+
+    @staticmethod
+    def decode(msg_type, data):
+        return loads(data)
+
+
+class StructCodec(object):
+    """ A compact, binary payload codec for 6000 (loco status) msgs. Fields
+        are packed in a fixed order, as given by _fields. None floats are
+        packed as NaN. Strings are prefixed by their 8 bit length.
+    """
+    version = 3  # EMP msg version denoting this codec
+
+    _fields = ('speed', 'heading', 'milepost', 'lat', 'long', 'bpp')
+    _keys = set(_fields + ('loco', 'direction', 'conns'))
+    _fixed = Struct('>6dB')  # _fields, then direction (1 = decreasing)
+    _len = Struct('>B')
+
+    @staticmethod
+    def supports(msg_type, payload):
+        return msg_type == 6000 and set(payload.keys()) == StructCodec._keys
+
+    @staticmethod
+    def encode(msg_type, payload):
+        floats = [payload[f] for f in StructCodec._fields]
+        floats = [float('nan') if f is None else f for f in floats]
+        decreasing = int(payload['direction'] == 'decreasing')
+        conns = payload['conns']
+
+        data = [StructCodec._fixed.pack(*(floats + [decreasing])),
+                StructCodec._pack_str(payload['loco']),
+                StructCodec._len.pack(len(conns))]
+        for label, base_id in conns.iteritems():
+            data.append(StructCodec._pack_str(label))
+            data.append(StructCodec._pack_str(base_id))
+
+        return ''.join(data)
+
+    @staticmethod
+    def decode(msg_type, data):
+        fixed = StructCodec._fixed.unpack_from(data)
+        payload = {f: (None if v != v else v)  # NaN != NaN
+                   for f, v in zip(StructCodec._fields, fixed)}
+        payload['direction'] = 'decreasing' if fixed[-1] else 'increasing'
+
+        offset = StructCodec._fixed.size
+        payload['loco'], offset = StructCodec._unpack_str(data, offset)
+        num_conns = StructCodec._len.unpack_from(data, offset)[0]
+        offset += StructCodec._len.size
+
+        conns = {}
+        for _ in range(num_conns):
+            label, offset = StructCodec._unpack_str(data, offset)
+            conns[label], offset = StructCodec._unpack_str(data, offset)
+        payload['conns'] = conns
+
+        return payload
+
+    @staticmethod
+    def _pack_str(string):
+        return StructCodec._len.pack(len(string)) + string
+
+    @staticmethod
+    def _unpack_str(data, offset):
+        """ Returns the string at the given offset and the offset after it.
+        """
+        size = StructCodec._len.unpack_from(data, offset)[0]
+        offset += StructCodec._len.size
+        return data[offset:offset + size], offset + size
+
+
+# Payload codecs, by name (for conf) and by EMP msg version (for decoding)
+PAYLOAD_CODECS = {'repr': ReprCodec, 'json': JSONCodec, 'struct': StructCodec}
+CODEC_VERSIONS = {c.version: c for c in PAYLOAD_CODECS.values()}
+
+
 class Message(object):
     """ A representation of a message, including it's raw EMP form. Contains
         static functions for converting between tuple and raw EMP form.
+        The payload codec is denoted by the EMP msg version field.
     """
 
-    def __init__(self, msg_content):
+    def __init__(self, msg_content, codec=PAYLOAD_CODECS[PAYLOAD_CODEC]):
         """ Constructs a message object from the given content - either a
             well-formed EMP msg string, or a tuple of the form:
                 (Message Type - ex: 6000,
@@ -52,6 +236,8 @@ class Message(object):
                  Payload - ex: { key: value, ... }
                 )
                 Note: All other EMP fields are static in this implementation.
+            codec: The payload codec to use when constructing from a tuple.
+                   Falls back to JSON for payloads the codec doesn't support.
         """
         if type(msg_content) == str:
             self.raw_msg = msg_content
@@ -59,7 +245,9 @@ class Message(object):
         else:
             if type(msg_content) != tuple or len(msg_content) != 4:
                 raise Exception('Msg content is an unexpected type or length.')
-            self.raw_msg = self._to_raw(msg_content)
+            if not codec.supports(msg_content[0], msg_content[3]):
+                codec = JSONCodec
+            self.raw_msg = self._to_raw(msg_content, codec)
 
         self.msg_type = msg_content[0]
         self.sender_addr = msg_content[1]
@@ -67,87 +255,132 @@ class Message(object):
         self.payload = msg_content[3]
 
     @staticmethod
-    def _to_raw(msg_tuple):
-        """ Given a msg in tuple form, returns a well-formed EMP msg string.
+    def size_from_header(header):
+        """ Given (at least) the EMP common header of a raw msg, returns the
+            msg's total size, in bytes.
+        """
+        sizes = EMP_SIZES.unpack_from(header)[0]
+        return EMP_HEADER.size + (sizes & 0xFF) + (sizes >> 8)
+
+    @staticmethod
+    def _to_raw(msg_tuple, codec=ReprCodec):
+        """ Given a msg in tuple form, returns a well-formed EMP msg string,
+            with its payload encoded by the given codec.
         """
         msg_type = msg_tuple[0]
         sender_addr = msg_tuple[1]
         dest_addr = msg_tuple[2]
         payload = msg_tuple[3]
-        payload_str = str(payload)
 
+        try:
+            payload_str = codec.encode(msg_type, payload)
+            return Message._pack_fields(msg_type,
+                                        codec.version,
+                                        sender_addr,
+                                        dest_addr,
+                                        payload_str)
+        except:
+            raise Exception("Msg format is invalid")
+
+    @staticmethod
+    def _to_tuple(raw_msg):
+        """ Returns a tuple representation of the msg contained in raw_msg.
+        """
+        msg_type, msg_version, sender_addr, dest_addr, payload = \
+            Message._unpack_fields(raw_msg)
+
+        # Turn the payload into a python dictionary, via its codec
+        try:
+            payload = CODEC_VERSIONS[msg_version].decode(msg_type, payload)
+        except KeyError:
+            raise Exception('Unknown msg version: ' + str(msg_version))
+        except:
+            raise Exception('Msg payload not of form { key: value, ... }')
+        if type(payload) != dict:
+            raise Exception('Msg payload not of form { key: value, ... }')
+
+        return (msg_type, sender_addr, dest_addr, payload)
+
+    @staticmethod
+    def _pack_fields(msg_type, msg_version, sender_addr, dest_addr, payload):
+        """ Returns a well-formed EMP msg string of the given fields, where 
+            payload is already encoded. Packs all fixed-size header fields
+            at once, and joins the rest in a single allocation.
+        """
         # Calculate body size (i.e. payload length + room for the 32 bit CRC)
-        body_size = 4 + len(payload_str)
+        body_size = len(payload) + EMP_CRC.size
 
         # Calculate size of variable portion of the "Variable Header",
         # i.e. len(source and destination strings) + null terminators.
         var_headsize = len(sender_addr) + len(dest_addr) + 2
 
-        # Build the raw msg msg using struct.pack, noting that
-        #   B = unsigned char, 8 bits
-        #   H = unsigned short, 16 bits
-        #   I = unsigned int, 32 bits
-        #   i = signed int, 32 bits
-        try:
-            # Pack EMP "Common Header"
-            raw_msg = pack(">B", 4)  # 8 bit EMP header version
-            raw_msg += pack(">H", msg_type)  # 16 bit message type/ID
-            raw_msg += pack(">B", 1)  # 8 bit message version
-            raw_msg += pack(">B", 0)  # 8 bit flag, all zeroes here.
-            raw_msg += pack(">I", body_size)[1:]  # 24 bit msg body size
-
-            # Pack EMP "Variable Header"
-            # 8 bit variable header size
-            raw_msg += pack(">B", var_headsize)
-            raw_msg += pack(">H", 120)  # 16 bit network TTL (seconds)
-            raw_msg += pack(">H", 0)  # 16 bit QoS, 0 = no preference
-            raw_msg += sender_addr  # 64 byte (max) msg source addr string
-            raw_msg += '\x00'  # null terminate msg source address
-            raw_msg += dest_addr  # 64 byte (max) msg dest addr string
-            raw_msg += '\x00'  # null terminate destination address
-
-            # Pack msg body
-            raw_msg += payload_str  # Variable size
-            raw_msg += pack(">i", crc32(raw_msg))  # 32 bit CRC
-        except:
-            raise Exception("Msg format is invalid")
+        if var_headsize > 0xFF or body_size > 0xFFFFFF:
+            raise Exception('Msg field too large.')
+
+        raw_msg = ''.join((EMP_HEADER.pack(EMP_VERSION,
+                                           msg_type,
+                                           msg_version,
+                                           0,  # 8 bit flag, all zeroes here.
+                                           body_size << 8 | var_headsize,
+                                           EMP_TTL,
+                                           EMP_QOS),
+                           sender_addr, '\x00',  # Null terminated addresses
+                           dest_addr, '\x00',
+                           payload))
 
-        return raw_msg
+        return raw_msg + EMP_CRC.pack(crc32(raw_msg))
 
     @staticmethod
-    def _to_tuple(raw_msg):
-        """ Returns a tuple representation of the msg contained in raw_msg.
+    def _unpack_fields(raw_msg):
+        """ Returns the given raw msg's type, version, sender and destination
+            addresses, and still-encoded payload, after validating it. Reads
+            the fixed-size header fields needed at once, and the rest, in
+            place - Only the fields returned are copied out.
         """
         # Validate raw_msg
-        if not raw_msg or len(raw_msg) < 20:  # 20 byte min msg size
+        size = len(raw_msg)
+        if size < 20:  # 20 byte min msg size
             raise Exception("Invalid message format")
 
-        # Ensure good CRC
-        msg_crc = unpack(">i", raw_msg[-4::])[0]  # last 4 bytes
-        raw_crc = crc32(raw_msg[:-4])
+        msg_type, msg_version, sizes = _unpack_fields_from(raw_msg)
+        vhead_end = EMP_HEADER_SIZE + (sizes & 0xFF)
+        crc_offset = size - EMP_CRC_SIZE
 
-        if msg_crc != raw_crc:
-            raise Exception("CRC Mismatch - message may be corrupt.")
+        if size != vhead_end + (sizes >> 8):
+            raise Exception("Msg size mismatch - message may be truncated.")
 
-        # Unpack msg fields, noting that unpack returns results as a tuple
-        msg_type = unpack('>H', raw_msg[1:3])[0]  # bytes 1-2
-        vhead_size = unpack('>B', raw_msg[8:9])[0]  # byte 8
+        # Ensure good CRC, without copying out all but the CRC to run it over:
+        # Continuing a CRC over the same bytes maps equal CRCs, and only
+        # equal ones, to equal results. So the msg's CRC is good iff the CRC
+        # of the whole msg equals its CRC continued over its own 4 bytes.
+        crc = raw_msg[crc_offset:]
+        if crc32(raw_msg) != crc32(crc, _unpack_crc(crc)[0]):
+            raise Exception("CRC Mismatch - message may be corrupt.")
 
-        # Extract sender, destination, and playload based on var header size
-        vhead_end = 13 + vhead_size
-        vhead = raw_msg[13:vhead_end]
-        vhead = vhead.split('\x00')  # split on terminators for easy extract
-        sender_addr = vhead[0]
-        dest_addr = vhead[1]
-        payload = raw_msg[vhead_end:len(raw_msg) - 4]  # -4 moves before CRC
+        # Sender and destination are null terminated, in the var header
+        sep = raw_msg.find('\x00', EMP_HEADER_SIZE, vhead_end - 1)
+        if sep < 0:
+            raise Exception("Invalid message format")
 
-        # Turn the payload into a python dictionary
-        try:
-            payload = eval(payload)
-        except:
-            raise Exception('Msg payload not of form { key: value, ... }')
+        return (msg_type,
+                msg_version,
+                raw_msg[EMP_HEADER_SIZE:sep],
+                raw_msg[sep + 1:vhead_end - 1],
+                raw_msg[vhead_end:crc_offset])
 
-        return (msg_type, sender_addr, dest_addr, payload)
+    @staticmethod
+    def _unpack_dest_addr(raw_msg):
+        """ Returns the given raw msg's destination address, read in place
+            from its var header, without validating the msg - As for routing
+            it, leaving that to its recipient. Assumes the msg is whole (see
+            split_raw_msgs()).
+        """
+        sizes = EMP_SIZES.unpack_from(raw_msg)[0]
+        vhead_end = EMP_HEADER_SIZE + (sizes & 0xFF)
+        sep = raw_msg.find('\x00', EMP_HEADER_SIZE, vhead_end - 1)
+        if sep < 0:
+            raise Exception("Invalid message format")
+        return raw_msg[sep + 1:vhead_end - 1]
 
 
 class Connection(object):
@@ -200,8 +433,18 @@ class Connection(object):
         """ Fetches the next message from the given queue at the broker and
             returns it. Also updates keep alive.
         """
-        self.client.fetch_next_msg(queue_name)
+        msg = self.client.fetch_next_msg(queue_name)
+        self.keep_alive()
+        return msg
+
+    def fetch_msgs(self, queue_name):
+        """ Fetches all available messages, up to FETCH_BATCH_SIZE, from the
+            given queue at the broker and returns them as a list. Also
+            updates keep alive.
+        """
+        msgs = self.client.fetch_msgs(queue_name)
         self.keep_alive()
+        return msgs
 
     def keep_alive(self):
         """ Update the last activity time to prevent timeout.
@@ -243,18 +486,27 @@ class Connection(object):
 
 
 class Client(object):
-    """ Exposes send_msg() and fetch_msg() interfaces to broker clients.
+    """ Exposes send_msg() and fetch_msg() interfaces to broker clients, and
+        their batch forms, send_msgs() and fetch_msgs(). Also subscribe(), for
+        msgs pushed by the broker as they arrive, and fetch_stats().
+        If the broker is in async mode, requests and responses are framed
+        (see send_frame()), else each is a single raw send/recv.
     """
 
     def __init__(self,
                  broker=BROKER,
-                 broker_send_port=SEND_PORT,
-                 broker_fetch_port=FETCH_PORT):
-        """
+                 broker_send_port=None,
+                 broker_fetch_port=None,
+                 broker_subscribe_port=None,
+                 broker_stats_port=None):
+        """ Ports not given default to this process' broker ports, as
+            configured or set by set_broker_ports().
         """
         self.broker = broker
-        self.send_port = broker_send_port
-        self.fetch_port = broker_fetch_port
+        self.send_port = broker_send_port or SEND_PORT
+        self.fetch_port = broker_fetch_port or FETCH_PORT
+        self.subscribe_port = broker_subscribe_port or SUBSCRIBE_PORT
+        self.stats_port = broker_stats_port or STATS_PORT
 
     def send_msg(self, message):
         """ Sends the given message (of type Message) over TCP/IP to the 
@@ -263,15 +515,20 @@ class Client(object):
             Returns True if msg sent succesfully, else raises an issue-
             specific exception.
         """
+        return self.send_msgs([message])
+
+    def send_msgs(self, messages):
+        """ Sends the given list of messages (of type Message) to the broker
+            in a single request. If any msg is invalid, none are enqueued.
+            Else each is, unless its queue is full and rejects it.
+            Returns True if all msgs were enqueued, else raises an issue-
+            specific exception. If only some were rejected, the others stay
+            enqueued and the exception's rejected attribute lists the
+            rejected msgs.
+        """
+        data = ''.join([to_wire(msg.raw_msg) for msg in messages])
         try:
-            # Init socket and connect to broker
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.broker, self.send_port))
-
-            # Send message and wait for a response
-            sock.send(message.raw_msg.encode('hex'))
-            response = sock.recv(MAX_MSG_SIZE).decode()
-            sock.close()
+            response = self._request(self.send_port, data)
         except:
             raise Exception('Send Error: Could not connect to broker.')
 
@@ -279,42 +536,357 @@ class Client(object):
             return True
         elif response == 'FAIL':
             raise Exception('Send Error: Broker responded with FAIL.')
+        elif response.startswith('REJECTED'):
+            rejected = [messages[int(i)] for i in response.split('\x00')[1:]]
+            e = Exception('Send Error: ' + str(len(rejected)) +
+                          ' msg(s) rejected - queue full or msg invalid.')
+            e.rejected = rejected
+            raise e
         else:
             err_str = 'Send Error: Unhandled response received from broker.'
             raise Exception(err_str)
 
-    def fetch_next_msg(self, queue_name):
+    def fetch_next_msg(self, queue_name, wait=0):
         """ Fetches the next msg from queue_name from the broker and returns it,
             Raises Queue.Empty if specified queue is empty.
+            wait: If nonzero, a long-poll - Seconds the broker may hold the
+                  request open, waiting for a msg, before responding.
         """
+        request = queue_name.encode()
+        if wait:
+            request += '\x001\x00' + str(wait)
         try:
-            # Establish socket connection
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.broker, self.fetch_port))
-
-            # Send queue name and wait for response
-            sock.send(queue_name.encode())
-            resp = sock.recv(MAX_MSG_SIZE)
+            resp = self._request(self.fetch_port,
+                                 request,
+                                 recv_fetch_resp,
+                                 wait)
         except:
             raise Exception('Fetch Error: Could not connect to broker.')
 
-        msg = None
         if resp == 'EMPTY':
             raise Queue.Empty  # No msg available to fetch
-        else:
-            msg = Message(resp.decode('hex'))  # Response is the msg
 
-        sock.close()
+        return Message(from_wire(resp))  # Response is the msg
 
-        return msg
+    def fetch_msgs(self, queue_name, max_msgs=FETCH_BATCH_SIZE, wait=0):
+        """ Fetches up to max_msgs msgs from queue_name from the broker, in a
+            single request, and returns them as a list, oldest first. The list
+            is empty if the queue is.
+            wait: If nonzero, a long-poll - Seconds the broker may hold the
+                  request open, waiting for a msg, before responding.
+        """
+        request = queue_name.encode() + '\x00' + str(max_msgs)
+        if wait:
+            request += '\x00' + str(wait)
+        try:
+            resp = self._request(self.fetch_port, request, _recv_all, wait)
+        except:
+            raise Exception('Fetch Error: Could not connect to broker.')
+
+        if resp == 'EMPTY':
+            return []
+
+        return [Message(raw_msg) for raw_msg in split_raw_msgs(resp)]
+
+    def subscribe(self, queue_name):
+        """ Subscribes to queue_name at the broker, over a persistent
+            connection, and yields each msg in the queue as the broker pushes
+            it, oldest first. Blocks between msgs. Raises an Exception if the
+            connection to the broker is lost.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(REFRESH_TIME + NET_TIMEOUT)  # Allow for heartbeats
+        try:
+            try:
+                sock.connect((self.broker, self.subscribe_port))
+                send_frame(sock, queue_name.encode())
+            except:
+                err_str = 'Subscribe Error: Could not connect to broker.'
+                raise Exception(err_str)
+
+            # Each frame is zero or more msgs. Zero is a heartbeat.
+            while True:
+                for raw_msg in split_raw_msgs(recv_frame(sock)):
+                    yield Message(raw_msg)
+        finally:
+            sock.close()
+
+    def fetch_stats(self):
+        """ Returns the broker's metrics, as a dict. See BrokerMetrics.stats().
+            If the broker is sharded, each shard serves its own, on the stats
+            port + its index, so all are fetched and merged (see
+            merge_stats()).
+        """
+        shards = BROKER_SHARDS if FRAMED else 1
+        return merge_stats([self._fetch_stats(self.stats_port + shard)
+                            for shard in range(shards)])
+
+    def _fetch_stats(self, port):
+        """ Returns the metrics served at the given broker stats port.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((self.broker, port))
+            return loads(_recv_all(sock))
+        except:
+            raise Exception('Stats Error: Could not connect to broker.')
+        finally:
+            sock.close()
+
+    def _request(self, port, data, recv_resp=None, wait=0):
+        """ Sends the given request data to the broker at the given port and
+            returns the broker's response. Framed requests go over a pooled,
+            persistent connection, if pooling is enabled.
+            recv_resp: For unframed requests, a function accepting the socket
+                       and returning the response. Defaults to a single recv.
+            wait: Seconds the broker may wait before responding, in addition
+                  to the usual network timeout.
+        """
+        timeout = NET_TIMEOUT + wait
+        if FRAMED and CLIENT_POOL_SIZE > 0:
+            return ConnPool.get(self.broker, port).request(data, timeout)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((self.broker, port))
+            if FRAMED:
+                send_frame(sock, data)
+                return recv_frame(sock)
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)  # Denotes end of request
+            if recv_resp:
+                return recv_resp(sock)
+            return sock.recv(MAX_MSG_SIZE)
+        finally:
+            sock.close()
+
+
+class ConnPool(object):
+    """ A pool of persistent, framed connections to a single broker port,
+        shared by all of a process' Clients. Connections are opened as needed,
+        up to size, and reused. A request over a reused connection that the
+        broker had dropped - its send failed, or the broker closed it without
+        a byte of response - is retried over a new one. Any other failure,
+        ex: a timeout, may come after the broker served the request, so is
+        raised rather than risk serving it twice.
+    """
+    _pools = {}  # All pools, by (PID, BROKER, PORT). PID keeps forks apart.
+    _pools_lock = Lock()
+
+    def __init__(self, broker, port, size=CLIENT_POOL_SIZE):
+        """ self._idle: (Queue) Open connections not currently in use
+            self._open: (int) Count of open connections, in use or idle
+        """
+        self.broker = broker
+        self.port = port
+        self.size = size
+        self._idle = Queue.Queue()
+        self._open = 0
+        self._open_lock = Lock()
+
+    @classmethod
+    def get(cls, broker, port):
+        """ Returns the current process' pool for the given broker and port.
+        """
+        key = (os.getpid(), broker, port)
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = ConnPool(broker, port)
+            return cls._pools[key]
+
+    def request(self, data, timeout=NET_TIMEOUT):
+        """ Sends the given data as a frame and returns the response frame.
+            timeout: Seconds to wait for the response.
+        """
+        sock, reused = self._checkout()
+        dropped = True  # Until the broker is known to have the request
+        try:
+            sock.settimeout(timeout)
+            send_frame(sock, data)
+            head = sock.recv(FRAME_HEADER.size)
+            if not head:
+                raise Exception('Connection closed by broker.')
+            dropped = False
+            head += _recv_exact(sock, FRAME_HEADER.size - len(head))
+            resp = _recv_exact(sock, FRAME_HEADER.unpack(head)[0])
+        except Exception as e:
+            self._discard(sock)
+            if not reused or not dropped or isinstance(e, socket.timeout):
+                raise
+            return self.request(data, timeout)  # Reconnect and retry
+
+        self._idle.put(sock)
+        return resp
+
+    def _checkout(self):
+        """ Returns an idle connection, else a new one if under size, else
+            waits for one to become idle. Also returns whether it was reused.
+        """
+        try:
+            return self._idle.get_nowait(), True
+        except Queue.Empty:
+            pass
+
+        with self._open_lock:
+            can_open = self._open < self.size
+            if can_open:
+                self._open += 1
+
+        if not can_open:
+            return self._idle.get(timeout=NET_TIMEOUT), True
+
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect((self.broker, self.port))
+        except:
+            self._discard(sock)
+            raise
+        return sock, False
+
+    def _discard(self, sock):
+        """ Closes the given connection, if any (i.e. None if it couldn't be
+            created), and frees its place in the pool.
+        """
+        if sock:
+            sock.close()
+        with self._open_lock:
+            self._open -= 1
+
+
+def set_broker_ports(send_port, fetch_port, subscribe_port, stats_port):
+    """ Sets the ports this process' broker listens on, and its clients
+        connect to by default, in place of those configured. Lets several
+        brokers, ex: one per BOS sandbox, run side by side, each with the
+        clients in its own processes.
+    """
+    global SEND_PORT, FETCH_PORT, SUBSCRIBE_PORT, STATS_PORT
+    SEND_PORT = send_port
+    FETCH_PORT = fetch_port
+    SUBSCRIBE_PORT = subscribe_port
+    STATS_PORT = stats_port
+
+
+def to_wire(raw_msg):
+    """ Returns the given raw EMP msg in its on-the-wire form - either as-is, 
+        or hex-encoded if the hex_wire (compatibility) flag is set.
+    """
+    if HEX_WIRE:
+        return raw_msg.encode('hex')
+    return raw_msg
+
+
+def from_wire(data):
+    """ Returns the raw EMP msg(s) contained in the given wire-form data.
+    """
+    if HEX_WIRE:
+        return data.decode('hex')
+    return data
+
+
+def split_raw_msgs(data):
+    """ Returns a list of the raw EMP msgs contained in the given wire-form
+        data, which may be any number of msgs back to back.
+    """
+    data = from_wire(data)
+    raw_msgs = []
+    start = 0
+    while start < len(data):
+        end = start + Message.size_from_header(
+            data[start:start + EMP_COMMON_SIZE])
+        if end > len(data):
+            raise Exception("Msg size mismatch - message may be truncated.")
+        raw_msgs.append(data[start:end])
+        start = end
+    return raw_msgs
+
+
+def recv_wire_msg(sock, prefix=''):
+    """ Receives a single EMP msg, in its wire form, from the given socket.
+        Reads exactly the msg's size, as given by its common header, over as
+        many recvs as needed. Accepts any already-received part of the msg.
+    """
+    scale = 2 if HEX_WIRE else 1  # Hex-encoding doubles the size
+    head = prefix + _recv_exact(sock, EMP_COMMON_SIZE * scale - len(prefix))
+    size = Message.size_from_header(from_wire(head))
+    return head + _recv_exact(sock, (size - EMP_COMMON_SIZE) * scale)
+
+
+def recv_wire_msgs(sock):
+    """ Receives a send request - one or more EMP msgs, back to back in their
+        wire form - from the given socket. Reads each msg by the size given
+        in its common header, so the sender needn't close its end of the
+        connection. The request ends at the first msg boundary followed by
+        nothing for SEND_BATCH_WAIT seconds, or by the sender closing its
+        end.
+    """
+    scale = 2 if HEX_WIRE else 1  # Hex-encoding doubles the size
+    chunks = []
+    while not chunks or select.select([sock], [], [], SEND_BATCH_WAIT)[0]:
+        head = sock.recv(EMP_COMMON_SIZE * scale)
+        if not head:
+            break  # The sender closed its end
+        chunks.append(recv_wire_msg(sock, head))
+    return ''.join(chunks)
+
+
+def recv_fetch_resp(sock):
+    """ Receives an unframed fetch response from the given socket - either
+        EMPTY, or a msg in its wire form.
+    """
+    head = _recv_exact(sock, len('EMPTY'))
+    if head == 'EMPTY':
+        return head
+    return recv_wire_msg(sock, head)
+
+
+def send_frame(sock, data):
+    """ Sends the given data over the given socket as a single frame.
+    """
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock):
+    """ Receives a single frame from the given socket and returns its data.
+    """
+    size = FRAME_HEADER.unpack(_recv_exact(sock, FRAME_HEADER.size))[0]
+    return _recv_exact(sock, size)
+
+
+def _recv_all(sock):
+    """ Receives from the given socket until the other side closes its end of
+        the connection, and returns all the data received.
+    """
+    chunks = []
+    while True:
+        chunk = sock.recv(MAX_MSG_SIZE)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def _recv_exact(sock, num_bytes):
+    """ Receives exactly num_bytes from the given socket, over as many recvs as
+        needed. Raises an Exception if the connection closes before then.
+    """
+    chunks = []
+    while num_bytes:
+        chunk = sock.recv(num_bytes)
+        if not chunk:
+            raise Exception('Connection closed mid-frame.')
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return ''.join(chunks)
 
 
 def get_6000_msg(loco):
         """ Returns a well-formed 6000 (loco status) msg for the given loco.
         """
-        con_str = str({k: v.conn_to.ID for (k, v)
-                       in loco.conns.iteritems()
-                       if v.connected() is True})
+        conns = {k: v.conn_to.ID for (k, v)
+                 in loco.conns.iteritems()
+                 if v.connected() is True}
                        
         status = {'loco': loco.ID,
                   'speed': loco.speed,
@@ -324,7 +896,7 @@ def get_6000_msg(loco):
                   'lat': loco.coords.lat,
                   'long': loco.coords.long,
                   'bpp': loco.bpp,
-                  'conns': con_str}
+                  'conns': conns}
 
         msg_type = 6000
         msg_source = loco.emp_addr
@@ -339,6 +911,758 @@ def get_6000_msg(loco):
         return status_msg
 
 
+class BrokerQueue(object):
+    """ A thread-safe, FIFO broker msg queue, bounded to maxsize msgs, whose
+        msgs expire expire_time seconds after being enqueued. When full, a put
+        either drops the oldest msg or is rejected, depending on overflow.
+        Msgs of the coalesce msg types are latest-value - a put replaces any
+        pending msg of the same type from the same sender.
+        If given a msg_log (a MsgLog), each msg put is appended to it, and
+        released from it when it leaves the queue, for any reason - except
+        a msg gotten without ack, which stays logged until acked once
+        delivered, or restored to the queue if its delivery failed.
+        Like Queue.Queue, raises Queue.Empty and Queue.Full.
+    """
+    def __init__(self,
+                 maxsize=QUEUE_MAX_SIZE,
+                 overflow=QUEUE_OVERFLOW,
+                 expire_time=MSG_EXPIRE_TIME,
+                 coalesce=COALESCE_MSG_TYPES,
+                 msg_log=None):
+        """ self.enqueued  : (int) Count of msgs enqueued, ever
+            self.dequeued  : (int) Count of msgs dequeued (i.e. fetched), ever
+            self.expired   : (int) Count of msgs expired, ever
+            self.dropped   : (int) Count of msgs dropped on overflow, ever
+            self.rejected  : (int) Count of msgs rejected on overflow, ever
+            self.coalesced : (int) Count of msgs replaced by newer ones, ever
+            self.ages      : (Histogram) Ages of msgs when dequeued, in secs
+
+            self._msgs: (deque) Msg entries by enqueue time, oldest first. 
+                        Since all msgs have the same expire_time, this is also
+                        FIFO. A replaced msg's entry stays, with a msg of None,
+                        until it reaches the head or the deque is compacted.
+                        [ [ENQUEUED_AT, Message, COALESCE_KEY], ... ]
+            self._pending: Entries of pending coalesce msgs, by coalesce key.
+                           { (MSG_TYPE, SENDER_ADDR): ENTRY }
+            self._size: (int) Count of msgs, i.e. entries not replaced
+        """
+        if overflow not in ('drop_oldest', 'reject'):
+            raise Exception('Invalid queue overflow policy: ' + overflow)
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.expire_time = expire_time or float('inf')  # 0 = Never expire
+        self.coalesce = coalesce
+        self.msg_log = msg_log
+        self.enqueued = 0
+        self.dequeued = 0
+        self.ages = Histogram()
+        self.expired = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self._msgs = deque()
+        self._pending = {}
+        self._size = 0
+        self._cond = Condition(Lock())
+
+    def qsize(self):
+        """ Returns the num of msgs in the queue, including any expired but not
+            yet removed.
+        """
+        return self._size
+
+    def put(self, msg, enqueued_at=None):
+        """ Adds the given msg to the queue, replacing any pending msg it
+            coalesces with. If the queue is full, either drops the oldest msg
+            or raises Queue.Full, depending on overflow.
+            enqueued_at: The msg's original enqueue time, if it's being 
+                         restored (and so is already in the msg log).
+        """
+        with self._cond:
+            now = time()
+            self._expire(now)
+
+            key = None
+            if msg.msg_type in self.coalesce:
+                key = (msg.msg_type, msg.sender_addr)
+                replaced = self._pending.get(key)
+                if replaced:
+                    self._release(replaced[1])
+                    replaced[1] = None
+                    self._size -= 1
+                    self.coalesced += 1
+                    self._compact()
+
+            if self.maxsize and self._size >= self.maxsize:
+                if self.overflow == 'reject':
+                    self.rejected += 1
+                    raise Queue.Full
+                self._popleft()
+                self.dropped += 1
+
+            if enqueued_at is None:
+                enqueued_at = now
+                if self.msg_log:
+                    self.msg_log.append(msg, now)
+
+            entry = [enqueued_at, msg, key]
+            self._msgs.append(entry)
+            self._size += 1
+            self.enqueued += 1
+            if key:
+                self._pending[key] = entry
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None, ack=True):
+        """ Removes and returns the oldest unexpired msg in the queue. If none,
+            waits up to timeout seconds for one (forever if None) if block,
+            else raises Queue.Empty.
+            ack: If False, the msg stays in the msg log until given to ack()
+                 or restore().
+        """
+        with self._cond:
+            self._expire(time())
+            if block and timeout is not None:
+                deadline = time() + timeout
+            while not self._size:
+                if not block:
+                    raise Queue.Empty
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._cond.wait(remaining)
+                self._expire(time())
+
+            enqueued_at, msg = self._popleft(release=ack)
+            self.dequeued += 1
+            self.ages.observe(time() - enqueued_at)
+            if not ack:
+                msg.enqueued_at = enqueued_at
+            return msg
+
+    def get_nowait(self, ack=True):
+        """ Removes and returns the oldest unexpired msg in the queue. Raises
+            Queue.Empty if none.
+        """
+        return self.get(False, ack=ack)
+
+    def ack(self, msgs):
+        """ Releases the given msgs, gotten without ack and since delivered,
+            from the msg log.
+        """
+        for msg in msgs:
+            self._release(msg)
+
+    def restore(self, msgs):
+        """ Returns the given msgs, gotten without ack but not delivered, to
+            the head of the queue, in order, with their original enqueue
+            times. A restored msg already replaced by a newer one of the same
+            coalesce key is released instead.
+        """
+        with self._cond:
+            for msg in reversed(msgs):
+                key = None
+                if msg.msg_type in self.coalesce:
+                    key = (msg.msg_type, msg.sender_addr)
+                    if key in self._pending:
+                        self._release(msg)
+                        self.coalesced += 1
+                        continue
+
+                entry = [msg.enqueued_at, msg, key]
+                self._msgs.appendleft(entry)
+                self._size += 1
+                self.dequeued -= 1
+                if key:
+                    self._pending[key] = entry
+            self._cond.notify()
+
+    def expire(self):
+        """ Removes all expired msgs from the queue and returns their count.
+        """
+        with self._cond:
+            return self._expire(time())
+
+    def stats(self):
+        """ Returns a dict of the queue's current size, lifetime enqueued,
+            dequeued, expired, dropped, rejected, and coalesced msg counts,
+            and a summary of msg ages at dequeue.
+        """
+        return {'size': self._size,
+                'enqueued': self.enqueued,
+                'dequeued': self.dequeued,
+                'msg_age': self.ages.summary(),
+                'expired': self.expired,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'coalesced': self.coalesced}
+
+    def _popleft(self, release=True):
+        """ Removes the oldest msg, discarding the entries of any replaced msgs
+            before it, and returns its enqueue time and the msg. Assumes the
+            caller holds self._cond and the queue is not empty.
+            release: If False, the msg is left in the msg log.
+        """
+        while True:
+            enqueued_at, msg, key = self._msgs.popleft()
+            if msg is not None:
+                break
+
+        self._size -= 1
+        if key:
+            del self._pending[key]
+        if release:
+            self._release(msg)
+        return enqueued_at, msg
+
+    def _release(self, msg):
+        """ Releases the given msg from the msg log, if any.
+        """
+        if self.msg_log:
+            self.msg_log.release(msg)
+
+    def _expire(self, now):
+        """ Removes msgs expired as of now and returns their count. Assumes
+            the caller holds self._cond.
+        """
+        count = 0
+        expired_at = now - self.expire_time  # Enqueued before this = expired
+        while self._msgs and self._msgs[0][0] <= expired_at:
+            if self._msgs[0][1] is None:
+                self._msgs.popleft()  # Replaced msg's entry
+                continue
+            self._popleft()
+            count += 1
+        self.expired += count
+        return count
+
+    def _compact(self):
+        """ Drops the entries of replaced msgs, if they're at least half of
+            all entries, keeping memory proportional to the num of msgs.
+            Assumes the caller holds self._cond.
+        """
+        if len(self._msgs) >= 2 * self._size + 64:
+            self._msgs = deque([e for e in self._msgs if e[1] is not None])
+
+
+class Histogram(object):
+    """ A histogram of observed values, ex: msg ages, in fixed buckets, given
+        by their upper bounds. Values above the last bound go in an overflow
+        bucket.
+    """
+    def __init__(self, bounds=AGE_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """ Adds the given value to the histogram.
+        """
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """ Adds the values of the given histogram, of the same bounds, to
+            this one.
+        """
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def merge_summary(self, summary):
+        """ Adds the values of the given summary (see summary()), of a
+            histogram of the same bounds, to this one.
+        """
+        self.buckets = [a + b for a, b in zip(self.buckets,
+                                              summary['buckets'])]
+        self.count += summary['count']
+        self.total += summary['mean'] * summary['count']
+        self.max = max(self.max, summary['max'])
+
+    def percentile(self, pct):
+        """ Returns an upper bound of the given percentile (0 - 100) of 
+            values - that of its bucket, or the max value for the overflow.
+        """
+        if not self.count:
+            return 0.0
+
+        target = self.count * pct / 100.0
+        seen = 0
+        for bound, num in zip(self.bounds, self.buckets):
+            seen += num
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        """ Returns a dict of the count, mean, max, and 50th, 90th, and 99th
+            percentiles of the values, and the bucket counts.
+        """
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': list(self.buckets)}
+
+
+class BrokerMetrics(object):
+    """ A broker's counters, of the names in METRIC_COUNTERS, and its recent
+        enqueue and dequeue rates. Safe to use from concurrent threads.
+    """
+    def __init__(self):
+        """ self.rates: Msgs per second, over the last tick() interval.
+                        { 'enqueued': RATE, 'dequeued': RATE }
+        """
+        self.started = time()
+        self.counters = dict.fromkeys(METRIC_COUNTERS, 0)
+        self.rates = {'enqueued': 0.0, 'dequeued': 0.0}
+        self._last_tick = (time(), 0, 0)  # (TIME, ENQUEUED, DEQUEUED)
+        self._lock = Lock()
+
+    def incr(self, counter, count=1):
+        """ Adds count to the given counter.
+        """
+        with self._lock:
+            self.counters[counter] += count
+
+    def tick(self, outgoing_queues):
+        """ Updates self.rates from the given dict of outgoing queues' total
+            enqueued and dequeued msg counts. Intended to be called 
+            periodically.
+        """
+        now = time()
+        queues = outgoing_queues.values()
+        enqueued = sum([q.enqueued for q in queues])
+        dequeued = sum([q.dequeued for q in queues])
+
+        last_time, last_enqueued, last_dequeued = self._last_tick
+        elapsed = now - last_time
+        if elapsed > 0:
+            self.rates = {'enqueued': (enqueued - last_enqueued) / elapsed,
+                          'dequeued': (dequeued - last_dequeued) / elapsed}
+        self._last_tick = (now, enqueued, dequeued)
+
+    def stats(self, outgoing_queues):
+        """ Returns a dict of the broker's uptime, counters, current open
+            connections, rates, and the given dict of outgoing queues' stats.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+        counters['connections_open'] = (counters['connections_opened'] - 
+                                        counters['connections_closed'])
+
+        return {'uptime': time() - self.started,
+                'counters': counters,
+                'rates': dict(self.rates),
+                'queues': queue_stats(outgoing_queues)}
+
+
+def count_metric(outgoing_queues, counter, count=1):
+    """ Adds count to the given counter of the given dict of outgoing queues'
+        broker metrics, if it has any.
+    """
+    metrics = getattr(outgoing_queues, 'metrics', None)
+    if metrics:
+        metrics.incr(counter, count)
+
+
+class MsgLog(object):
+    """ A broker's append-only, on-disk write-ahead log of enqueued msgs, so
+        pending msgs survive a broker restart. The log is a dir of numbered
+        segment files, rotated every segment_size bytes. Each record is
+        either an append, of a msg and its enqueue time, or a release, of a
+        msg that has left its queue (i.e. was fetched, dropped, expired, or
+        coalesced). Both are keyed by the msg's seq num. See WAL_RECORD.
+        A fetched or pushed msg is released once sent to its client, not
+        once the client has it - There's no client ack - so a msg sent just
+        before its client (or the connection) fails may be lost.
+        Records are fsync'd in batches, every sync_count records or 
+        sync_interval seconds, whichever is first, so a crash may lose the
+        newest records. Segments are deleted, oldest first, once all their
+        msgs have been released.
+    """
+    def __init__(self,
+                 log_dir,
+                 segment_size=WAL_SEGMENT_SIZE,
+                 sync_count=WAL_SYNC_COUNT,
+                 sync_interval=WAL_SYNC_INTERVAL):
+        """ self._segments: (OrderedDict) Unreleased msg counts, by segment 
+                            ID, oldest first. { SEG_ID: COUNT }
+            self._seg_id: (int) The active (i.e. being appended) segment ID
+        """
+        self.log_dir = log_dir
+        self.segment_size = segment_size
+        self.sync_count = sync_count
+        self.sync_interval = sync_interval
+        self._segments = OrderedDict()
+        self._seg_id = None
+        self._seq = 0  # Last used msg seq num
+        self._fd = None
+        self._seg_bytes = 0
+        self._unsynced = 0
+        self._last_sync = time()
+        self._lock = Lock()
+
+    def replay(self, outgoing_queues):
+        """ Restores each unreleased msg in the log to its queue in the given
+            dict of outgoing queues, in order and with its original enqueue
+            time, then readies the log for appends. Returns the num of msgs
+            restored. Call once, before any appends.
+        """
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        # Read all segments, keeping only unreleased appends
+        pending = OrderedDict()  # { SEQ: (SEG_ID, ENQUEUED_AT, RAW_MSG) }
+        for seg_id in self._segment_ids():
+            self._segments[seg_id] = 0
+            for op, seq, enqueued_at, data in self._read_segment(seg_id):
+                self._seq = max(self._seq, seq)
+                if op == WAL_APPEND:
+                    pending[seq] = (seg_id, enqueued_at, data)
+                else:
+                    pending.pop(seq, None)
+
+        # Releases of restored msgs go to a new segment
+        with self._lock:
+            self._open_segment(next(reversed(self._segments), 0) + 1)
+
+        count = 0
+        for seq, (seg_id, enqueued_at, raw_msg) in pending.iteritems():
+            try:
+                msg = Message(raw_msg)
+            except Exception as e:
+                broker_log.error('Skipped invalid logged msg: ' + str(e))
+                continue
+
+            msg.wal_seq = seq
+            msg.wal_seg = seg_id
+            self._segments[seg_id] += 1
+            try:
+                queue = get_queue(outgoing_queues, msg.dest_addr)
+                queue.put(msg, enqueued_at)
+                count += 1
+            except Queue.Full:
+                self.release(msg)
+
+        with self._lock:
+            self._truncate()
+            self._sync()
+
+        syncer = Thread(target=self._syncer)
+        syncer.daemon = True
+        syncer.start()
+        return count
+
+    def append(self, msg, enqueued_at):
+        """ Appends the given msg, enqueued at the given time, to the log.
+        """
+        with self._lock:
+            self._seq += 1
+            msg.wal_seq = self._seq
+            msg.wal_seg = self._seg_id
+            self._segments[self._seg_id] += 1
+            self._write(WAL_RECORD.pack(WAL_APPEND,
+                                        self._seq,
+                                        enqueued_at,
+                                        len(msg.raw_msg)) + msg.raw_msg)
+
+    def release(self, msg):
+        """ Releases the given msg from the log. I.e. it need not be restored.
+        """
+        with self._lock:
+            seg_id = getattr(msg, 'wal_seg', None)
+            if seg_id is None:
+                return  # Not logged, or already released
+            msg.wal_seg = None
+
+            self._write(WAL_RECORD.pack(WAL_RELEASE, msg.wal_seq, 0, 0))
+            self._segments[seg_id] -= 1
+            self._truncate()
+
+    def _segment_ids(self):
+        """ Returns the IDs of the segment files in the log dir, in order.
+        """
+        return sorted([int(f[:-4]) for f in os.listdir(self.log_dir)
+                       if f.endswith('.wal') and f[:-4].isdigit()])
+
+    def _path(self, seg_id):
+        """ Returns the given segment's file path.
+        """
+        return os.path.join(self.log_dir, '%010d.wal' % seg_id)
+
+    def _read_segment(self, seg_id):
+        """ Yields each record in the given segment as a tuple of the form
+            (OP, SEQ, ENQUEUED_AT, DATA), reading the file via mmap. Stops at 
+            the first incomplete record, as from a write cut off by a crash.
+        """
+        with open(self._path(seg_id), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            log_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            offset = 0
+            while offset + WAL_RECORD.size <= size:
+                op, seq, enqueued_at, length = \
+                    WAL_RECORD.unpack_from(log_map, offset)
+                start = offset + WAL_RECORD.size
+                if op not in (WAL_APPEND, WAL_RELEASE) or start + length > size:
+                    break
+                offset = start + length
+                yield op, seq, enqueued_at, log_map[start:offset]
+        finally:
+            log_map.close()
+
+    def _open_segment(self, seg_id):
+        """ Makes a new segment, of the given ID, the active segment. Assumes
+            the caller holds self._lock.
+        """
+        if self._fd is not None:
+            self._sync()
+            os.close(self._fd)
+
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        self._fd = os.open(self._path(seg_id), flags, 0644)
+        self._seg_id = seg_id
+        self._seg_bytes = 0
+        self._segments[seg_id] = 0
+
+    def _write(self, record):
+        """ Writes the given record to the active segment, syncing if due and
+            rotating if full. Assumes the caller holds self._lock.
+        """
+        os.write(self._fd, record)
+        self._seg_bytes += len(record)
+        self._unsynced += 1
+
+        if self._unsynced >= self.sync_count:
+            self._sync()
+        if self._seg_bytes >= self.segment_size:
+            self._open_segment(self._seg_id + 1)
+            self._truncate()
+
+    def _sync(self):
+        """ Fsyncs the active segment, if it has unsynced records. Assumes the
+            caller holds self._lock.
+        """
+        if self._unsynced:
+            os.fsync(self._fd)
+            self._unsynced = 0
+        self._last_sync = time()
+
+    def _truncate(self):
+        """ Deletes the oldest segments, up to the active one, while all their
+            msgs have been released. Only the oldest may go, because a
+            segment may hold releases of msgs in the segments before it.
+            Assumes the caller holds self._lock.
+        """
+        for seg_id, count in self._segments.items():
+            if count or seg_id == self._seg_id:
+                break
+            del self._segments[seg_id]
+            try:
+                os.remove(self._path(seg_id))
+            except OSError as e:
+                broker_log.error('Could not remove log segment: ' + str(e))
+
+    def _syncer(self):
+        """ Fsyncs the log every sync_interval seconds, if needed. Intended to
+            run as a thread.
+        """
+        while True:
+            sleep(self.sync_interval)
+            with self._lock:
+                if time() - self._last_sync >= self.sync_interval:
+                    self._sync()
+
+
+class QueueMap(dict):
+    """ A broker's outgoing msg queues, by address. { ADDRESS: BrokerQueue }
+        Queues are created with the map's msg_log, if any. Also holds the
+        broker's metrics.
+    """
+    def __init__(self, msg_log=None):
+        dict.__init__(self)
+        self.msg_log = msg_log
+        self.metrics = BrokerMetrics()
+
+
+def enqueue_msg(outgoing_queues, msg):
+    """ Adds the given msg to its queue in the given dict of outgoing queues,
+        keyed by dest_addr, creating the queue if needed.
+    """
+    get_queue(outgoing_queues, msg.dest_addr).put(msg)
+
+
+def get_queue(outgoing_queues, queue_name):
+    """ Returns the named queue from the given dict of outgoing queues,
+        creating it if needed. Safe to call from concurrent threads.
+    """
+    queue = outgoing_queues.get(queue_name)
+    if queue is None:
+        msg_log = getattr(outgoing_queues, 'msg_log', None)
+        queue = outgoing_queues.setdefault(queue_name,
+                                           BrokerQueue(msg_log=msg_log))
+    return queue
+
+
+def serve_send(outgoing_queues, data):
+    """ Serves the given send request, i.e. one or more msgs in wire form,
+        by adding each msg to its queue in the given dict of outgoing queues.
+        If any msg is invalid, raises an Exception and no msgs are enqueued.
+        Else returns the msgs enqueued and the indexes, in the request, of
+        any rejected by a full queue (see send_response()).
+    """
+    count_metric(outgoing_queues, 'send_requests')
+    try:
+        msgs = [Message(raw_msg) for raw_msg in split_raw_msgs(data)]
+        if not msgs:
+            raise Exception('Empty send request.')
+    except Exception as e:
+        count_metric(outgoing_queues, 'send_failures')
+        if str(e).startswith('CRC Mismatch'):
+            count_metric(outgoing_queues, 'crc_failures')
+        raise
+
+    enqueued = []
+    rejected = []
+    for i, msg in enumerate(msgs):
+        try:
+            enqueue_msg(outgoing_queues, msg)
+            enqueued.append(msg)
+        except Queue.Full:
+            rejected.append(i)
+
+    if rejected:
+        count_metric(outgoing_queues, 'send_failures')
+    return enqueued, rejected
+
+
+def send_response(rejected):
+    """ Returns the response to a served send request given the indexes of
+        its msgs rejected, if any - Either OK, or REJECTED followed by each
+        index, null-delimited.
+    """
+    if not rejected:
+        return 'OK'
+    return '\x00'.join(['REJECTED'] + [str(i) for i in rejected])
+
+
+def expire_msgs(outgoing_queues):
+    """ Removes expired msgs from each of the given dict of outgoing queues,
+        logging the num removed, if any.
+    """
+    expired = sum([q.expire() for q in outgoing_queues.values()])
+    if expired:
+        broker_log.info('Expired ' + str(expired) + ' msg(s).')
+
+
+def queue_stats(outgoing_queues):
+    """ Returns a dict of stats for the given dict of outgoing queues - their
+        total size, enqueued, dequeued, expired, dropped, rejected, and 
+        coalesced msg counts, a summary of all msg ages at dequeue, and each
+        queue's stats by queue name.
+    """
+    queues = outgoing_queues.items()
+    keys = ('size', 'enqueued', 'dequeued', 'expired', 'dropped', 'rejected',
+            'coalesced')
+    stats = dict([(name, q.stats()) for name, q in queues])
+    totals = dict([(k, sum([q[k] for q in stats.values()])) for k in keys])
+
+    ages = Histogram()
+    for _, q in queues:
+        ages.merge(q.ages)
+    totals['msg_age'] = ages.summary()
+    totals['queues'] = stats
+    return totals
+
+
+def merge_stats(shard_stats):
+    """ Returns the given list of broker shards' stats (see
+        BrokerMetrics.stats()) merged into those of one broker - The longest
+        uptime, the sums of counters, rates, and queue totals, and all msg
+        ages. Each queue is on a single shard, so its stats are given as is.
+    """
+    merged = {'uptime': max([stats['uptime'] for stats in shard_stats]),
+              'counters': {},
+              'rates': {},
+              'queues': {'queues': {}}}
+    ages = Histogram()
+    for stats in shard_stats:
+        for key in ('counters', 'rates'):
+            for name, value in stats[key].items():
+                merged[key][name] = merged[key].get(name, 0) + value
+
+        for name, value in stats['queues'].items():
+            if name == 'msg_age':
+                ages.merge_summary(value)
+            elif name == 'queues':
+                merged['queues']['queues'].update(value)
+            else:
+                merged['queues'][name] = merged['queues'].get(name, 0) + value
+    merged['queues']['msg_age'] = ages.summary()
+    return merged
+
+
+def parse_fetch(request):
+    """ Returns the queue name, max num of msgs, and long-poll wait seconds
+        of the given fetch request. A request is a queue name, optionally
+        followed by a null and the max num of msgs to fetch, optionally
+        followed by a null and the wait. Without a max, at most one msg is
+        served. Without a wait, the request never waits for a msg.
+    """
+    fields = request.split('\x00')
+    queue_name = fields[0]
+    max_msgs = int(fields[1]) if len(fields) > 1 and fields[1] else 1
+    wait = float(fields[2]) if len(fields) > 2 and fields[2] else 0
+    return queue_name, max_msgs, min(wait, MAX_FETCH_WAIT)
+
+
+def serve_fetch(outgoing_queues, request, block=False):
+    """ Serves the given fetch request from the given dict of outgoing queues.
+        Returns the response data - either the requested msgs in wire form,
+        back to back, or EMPTY - the msgs' queue, and the msgs. The msgs are
+        gotten without ack, so the caller must give them to the queue's
+        ack() once the response is sent, or to its restore() if not.
+        block: If True, waits up to the request's long-poll wait for a msg,
+               if none are available. Else, never blocks.
+    """
+    queue_name, max_msgs, wait = parse_fetch(request)
+    block = block and wait > 0
+    if block:
+        queue = get_queue(outgoing_queues, queue_name)
+    else:
+        queue = outgoing_queues.get(queue_name)
+
+    msgs = []
+    while queue and len(msgs) < max_msgs:
+        try:
+            if block and not msgs:
+                # Wakes on msg arrival
+                msgs.append(queue.get(timeout=wait, ack=False))
+            else:
+                msgs.append(queue.get_nowait(ack=False))
+        except Queue.Empty:
+            break
+
+    if not msgs:
+        return 'EMPTY', queue, msgs
+    return ''.join([to_wire(msg.raw_msg) for msg in msgs]), queue, msgs
+
+
 class Receiver(Thread):
     """ Watches for incoming EMP messages over TCP/IP on the interface and port 
         specified and adds them to the given list of queues (a list)
@@ -351,8 +1675,9 @@ class Receiver(Thread):
         # Init TCP/IP listener
         try:
             sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind((BROKER, SEND_PORT))
-            sock.listen(1)
+            sock.listen(LISTEN_BACKLOG)
         except:
             print('!!ERROR 1!! - See issue #9')
             exit()
@@ -363,17 +1688,19 @@ class Receiver(Thread):
                 conn, client = sock.accept()
             except:
                 continue
+            count_metric(self.outgoing_queues, 'connections_opened')
 
-            # Receive the msg from sender, responding with either OK or FAIL
-            log_str = 'Incoming msg from ' + str(client[0]) + ' gave: '
+            # Receive the msg(s) from sender, responding with OK, REJECTED (if
+            # any msgs were), or FAIL
             try:
-                raw_msg = conn.recv(MAX_MSG_SIZE).decode()
-                msg = Message(raw_msg.decode('hex'))
-                conn.send('OK'.encode())
+                msgs, rejected = serve_send(self.outgoing_queues,
+                                            recv_wire_msgs(conn))
+                conn.send(send_response(rejected).encode())
                 conn.close()
+                count_metric(self.outgoing_queues, 'connections_closed')
             except Exception as e:
-                log_str += 'Msg recv failed due to ' + str(e)
-                broker_log.error(log_str)
+                broker_log.error('Incoming msg from %s gave: '
+                                 'Msg recv failed due to %s', client[0], e)
 
                 try:
                     conn.send('FAIL'.encode())
@@ -381,15 +1708,16 @@ class Receiver(Thread):
                     pass
 
                 conn.close()
+                count_metric(self.outgoing_queues, 'connections_closed')
                 continue
 
-            # Add msg to outgoing queue dict, keyed by dest_addr
-            if not self.outgoing_queues.get(msg.dest_addr):
-                self.outgoing_queues[msg.dest_addr] = Queue.Queue()
-            self.outgoing_queues[msg.dest_addr].put(msg)
-            log_str = 'Msg served: ' + msg.sender_addr + ' '
-            log_str += 'to ' + msg.dest_addr
-            broker_log.info(log_str)
+            for msg in msgs:
+                broker_log.info('Msg served: %s to %s',
+                                msg.sender_addr, msg.dest_addr)
+            if rejected:
+                broker_log.error('Incoming msg from %s gave: %d msg(s) '
+                                 'rejected - queue full.',
+                                 client[0], len(rejected))
 
         # Do cleanup
         sock.close()
@@ -398,8 +1726,9 @@ class Receiver(Thread):
 class MsgServer(Thread):
     """ Watches for incoming TCP/IP msg requests (ex, A loco or the BOS
         checking its msg queue) and serves them from the given list of queues 
-        by address.
-        After a msg is served it's removed from the queue.
+        by address, each in its own thread, so long-polls don't block others.
+        After a msg is served it's removed from the queue, and released from
+        the msg log once sent - On a failed send, it's restored.
     """
     def __init__(self, outgoing_queues):
         Thread.__init__(self)
@@ -409,8 +1738,9 @@ class MsgServer(Thread):
         # Init listener
         try:
             sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind((BROKER, FETCH_PORT))
-            sock.listen(1)
+            sock.listen(LISTEN_BACKLOG)
         except:
             print('!!ERROR 2!! - See issue #9')
             exit()
@@ -421,31 +1751,708 @@ class MsgServer(Thread):
                 conn, client = sock.accept()
             except:
                 continue
+            count_metric(self.outgoing_queues, 'connections_opened')
 
             # Process the request
-            log_str = 'Fetch request from ' + str(client[0]) + ' '
+            server = Thread(target=self._serve, args=(conn, client))
+            server.daemon = True
+            server.start()
+
+        # Do cleanup
+        sock.close()
+
+    def _serve(self, conn, client):
+        """ Serves the fetch request on the given connection, then closes it.
+        """
+        count_metric(self.outgoing_queues, 'fetch_requests')
+        try:
+            request = _recv_all(conn)
+            resp, queue, msgs = serve_fetch(self.outgoing_queues, request,
+                                            True)
             try:
-                queue_name = conn.recv(MAX_MSG_SIZE).decode()
-                log_str += 'for ' + queue_name + ' gave: '
+                conn.sendall(resp)
+            except:
+                if msgs:
+                    queue.restore(msgs)
+                raise
+            if msgs:
+                queue.ack(msgs)
+                broker_log.info('Fetch request from %s for %s gave: '
+                                '%d msg(s) served.',
+                                client[0], request.split('\x00')[0],
+                                len(msgs))
+            else:
+                broker_log.info('Fetch request from %s for %s gave: '
+                                'Queue empty.',
+                                client[0], request.split('\x00')[0])
+        except:
+            pass
+        conn.close()
+        count_metric(self.outgoing_queues, 'connections_closed')
+
+
+class SubscriptionServer(Thread):
+    """ Watches for incoming TCP/IP subscribe requests (ex, The BOS watching 
+        its msg queue) and pushes msgs from the requested queue over the
+        connection as they arrive, each subscriber in its own thread. Pushes
+        are framed, and each is a batch of one or more msgs, or an empty
+        heartbeat every REFRESH_TIME. A queue has at most one subscriber -
+        the newest. Any older one is disconnected.
+        Msgs are removed from the queue as they're pushed, but released from
+        the msg log only once sent - On a failed push, they're restored.
+    """
+    def __init__(self, outgoing_queues):
+        """ self._subscribers: Subscriber connections, by queue name.
+                               { QUEUE_NAME: CONN }
+        """
+        Thread.__init__(self)
+        self.outgoing_queues = outgoing_queues
+        self._subscribers = {}
+        self._lock = Lock()
+
+    def run(self):
+        # Init listener
+        try:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((BROKER, SUBSCRIBE_PORT))
+            sock.listen(LISTEN_BACKLOG)
+        except:
+            print('!!ERROR 3!! - See issue #9')
+            exit()
+
+        while True:
+            # Block until timeout or a subscribe request is received
+            try:
+                conn, client = sock.accept()
+            except:
+                continue
+            count_metric(self.outgoing_queues, 'connections_opened')
+
+            publisher = Thread(target=self._serve, args=(conn, client))
+            publisher.daemon = True
+            publisher.start()
+
+        # Do cleanup
+        sock.close()
+
+    def _serve(self, conn, client):
+        """ Pushes msgs to the subscriber on the given connection until it
+            disconnects.
+        """
+        count_metric(self.outgoing_queues, 'subscribe_requests')
+        try:
+            queue_name = recv_frame(conn)
+            queue = get_queue(self.outgoing_queues, queue_name)
+            with self._lock:
+                replaced = self._subscribers.get(queue_name)
+                self._subscribers[queue_name] = conn
+            if replaced:
+                try:
+                    replaced.shutdown(socket.SHUT_RDWR)  # Its thread exits
+                except socket.error:
+                    pass  # Already closed
+                broker_log.info('Subscriber replaced for %s', queue_name)
+            broker_log.info('Subscriber %s subscribed to %s',
+                            client[0], queue_name)
+
+            while self._subscribers.get(queue_name) is conn:
+                msgs = []
+                try:
+                    # Wakes on arrival
+                    msgs.append(queue.get(timeout=REFRESH_TIME, ack=False))
+                    while len(msgs) < FETCH_BATCH_SIZE:
+                        msgs.append(queue.get_nowait(ack=False))
+                except Queue.Empty:
+                    pass
 
-                msg = None
                 try:
-                    msg = self.outgoing_queues[queue_name].get(timeout=.5)
+                    wire_msgs = [to_wire(msg.raw_msg) for msg in msgs]
+                    send_frame(conn, ''.join(wire_msgs))  # Empty = heartbeat
                 except:
-                    log_str += 'Queue empty.'
-                    conn.send('EMPTY'.encode())
+                    queue.restore(msgs)
+                    raise
+                queue.ack(msgs)
+
+                if msgs:
+                    broker_log.info('Subscriber %s pushed %d msg(s).',
+                                    client[0], len(msgs))
+        except Exception as e:
+            broker_log.info('Subscriber %s disconnected: %s', client[0], e)
+
+        with self._lock:
+            for queue_name, subscriber in self._subscribers.items():
+                if subscriber is conn:
+                    del self._subscribers[queue_name]
+        conn.close()
+        count_metric(self.outgoing_queues, 'connections_closed')
+
+
+class StatsServer(Thread):
+    """ Serves the broker's metrics (see BrokerMetrics.stats()) as JSON on
+        the given port. Each client is sent the current stats, then the
+        connection is closed. Ex: `nc localhost 18184`
+    """
+    def __init__(self, outgoing_queues, port):
+        Thread.__init__(self)
+        self.daemon = True
+        self.outgoing_queues = outgoing_queues
+        self.port = port
 
-                if msg:
-                    conn.send(msg.raw_msg.encode('hex'))  # Send msg
-                    log_str += 'Msg served.'
+    def run(self):
+        # Init listener
+        try:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((BROKER, self.port))
+            sock.listen(LISTEN_BACKLOG)
+        except Exception as e:
+            broker_log.error('Stats server failed to start: ' + str(e))
+            return
 
-                broker_log.info(log_str)
-                conn.close()
+        while True:
+            try:
+                conn, client = sock.accept()
             except:
                 continue
 
-        # Do cleanup
-        sock.close()
+            try:
+                metrics = self.outgoing_queues.metrics
+                conn.sendall(dumps(metrics.stats(self.outgoing_queues)))
+            except Exception as e:
+                broker_log.error('Stats request failed: ' + str(e))
+            conn.close()
+
+
+class FramedHandler(asyncore.dispatcher):
+    """ An async broker connection. Buffers incoming data, passing each
+        complete frame to the given on_frame(handler, data) callback, and
+        buffers outgoing frames until the socket is writable. Any number of
+        frames may be exchanged over the connection. If set, on_drain(handler)
+        is called each time all outgoing frames have been sent, and on_close()
+        when the connection closes. Closing also closes its upstreams.
+        If sock is None, the handler's socket is created and connected by the
+        caller (see asyncore.dispatcher) - Frames sent meanwhile are queued.
+    """
+    def __init__(self, sock, on_frame, sock_map):
+        """ self.upstreams: Connections to other brokers opened on this
+                            connection's behalf, by key. { KEY: HANDLER }
+        """
+        asyncore.dispatcher.__init__(self, sock, map=sock_map)
+        self.on_frame = on_frame
+        self.on_drain = None
+        self.on_close = None
+        self.upstreams = {}
+        self._inbuf = ''
+        self._outbuf = ''
+
+    def send_frame(self, data):
+        """ Queues the given data to be sent as a single frame.
+        """
+        self._outbuf += FRAME_HEADER.pack(len(data)) + data
+
+    def handle_read(self):
+        self._inbuf += self.recv(65536)
+
+        # Pass along each complete frame, keeping any partial one
+        start = 0
+        header_size = FRAME_HEADER.size
+        while len(self._inbuf) - start >= header_size:
+            size = FRAME_HEADER.unpack_from(self._inbuf, start)[0]
+            end = start + header_size + size
+            if len(self._inbuf) < end:
+                break
+            self.on_frame(self, self._inbuf[start + header_size:end])
+            start = end
+        self._inbuf = self._inbuf[start:]
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._outbuf)
+        self._outbuf = self._outbuf[sent:]
+        if not self._outbuf and self.on_drain:
+            self.on_drain(self)
+
+    def draining(self):
+        """ Returns True if outgoing frames are waiting to be sent.
+        """
+        return bool(self._outbuf)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        on_close, self.on_close = self.on_close, None  # Call at most once
+        if on_close:
+            on_close()
+        for upstream in self.upstreams.values():
+            upstream.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        broker_log.error('Closed connection due to error: ' + 
+                         str(asyncore.compact_traceback()[2]))
+        self.close()
+
+
+class FramedListener(asyncore.dispatcher):
+    """ An async TCP/IP listener. Each accepted connection is given its own
+        FramedHandler, with the given on_frame callback.
+        sock: An already listening socket to use, instead of binding port.
+        reuse_port: If True, other sockets may listen on the same port, with
+                    the OS balancing new connections among them.
+        on_accept: If given, called with each new FramedHandler.
+    """
+    def __init__(self, port, on_frame, sock_map, sock=None, reuse_port=False,
+                 on_accept=None):
+        asyncore.dispatcher.__init__(self, sock, map=sock_map)
+        self.on_frame = on_frame
+        self.sock_map = sock_map
+        self.on_accept = on_accept
+        if sock:
+            self.accepting = True
+            return
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.bind((BROKER, port))
+        self.listen(LISTEN_BACKLOG)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair:
+            handler = FramedHandler(pair[0], self.on_frame, self.sock_map)
+            if self.on_accept:
+                self.on_accept(handler)
+
+
+class AsyncBroker(object):
+    """ A single-threaded, event-driven alternative to the Receiver, MsgServer
+        and SubscriptionServer threads. Serves the send, fetch, and subscribe
+        protocols on their usual ports, but framed, to any number of
+        concurrent clients, each of which may make any number of requests per
+        connection.
+        May also run as one of several shards (see MsgBroker), each owning
+        the queues of a hash partition of EMP addresses (see shard_of()).
+        Requests arriving at a shard not owning their queue are forwarded to
+        the owner's internal listeners, over a connection per client
+        connection, and the owner's responses relayed back.
+    """
+    def __init__(self, outgoing_queues, shard=0, shard_socks=None,
+                 parent_pid=None):
+        """ shard: This broker's index among the shards, if sharded.
+            shard_socks: If sharded, each shard's internal, already listening,
+                         (send, fetch, subscribe) sockets, by shard index.
+            parent_pid: If given, the broker exits when its parent does.
+
+            self._waiting: Long-poll fetches waiting on a msg, by queue name,
+                           oldest first. { QUEUE_NAME: [(DEADLINE, HANDLER, 
+                           REQUEST), ... ] }
+            self._subscribers: Subscriber connections, by queue name. 
+                               { QUEUE_NAME: HANDLER }
+            self._pushed: Msgs pushed to each subscriber but not yet sent,
+                          and their queue. { HANDLER: (QUEUE, [MSG, ... ]) }
+            self._fetched: Msgs fetched over each connection but not yet
+                           sent, and their queue, by fetch.
+                           { HANDLER: [(QUEUE, [MSG, ... ]), ... ] }
+        """
+        self.outgoing_queues = outgoing_queues
+        self.shard = shard
+        self._shard_socks = shard_socks
+        self._parent_pid = parent_pid
+        self._sock_map = {}  # The asyncore socket map, for this broker only
+        self._waiting = {}
+        self._subscribers = {}
+        self._pushed = {}
+        self._fetched = {}
+
+    def run(self):
+        """ Serves requests until the process (or its parent, if given) is
+            terminated. Blocks.
+        """
+        handlers = (self._on_send, self._on_fetch, self._on_subscribe)
+        ports = (SEND_PORT, FETCH_PORT, SUBSCRIBE_PORT)
+        try:
+            if not self._shard_socks:
+                for port, on_frame in zip(ports, handlers):
+                    FramedListener(port, on_frame, self._sock_map,
+                                   on_accept=self._on_accept)
+            else:
+                # Internal listeners, for requests forwarded by other shards
+                for sock, on_frame in zip(self._shard_socks[self.shard],
+                                          handlers):
+                    FramedListener(None, on_frame, self._sock_map, sock)
+
+                # Public listeners, shared by all shards if the OS allows,
+                # else served by the first shard only.
+                reuse_port = hasattr(socket, 'SO_REUSEPORT')
+                if reuse_port or self.shard == 0:
+                    routers = (self._route_send,
+                               self._route_fetch,
+                               self._route_subscribe)
+                    for port, on_frame in zip(ports, routers):
+                        FramedListener(port, on_frame, self._sock_map,
+                                       reuse_port=reuse_port,
+                                       on_accept=self._on_accept)
+        except Exception as e:
+            broker_log.error('Async broker failed to start: ' + str(e))
+            exit()
+
+        last_beat = time()
+        while True:
+            asyncore.loop(timeout=self._poll_timeout(),
+                          use_poll=True,
+                          map=self._sock_map,
+                          count=1)
+            self._expire_waiting()
+
+            if time() - last_beat >= REFRESH_TIME:
+                self._heartbeat()
+                expire_msgs(self.outgoing_queues)
+                self.outgoing_queues.metrics.tick(self.outgoing_queues)
+                last_beat = time()
+
+                if self._parent_pid and os.getppid() != self._parent_pid:
+                    return  # Orphaned
+
+    def _on_accept(self, handler):
+        """ Counts the given new client connection, and its closing.
+        """
+        count_metric(self.outgoing_queues, 'connections_opened')
+        handler.on_close = lambda: count_metric(self.outgoing_queues,
+                                                'connections_closed')
+
+    def _poll_timeout(self):
+        """ Returns the seconds until the next long-poll fetch times out, up
+            to REFRESH_TIME.
+        """
+        deadlines = [deadline for waiting in self._waiting.values()
+                     for deadline, _, _ in waiting]
+        if not deadlines:
+            return REFRESH_TIME
+        return max(0, min(min(deadlines) - time(), REFRESH_TIME))
+
+    def _expire_waiting(self):
+        """ Responds EMPTY to each long-poll fetch whose wait has elapsed.
+        """
+        now = time()
+        for queue_name, waiting in self._waiting.items():
+            for deadline, handler, _ in waiting:
+                if deadline <= now and handler.connected:
+                    handler.send_frame('EMPTY')
+
+            waiting = [w for w in waiting if w[0] > now]
+            if waiting:
+                self._waiting[queue_name] = waiting
+            else:
+                del self._waiting[queue_name]
+
+    def _heartbeat(self):
+        """ Sends each subscriber an empty push, so each end knows the other
+            is alive, and forgets disconnected subscribers.
+        """
+        for queue_name, handler in self._subscribers.items():
+            if handler.connected:
+                handler.send_frame('')
+            else:
+                del self._subscribers[queue_name]
+
+    def _push(self, queue_name):
+        """ Pushes the next batch of up to FETCH_BATCH_SIZE msgs in the given
+            queue to its subscriber, if any, unless it's still being sent the
+            last batch. Msgs stay queued (and coalescable) until then, and
+            logged until sent (see _on_push_sent()). Returns True if the queue
+            has a subscriber, else False.
+        """
+        handler = self._subscribers.get(queue_name)
+        if not handler:
+            return False
+        if not handler.connected:
+            del self._subscribers[queue_name]
+            return False
+        if handler.draining():
+            return True  # Pushes again once drained
+
+        queue = self.outgoing_queues.get(queue_name)
+        msgs = []
+        while queue and len(msgs) < FETCH_BATCH_SIZE:
+            try:
+                msgs.append(queue.get_nowait(ack=False))
+            except Queue.Empty:
+                break
+
+        if msgs:
+            handler.send_frame(''.join([to_wire(m.raw_msg) for m in msgs]))
+            self._pushed[handler] = (queue, msgs)
+            broker_log.info('Subscriber for %s pushed %d msg(s).',
+                            queue_name, len(msgs))
+        return True
+
+    def _on_push_sent(self, handler, queue_name):
+        """ Acks the msgs last pushed to the given subscriber, now that all
+            have been sent, then pushes the next batch.
+        """
+        queue, msgs = self._pushed.pop(handler, (None, None))
+        if msgs:
+            queue.ack(msgs)
+        self._push(queue_name)
+
+    def _on_push_failed(self, handler):
+        """ Restores the msgs pushed to the given subscriber, but not sent, to
+            their queue, as its connection closed.
+        """
+        queue, msgs = self._pushed.pop(handler, (None, None))
+        if msgs:
+            queue.restore(msgs)
+            broker_log.info('Restored %d msg(s) unsent to a subscriber.',
+                            len(msgs))
+
+    def _wake_waiting(self, queue_name):
+        """ Serves the long-poll fetches waiting on the given queue, oldest
+            first, while it has msgs.
+        """
+        waiting = self._waiting.pop(queue_name, [])
+        while waiting:
+            _, handler, request = waiting[0]
+            if handler.connected:
+                resp, queue, msgs = serve_fetch(self.outgoing_queues, request)
+                if not msgs:
+                    break
+                self._send_fetched(handler, resp, queue, msgs)
+                broker_log.info('Fetch request for %s gave: '
+                                '%d msg(s) served.', queue_name, len(msgs))
+            waiting.pop(0)
+
+        if waiting:
+            self._waiting[queue_name] = waiting
+
+    def _on_send(self, handler, data):
+        """ Handles a send request, responding with OK, REJECTED, or FAIL.
+        """
+        handler.send_frame(self._serve_send(data))
+
+    def _serve_send(self, data):
+        """ Serves a send request, returning OK, REJECTED (followed by the
+            indexes of the msgs rejected), or FAIL (see send_response()).
+        """
+        try:
+            msgs, rejected = serve_send(self.outgoing_queues, data)
+        except Exception as e:
+            broker_log.error('Msg recv failed due to %s', e)
+            return 'FAIL'
+
+        for msg in msgs:
+            broker_log.info('Msg served: %s to %s',
+                            msg.sender_addr, msg.dest_addr)
+        if rejected:
+            broker_log.error('%d msg(s) rejected - queue full.', len(rejected))
+
+        for queue_name in set([msg.dest_addr for msg in msgs]):
+            if self._push(queue_name):
+                continue
+            if queue_name in self._waiting:
+                self._wake_waiting(queue_name)
+        return send_response(rejected)
+
+    def _on_fetch(self, handler, data):
+        """ Handles a fetch request, responding with either the next msg(s) in
+            the requested queue or EMPTY. Never blocks - A long-poll fetch of
+            an empty queue waits in self._waiting instead.
+        """
+        count_metric(self.outgoing_queues, 'fetch_requests')
+        try:
+            queue_name, _, wait = parse_fetch(data)
+            resp, queue, msgs = serve_fetch(self.outgoing_queues, data)
+        except Exception as e:
+            broker_log.error('Fetch request for %s gave: %s',
+                             data.split('\x00')[0], e)
+            handler.send_frame('EMPTY')
+            return
+
+        if not msgs and wait > 0:
+            waiting = self._waiting.setdefault(queue_name, [])
+            waiting.append((time() + wait, handler, data))
+            return
+
+        self._send_fetched(handler, resp, queue, msgs)
+        if msgs:
+            broker_log.info('Fetch request for %s gave: %d msg(s) served.',
+                            queue_name, len(msgs))
+        else:
+            broker_log.info('Fetch request for %s gave: Queue empty.',
+                            queue_name)
+
+    def _send_fetched(self, handler, resp, queue, msgs):
+        """ Sends the given fetch response, of the given msgs from the given
+            queue. The msgs are acked once sent (see _on_fetch_sent()), or
+            restored to their queue if the connection closes first.
+        """
+        handler.send_frame(resp)
+        if not msgs:
+            return
+
+        # Hooked once per connection, however many fetches it makes
+        if handler not in self._fetched:
+            handler.on_drain = self._on_fetch_sent
+            on_close = handler.on_close
+            def closed():
+                self._on_fetch_failed(handler)
+                if on_close:
+                    on_close()
+            handler.on_close = closed
+        self._fetched.setdefault(handler, []).append((queue, msgs))
+
+    def _on_fetch_sent(self, handler):
+        """ Acks the msgs fetched over the given connection, now that all
+            have been sent.
+        """
+        for queue, msgs in self._fetched[handler]:
+            queue.ack(msgs)
+        self._fetched[handler] = []
+
+    def _on_fetch_failed(self, handler):
+        """ Restores the msgs fetched over the given connection, but not sent,
+            to their queues, as the connection closed.
+        """
+        fetched = self._fetched.pop(handler, [])
+        for queue, msgs in reversed(fetched):
+            queue.restore(msgs)
+        if fetched:
+            broker_log.info('Restored %d msg(s) unsent to a fetcher.',
+                            sum([len(msgs) for _, msgs in fetched]))
+
+    def _on_subscribe(self, handler, data):
+        """ Handles a subscribe request, pushing all msgs already in the
+            requested queue, and any that arrive later, over the handler's
+            connection. A queue has at most one subscriber - the newest. Any
+            older one is disconnected.
+        """
+        count_metric(self.outgoing_queues, 'subscribe_requests')
+        replaced = self._subscribers.get(data)
+        if replaced and replaced is not handler:
+            replaced.close()  # Restoring its msgs pushed but not sent
+            broker_log.info('Subscriber replaced for %s', data)
+        self._subscribers[data] = handler
+        handler.on_drain = lambda h: self._on_push_sent(h, data)
+
+        on_close = handler.on_close
+        def closed():
+            self._on_push_failed(handler)
+            if on_close:
+                on_close()
+        handler.on_close = closed
+
+        broker_log.info('Subscriber added for %s', data)
+        self._push(data)
+
+    def _route_send(self, handler, data):
+        """ Handles a send request at a public listener. Msgs for queues this
+            shard owns are served here, the rest forwarded to their owners,
+            and the client responded to once all have responded - With OK if
+            all did, else REJECTED with the indexes, in the client's request,
+            of each msg an owner rejected or failed. Msgs are routed by their
+            destination alone - Each is validated only by its owner.
+        """
+        by_owner = {}  # { SHARD: [WIRE_MSG, ... ] }
+        indexes = {}   # { SHARD: [INDEX_IN_REQUEST, ... ] }
+        try:
+            for i, raw_msg in enumerate(split_raw_msgs(data)):
+                dest_addr = Message._unpack_dest_addr(raw_msg)
+                owner = shard_of(dest_addr, len(self._shard_socks))
+                by_owner.setdefault(owner, []).append(to_wire(raw_msg))
+                indexes.setdefault(owner, []).append(i)
+        except Exception as e:
+            broker_log.error('Msg recv failed due to ' + str(e))
+            handler.send_frame('FAIL')
+            return
+
+        if not by_owner or by_owner.keys() == [self.shard]:
+            self._on_send(handler, data)
+            return
+
+        handler.send_indexes = indexes
+        handler.send_rejected = []
+        for owner, wire_msgs in by_owner.iteritems():
+            part = ''.join(wire_msgs)
+            if owner == self.shard:
+                self._on_send_result(handler, self._serve_send(part), owner)
+            else:
+                self._forward(handler, owner, 0, part, self._on_send_result)
+
+    def _on_send_result(self, handler, resp, owner):
+        """ Collects the given owner shard's response to a routed send request,
+            responding to the client once all shards have.
+        """
+        indexes = handler.send_indexes.pop(owner)
+        if resp == 'FAIL':
+            handler.send_rejected.extend(indexes)
+        elif resp.startswith('REJECTED'):
+            handler.send_rejected.extend(
+                [indexes[int(i)] for i in resp.split('\x00')[1:]])
+
+        if not handler.send_indexes:
+            handler.send_frame(send_response(sorted(handler.send_rejected)))
+
+    def _route_fetch(self, handler, data):
+        """ Handles a fetch request at a public listener, serving it here if
+            this shard owns the queue, else forwarding it to the owner.
+        """
+        owner = shard_of(data.split('\x00')[0], len(self._shard_socks))
+        if owner == self.shard:
+            self._on_fetch(handler, data)
+        else:
+            self._forward(handler, owner, 1, data, self._relay)
+
+    def _route_subscribe(self, handler, data):
+        """ Handles a subscribe request at a public listener, serving it here
+            if this shard owns the queue, else forwarding it to the owner.
+        """
+        owner = shard_of(data, len(self._shard_socks))
+        if owner == self.shard:
+            self._on_subscribe(handler, data)
+        else:
+            self._forward(handler, owner, 2, data, self._relay)
+
+    def _relay(self, handler, data, owner):
+        """ Relays the given frame, from the given owner shard, to the client.
+        """
+        handler.send_frame(data)
+
+    def _forward(self, handler, owner, listener, data, on_resp):
+        """ Forwards the given request frame, from the given client connection,
+            to the given owner shard's listener (an index into its internal 
+            listeners), reusing the client's connection to it, if any, else
+            connecting without blocking - The frame is sent once connected.
+            Each response frame is passed to on_resp(handler, data, owner).
+            Either connection closing closes the other.
+        """
+        upstream = handler.upstreams.get((owner, listener))
+        if not upstream:
+            upstream = FramedHandler(None,
+                                     lambda up, resp: on_resp(handler, resp,
+                                                              owner),
+                                     self._sock_map)
+            try:
+                addr = self._shard_socks[owner][listener].getsockname()
+                upstream.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+                upstream.connect(addr)
+            except Exception as e:
+                broker_log.error('Could not forward to shard: ' + str(e))
+                upstream.close()
+                handler.close()
+                return
+
+            upstream.on_close = handler.close
+            handler.upstreams[(owner, listener)] = upstream
+
+        upstream.send_frame(data)
 
 
 class MsgBroker(Process):
@@ -453,19 +2460,118 @@ class MsgBroker(Process):
     Msgs are received by the broker via TCP/IP and enqued for receipt.
     Recipients request msgs from broker via TCP/IP by address (i.e queue name).
     After a fetch, the msg is removed from the queue.
+    Recipients may instead subscribe to their address, to have msgs pushed.
+    If write_ahead_log is set, queued msgs are logged to wal_dir, and restored
+    from there on start.
+    Runs as either a Receiver, MsgServer, and SubscriptionServer thread, or an
+    AsyncBroker, depending on the broker_mode configured. In async mode, may
+    run as broker_shards AsyncBroker processes, each owning a partition of
+    the queues, and any of which may accept any client's request.
+    Either way, each broker process also serves its metrics via StatsServer.
     """
-    def __init__(self): 
+    def __init__(self, ports=None):
+        """ ports: If given, a (send, fetch, subscribe, stats) port tuple to
+                   listen on instead of those configured.
+        """
         Process.__init__(self)
-        self.outgoing_queues = {}  # Outbound msg queues: { ADDRESS: Queue }
+        self.outgoing_queues = QueueMap()  # { ADDRESS: BrokerQueue }
+        self.ports = ports
+
+    @flushes_logs
+    def run(self):
+        if self.ports:
+            set_broker_ports(*self.ports)
+
+        if FRAMED and BROKER_SHARDS > 1:
+            self._run_shards()  # Blocks
+            return
+
+        # Each broker has its own log, by its send port
+        self._restore(self._log_dir())
+        StatsServer(self.outgoing_queues, STATS_PORT).start()
+
+        if FRAMED:
+            broker_log.info('BOS Started (async mode).')
+            AsyncBroker(self.outgoing_queues).run()  # Blocks
+            return
 
-    def run(self):        
         Receiver(self.outgoing_queues).start()
         MsgServer(self.outgoing_queues).start()
+        SubscriptionServer(self.outgoing_queues).start()
         broker_log.info('BOS Started.')
 
-        # Stay alive (there is likely a better way to do this)
+        # Stay alive, sweeping for expired msgs and updating metrics
         while True:
-            sleep(10)
+            sleep(REFRESH_TIME)
+            expire_msgs(self.outgoing_queues)
+            self.outgoing_queues.metrics.tick(self.outgoing_queues)
+
+    def _restore(self, log_dir):
+        """ If write_ahead_log is set, restores msgs logged in the given dir
+            of wal_dir, and logs all msgs there from now on.
+        """
+        if not WRITE_AHEAD_LOG:
+            return
+
+        self.outgoing_queues.msg_log = MsgLog(log_dir)
+        count = self.outgoing_queues.msg_log.replay(self.outgoing_queues)
+        broker_log.info('Restored ' + str(count) + ' logged msg(s).')
+
+    def discard_log(self):
+        """ Deletes the broker's msg log, and so its logged msgs, if any.
+            Call only while the broker is stopped.
+        """
+        shutil.rmtree(self._log_dir(), ignore_errors=True)
+
+    def _log_dir(self):
+        """ Returns the broker's dir of wal_dir, by its send port.
+        """
+        send_port = self.ports[0] if self.ports else SEND_PORT
+        return os.path.join(WAL_DIR, str(send_port))
+
+    def _run_shards(self):
+        """ Runs the broker as BROKER_SHARDS AsyncBroker processes - this one
+            and its children. Blocks.
+        """
+        # Each shard's internal (send, fetch, subscribe) listeners, bound now
+        # so every shard knows every other's ports.
+        shard_socks = []
+        for _ in range(BROKER_SHARDS):
+            socks = []
+            for _ in range(3):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.bind((BROKER, 0))  # Any free port
+                sock.listen(LISTEN_BACKLOG)
+                socks.append(sock)
+            shard_socks.append(socks)
+
+        for shard in range(1, BROKER_SHARDS):
+            shard_proc = Process(target=self._run_shard,
+                                 args=(shard, shard_socks, os.getpid()))
+            shard_proc.daemon = True
+            shard_proc.start()
+
+        broker_log.info('BOS Started (async mode, ' + 
+                        str(BROKER_SHARDS) + ' shards).')
+        self._run_shard(0, shard_socks)
+
+    @flushes_logs
+    def _run_shard(self, shard, shard_socks, parent_pid=None):
+        """ Runs the given shard's AsyncBroker. Blocks.
+        """
+        self._restore(os.path.join(self._log_dir(), str(shard)))
+        StatsServer(self.outgoing_queues, STATS_PORT + shard).start()
+        AsyncBroker(self.outgoing_queues,
+                    shard,
+                    shard_socks,
+                    parent_pid).run()
+
+
+def shard_of(addr, num_shards):
+    """ Returns the index of the broker shard owning the given EMP address'
+        queue, among the given num of shards.
+    """
+    return (crc32(addr) & 0xFFFFFFFF) % num_shards
 
 
 # debug:
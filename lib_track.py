@@ -4,28 +4,54 @@
     Author: Dustin Fast, 2018
 """
 
+import os
+import sys
+import mmap
 import Queue
+import tempfile
 import multiprocessing
-from time import sleep
+from array import array
+from bisect import bisect_left, bisect_right
+from struct import pack, unpack_from, calcsize
+from collections import namedtuple
+from time import sleep, time
 from json import loads
-from threading import Thread
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Condition
 from datetime import datetime
 from ConfigParser import RawConfigParser
 from math import degrees, radians, sin, cos, atan2
 
-from lib_app import track_log
+from lib_app import track_log, flushes_logs
 from lib_app import REFRESH_TIME
-from lib_messaging import Connection, get_6000_msg
+from lib_messaging import Connection, get_6000_msg, set_broker_ports
 from lib_messaging import MSG_INTERVAL, LOCO_EMP_PREFIX
 
+# Attempt to import optional 3rd party modules, falling back on fail.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Import conf data
 config = RawConfigParser()
 config.read('app_config.dat')
 TRACK_RAILS = config.get('track', 'track_rails')
 TRACK_LOCOS = config.get('track', 'track_locos')
 TRACK_BASES = config.get('track', 'track_bases')
+TRACK_MODEL = config.get('track', 'track_model')
 SPEED_UNITS = config.get('track', 'speed_units')
 CONN_TIMEOUT = int(config.get('track', 'component_timeout'))
+MOVEMENT_ENGINE = config.get('track', 'movement_engine')
+SIM_WORKERS = int(config.get('track', 'sim_workers'))
+
+# Compiled track model file format. See TrackModel.
+MODEL_MAGIC = 'PTCTRK01'
+MODEL_HEADER = '<8s5I4x'  # Magic, num mps, bases, coverage sets, set items,
+                          # and base ID bytes. Pads to 8 byte alignment.
+MODEL_TYPES = {'d': ('<f8', 8),  # Typecode: (NumPy dtype, item size)
+               'I': ('<u4', 4)}
 
 
 ############################
@@ -33,35 +59,155 @@ CONN_TIMEOUT = int(config.get('track', 'component_timeout'))
 ############################
 
 class DeviceSim(object):
-    """ A collection of threads representing a device simulation. Exposes start
-        and stop interfaces.
-        Assumes each thread implements self.running (a bool) as a poison pill.
+    """ A collection of targets representing a device simulation. Each target
+        is a function accepting the device and performing one simulation step.
+        Targets are run every MSG_INTERVAL, either each in its own thread or as
+        tasks on a shared SimScheduler. Exposes start and stop interfaces.
+        Each start is a new generation of the sim. Threads and tasks of older
+        generations exit, so a sim restarted before they notice its stop
+        doesn't run its targets twice.
     """
     def __init__(self, device, targets=[]):
         self.running = False  # Thread kill signal
-        self._thread_targets = targets
+        self.generation = 0   # (int) Incremented on each start
+        self._targets = targets
         self._threads = []
         self.device = device
         self.label = device.name
         self.time_iplier = 1  # (float) Time speed up/slow down
         
+    def start(self, scheduler=None):
+        """ Starts the simulation. If a scheduler (a SimScheduler) is given,
+            the targets run as tasks on its worker pool, else each target gets
+            its own thread.
+        """
+        if not self.running:
+            self.running = True
+            self.generation += 1
+            if scheduler:
+                [scheduler.add(self, t) for t in self._targets]
+            else:
+                self._threads = [Thread(target=self._run_target,
+                                        args=[t, self.generation])
+                                 for t in self._targets]
+                [t.start() for t in self._threads]
+
+    def stop(self):
+        """ Stops the simulation threads (or scheduled tasks).
+        """
+        if self.running:
+            print('* Stopped sim thread ' + self.label)
+            self.running = False  # Thread poison pill
+            [t.join(timeout=REFRESH_TIME) for t in self._threads]
+
+    def _run_target(self, target, generation):
+        """ Runs the given target every MSG_INTERVAL until the sim is stopped
+            or restarted (i.e. is no longer of the given generation).
+            Intended to be run as a Thread.
+        """
+        while self.running:
+            sleep(MSG_INTERVAL)  # Sleep for specified interval
+            if not self.running or self.generation != generation:
+                break
+            target(self.device)
+
+
+class SimScheduler(object):
+    """ Runs device simulation targets as scheduled tasks on a fixed-size pool
+        of worker threads, rather than a thread per target. Tasks wait in a
+        heap, by due time, and a dispatcher thread hands each to the workers
+        when it comes due. A task is rescheduled one interval after its last
+        due time, once it finishes, so it never runs concurrently with itself.
+    """
+    def __init__(self, num_workers, interval=MSG_INTERVAL):
+        """ self.interval : (float) Seconds between runs of each task
+            self._tasks   : (list) A heap of tasks, each of the sim generation
+                            it was added in - [ (DUE, SEQ, SIM, GEN, TARGET) ]
+            self._ready   : (Queue) Tasks due to be run by the workers
+        """
+        self.running = False
+        self.interval = interval
+        self._tasks = []
+        self._seq = count()  # Heap tie-breaker
+        self._tasks_cond = Condition()
+        self._ready = Queue.Queue()
+        self._threads = [Thread(target=self._worker) for _ in range(num_workers)]
+        self._threads.append(Thread(target=self._dispatcher))
+        for t in self._threads:
+            t.daemon = True
+
     def start(self):
-        """ Starts the simulation threads. 
+        """ Starts the dispatcher and worker threads.
         """
         if not self.running:
             self.running = True
-            self._threads = [Thread(target=t, args=[self.device]) 
-                             for t in self._thread_targets]
             [t.start() for t in self._threads]
 
     def stop(self):
-        """ Stops the simulation threads.
+        """ Stops the dispatcher and worker threads.
         """
         if self.running:
-            print('* Stopped sim thread ' + self.label)
             self.running = False  # Thread poison pill
+            with self._tasks_cond:
+                self._tasks_cond.notify()
+            [self._ready.put(None) for _ in self._threads]
             [t.join(timeout=REFRESH_TIME) for t in self._threads]
 
+    def add(self, sim, target):
+        """ Schedules target(sim.device) to run every interval while the given
+            DeviceSim is running, starting one interval from now. The task is
+            dropped once the sim stops or is restarted.
+        """
+        self._schedule(time() + self.interval, sim, sim.generation, target)
+
+    def _schedule(self, due, sim, generation, target):
+        """ Pushes the given task onto the heap, waking the dispatcher.
+        """
+        with self._tasks_cond:
+            heappush(self._tasks,
+                     (due, next(self._seq), sim, generation, target))
+            self._tasks_cond.notify()
+
+    def _dispatcher(self):
+        """ Moves each task to the ready queue when it comes due. Intended to
+            be run as a Thread.
+        """
+        while self.running:
+            with self._tasks_cond:
+                if not self._tasks:
+                    self._tasks_cond.wait(REFRESH_TIME)
+                    continue
+                wait = self._tasks[0][0] - time()
+                if wait > 0:
+                    self._tasks_cond.wait(wait)
+                    continue
+                task = heappop(self._tasks)
+            self._ready.put(task)
+
+    def _worker(self):
+        """ Runs ready tasks, rescheduling each while its sim is running.
+            Intended to be run as a Thread.
+        """
+        while self.running:
+            task = self._ready.get()
+            if not task:
+                continue
+
+            due, _, sim, generation, target = task
+            if not sim.running or sim.generation != generation:
+                continue  # Sim was stopped or restarted - drop its task
+
+            try:
+                target(sim.device)
+            except Exception as e:
+                err_str = ' sim task stopped due to ' + str(e)
+                track_log.error(sim.label + err_str)
+                continue
+
+            # Next run is one interval after this one was due, or now if late
+            self._schedule(max(due + self.interval, time()), sim, generation,
+                           target)
+
 
 class TrackDevice(object):
     """ The template class for on-track, communication-enabled devices. I.e., 
@@ -74,6 +220,7 @@ class TrackDevice(object):
             self.coords   : (Location) The devices location, as a Location
             self.conns      : (dict) Connection objects - { ID: Connection }
             self.sim        : The device's simulation. Start w/self.sim.start()
+            self.version    : (int) Incremented on each state change
         """
         self.ID = ID
         self.devtype = device_type
@@ -81,6 +228,7 @@ class TrackDevice(object):
         self.coords = location
         self.conns = {}
         self.sim = None
+        self.version = 0
 
     def __str__(self):
         """ Returns a string representation of the device """
@@ -100,8 +248,16 @@ class TrackDevice(object):
     def disconnect(self):
         """ Sets all the devices connections to an unconnected status.
         """
+        if self.connected():
+            self.changed()
         [c.disconnect() for c in self.conns.values()]
 
+    def changed(self):
+        """ Marks the device's state as changed, so views of it cached by 
+            version (ex: lib_web.WebCache) are rebuilt.
+        """
+        self.version += 1
+
 
 #################
 # Child Classes #
@@ -120,6 +276,8 @@ class Loco(TrackDevice):
             self.coords   : (Location) Current location, as a Location
             self.bpp        : (float) Brake pipe pressure. Affects braking.
             self.bases_inrange: (list) Base objects within communication range
+            self.makeup_dist: (float) Dist traveled, but not yet reflected by
+                              self.coords. Carried over to the next move.
         """
         TrackDevice.__init__(self, str(ID), 'Loco')
         self.emp_addr = LOCO_EMP_PREFIX + self.ID
@@ -132,6 +290,7 @@ class Loco(TrackDevice):
         self.bpp = None
         self.bases_inrange = []
         self.bases = []
+        self.makeup_dist = 0
 
         self.conns = {'Radio 1': Connection('Radio 1', timeout=CONN_TIMEOUT),
                       'Radio 2': Connection('Radio 2', timeout=CONN_TIMEOUT)}
@@ -155,26 +314,36 @@ class Loco(TrackDevice):
             bases: A dict denoting current base connections. Is of the 
                    format: { ConnectionLabel: base_ID }
         """
-        if speed is not None:
-            self.speed = speed
-        if heading is not None:
-            self.heading = heading
-        if direction is not None:
-            self.direction = direction
-        if location is not None:
-            self.coords = location
-        if bpp is not None:
-            self.bpp = bpp
-        if bases is not None:
-            if not bases:
-                [c.disconnect for c in self.conns]
-                return
-            try:
-                for conn_label, base_id in bases.iteritems():
-                    self.conns[conn_label].connect(self.track.bases[base_id])
-            except KeyError:
-                err_str = ' - Invalid connection or base ID in bases param.'
-                raise ValueError(self.name + err_str)
+        try:
+            if speed is not None:
+                self.speed = speed
+            if heading is not None:
+                self.heading = heading
+            if direction is not None:
+                self.direction = direction
+            if location is not None:
+                self.coords = location
+            if bpp is not None:
+                self.bpp = bpp
+            if bases is not None:
+                if not bases:
+                    [c.disconnect for c in self.conns]
+                    return
+                try:
+                    for conn_label, base_id in bases.iteritems():
+                        base = self.track.bases[base_id]
+                        self.conns[conn_label].connect(base)
+                except KeyError:
+                    err_str = ' - Invalid connection or base ID in bases param.'
+                    raise ValueError(self.name + err_str)
+        finally:
+            self.changed()  # After the changes, so none go unseen
+
+    def changed(self):
+        """ Marks the loco's, and so its track's, state as changed.
+        """
+        TrackDevice.changed(self)
+        self.track.version += 1
 
 
 class Base(TrackDevice):
@@ -253,91 +422,57 @@ class Track(object):
             Format: { LOCOID: LOCO_OBJECT }
         self.bases = A dict of radio base stations, by base ID
             Format: { BASEID: BASE_OBJECT }
-        self.mileposts = A dict of all track mileposts, by marker number
-            Format: { MP: LOCATIONOBJECT }
-        self.mileposts_sorted = A list of all track mileposts, sorted by marker
-            Format: [ LOCATIONOBJECT_1, ... , LOCATIONOBJECT_N ]
+        self.layout = The track's static TrackLayout, shared. Its members:
+        self.model = The TrackModel of the track's mileposts and bases
+        self.mileposts_sorted = All track mileposts, sorted by marker
+            Format: Mileposts [ LOCATIONOBJECT_1, ... , LOCATIONOBJECT_N ]
         self.marker_linear = Numerical milepost markers in ascending order
             Format: [ MP_1, ... , MP_n ], where MP1 < MPn
         self.marker_linear_rev = Numerical milepost markers in descending order
             Format: [ MP_n, ... , MP_1], where MP1 < MPn
+        self.coverage = A CoverageIndex of the bases' coverage areas
+        self.version = Incremented on each state change of its locos
         Note: BASEID/LOCOD = strings, MP = floats
+        Note: The layout's members are shared, and so must not be modified.
     """
 
     def __init__(self,
                  track_file=TRACK_RAILS,
                  locos_file=TRACK_LOCOS,
-                 bases_file=TRACK_BASES):
+                 bases_file=TRACK_BASES,
+                 model_file=TRACK_MODEL):
         """ track_file: Track JSON representation
             locos_file: Locos JSON representation
             bases_file: Base stations JSON representation
+            model_file: Compiled track model of track_file and bases_file,
+                        or None to always parse them. See load_track_model().
         """
         # On-Track device properties
         self.locos = {}
         self.bases = {}
         self.last_seen = {}     # Last msg recv time, by device:
                                 # { DeviceType: { ID: DateTime } }
-
-        # Track properties
-        self.mileposts = {}
-        self.mileposts_sorted = []
-        self.marker_linear = []
-        self.marker_linear_rev = []
+        self.version = 0
+
+        # Track properties, shared with all other Tracks of the same files
+        self.layout = get_track_layout(track_file, bases_file, model_file)
+        self.model = self.layout.model
+        self.mileposts_sorted = self.layout.mileposts
+        self.marker_linear = self.layout.marker_linear
+        self.marker_linear_rev = self.layout.marker_linear_rev
+        self.coverage = None
         # self.restrictions = {}  # { AUTH_ID: ( START_MILEPOST, END_MILEPOST }
 
-        # Populate bases station (self.bases) from base_file
-        try:
-            with open(bases_file) as base_data:
-                bases = loads(base_data.read())
-        except Exception as e:
-            raise Exception('Error reading ' + bases_file + ': ' + str(e))
-
-        for base in bases:
-            try:
-                base_id = str(base['id'])
-                coverage_start = float(base['coverage'][0])
-                coverage_end = float(base['coverage'][1])
-                mp = base_id  # base ids denote location
-                lat = float(base['lat'])
-                lng = float(base['long'])
-            except ValueError:
-                raise ValueError('Conversion error in ' + bases_file + '.')
-            except KeyError:
-                raise Exception('Malformed ' + bases_file + ': Key Error.')
-
-            self.bases[base_id] = Base(base_id, 
-                                       coverage_start,
-                                       coverage_end,
-                                       Location(mp, lat, lng))
+        # Populate bases station (self.bases) from the model, in model order
+        bases = []
+        for b in self.model.bases:
+            location = Location(b.ID, b.lat, b.long)
+            base = Base(b.ID, b.cov_start, b.cov_end, location)
+            self.bases[b.ID] = base
+            bases.append(base)
 
-        # Populate milepost objects (self.mileposts) from track_file
-        try:
-            with open(track_file) as rail_data:
-                locations = loads(rail_data.read())
-        except Exception as e:
-            raise Exception('Error reading ' + track_file + ': ' + str(e))
-
-        for marker in locations:
-            try:
-                mp = float(marker['milemarker'])
-                lat = float(marker['lat'])
-                lng = float(marker['long'])
-            except ValueError:
-                raise ValueError('Conversion error in ' + track_file + '.')
-            except KeyError:
-                raise Exception('Malformed ' + track_file + ': Key Error.')
-
-            self.mileposts[mp] = Location(mp, lat, lng)
-            coverage = [b for b in self.bases.values() 
-                        if b.covers_location(self.mileposts[mp])]
-            self.mileposts[mp].covered_by = coverage
-
-        # Build the other milepost lists/dicts from self.mileposts
-        self.marker_linear = [m for m in sorted(self.mileposts.keys())]
-        self.marker_linear_rev = self.marker_linear[::-1]
-        sorted_objs = [m for m in 
-                       sorted(self.mileposts.values(), key=lambda x: x.marker)]
-        self.mileposts_sorted = sorted_objs
+        # Index base coverage once, for fast by-marker coverage lookups
+        self.coverage = CoverageIndex(bases)
 
         # Populate Locomotive objects (self.locos) from locos_file
         try:
@@ -349,10 +484,8 @@ class Track(object):
         for loco in locos:
             try:
                 mp = loco['lastmilepost']
-                try:
-                    loco_location = self.mileposts[mp]
-                except KeyError:
-                    print(self.mileposts[0])
+                loco_location = self.get_location_at(mp)
+                if not loco_location:
                     raise Exception('Invalid milepost encountered: ' + str(mp))
 
                 loco_id = str(loco['id'])  # Ensure string ID
@@ -387,30 +520,32 @@ class Track(object):
         mp = curr_mp.marker
         target_mp = mp + distance
         dist_diff = 0
-        next_mp = None
+        next_idx = None
+        mps = self.marker_linear
+        num_mps = len(mps)
 
-        # Set the location object list to iterate, depending on direction
+        # Bisect from the current mp's index toward the direction of travel,
+        # noting any unconsumed distance for next time
+        curr_idx = bisect_left(mps, mp)
         if distance > 0:
-            mps = self.marker_linear
-        elif distance < 0:
-            mps = self.marker_linear_rev
-
-        # Find next mp marker, noting any unconsumed distance for next time
-        for i, marker in enumerate(mps):
-            if marker == target_mp:
-                next_mp = marker
-                dist_diff = 0
-                break
-            elif (distance > 0 and marker > target_mp) or \
-                 (distance < 0 and marker < target_mp):
-                next_mp = mp
-                if i > 0:
-                    next_mp = mps[i - 1]
-                dist_diff = abs(target_mp - next_mp)
-                break
-
-        # Get mp object associated with next_mp
-        next_mp_obj = self.get_location_at(next_mp)
+            i = bisect_left(mps, target_mp, lo=curr_idx)
+            if i < num_mps and mps[i] == target_mp:
+                next_idx = i
+            elif i < num_mps:
+                next_idx = i - 1 if i > 0 else curr_idx
+                dist_diff = abs(target_mp - mps[next_idx])
+        else:
+            i = bisect_right(mps, target_mp, hi=min(curr_idx + 1, num_mps))
+            if i > 0 and mps[i - 1] == target_mp:
+                next_idx = i - 1
+            elif i > 0:
+                next_idx = i if i < num_mps else curr_idx
+                dist_diff = abs(target_mp - mps[next_idx])
+
+        # Get mp object at next_idx
+        next_mp_obj = None
+        if next_idx is not None:
+            next_mp_obj = self.mileposts_sorted[next_idx]
 
         # debug
         # if not next_mp_obj:
@@ -429,7 +564,7 @@ class Track(object):
     def get_location_at(self, mile):
         """ Returns the Location at the given track mile (a float) iff exists.
         """
-        return self.mileposts.get(mile, None)
+        return self.mileposts_sorted.get(mile)
 
     def set_lastseen(self, device):
         """ Given a TrackDevice, updates the Track.last_seen with the current
@@ -438,6 +573,7 @@ class Track(object):
         if not self.last_seen.get(device.devtype):
             self.last_seen[device.devtype] = {}
         self.last_seen[device.devtype][device.ID] = datetime.now()
+        device.changed()
 
     def get_lastseen(self, device):
         """ Returns last comms time (datetime) for the given device iff exists.
@@ -448,6 +584,42 @@ class Track(object):
             pass
 
 
+class CoverageIndex(object):
+    """ An interval index of base station coverage areas, built once from the
+        bases' cov_start/cov_end ranges. Coverage ranges are inclusive.
+        The distinct range endpoints split the track into elementary segments,
+        each of which is covered by a fixed set of bases, so a lookup is a
+        single bisect.
+    """
+    def __init__(self, bases):
+        """ self._bounds  : (list) Sorted, distinct coverage range endpoints
+            self._at_bound: (list) Bases covering each endpoint, by index
+            self._between : (list) Bases covering the open segment before each
+                            endpoint, by index. Last item is past all bounds.
+            Note: Bases keep the order given, in each list.
+        """
+        bases = list(bases)
+        bounds = set([b.cov_start for b in bases] + [b.cov_end for b in bases])
+        self._bounds = sorted(bounds)
+        self._at_bound = [[b for b in bases if b.cov_start <= p <= b.cov_end]
+                          for p in self._bounds]
+
+        self._between = [[]]  # Nothing is covered before the first endpoint
+        for lo, hi in zip(self._bounds, self._bounds[1:]):
+            self._between.append([b for b in bases
+                                  if b.cov_start <= lo and hi <= b.cov_end])
+        self._between.append([])  # Nor past the last endpoint
+
+    def bases_at(self, marker):
+        """ Returns a list of the bases covering the given track marker (a
+            float). The list is shared, so callers must not modify it.
+        """
+        i = bisect_left(self._bounds, marker)
+        if i < len(self._bounds) and self._bounds[i] == marker:
+            return self._at_bound[i]
+        return self._between[i]
+
+
 class Location:
     """ An abstraction of a location.
     """
@@ -455,7 +627,8 @@ class Location:
         """ self.marker = (float) The numeric location marker
             self.lat = (float) Latitude of location
             self.long = (float) Longitude of location
-            self.covered_by = (list) Bases covering this location
+            self.covered_by = (list) Bases, or BaseRecords, covering this
+                              location
         """
         self.marker = marker
         self.lat = latitude
@@ -470,36 +643,529 @@ class Location:
         return coord_str
 
 
+# A base station's record in a TrackModel
+BaseRecord = namedtuple('BaseRecord', 'ID cov_start cov_end lat long')
+
+
+class TrackModel(object):
+    """ The static data of a track - its mileposts and base stations - as
+        columnar arrays. Built by parsing the track's JSON files, or loaded
+        from a compiled model file (see load_track_model()), in which case
+        its arrays are read-only views of the mmap'd file, so processes
+        loading the same file share its pages.
+
+        Arrays are NumPy arrays if loaded with NumPy, else array.arrays.
+        Model file format, little-endian, with each array 8 byte aligned:
+            Header       : MODEL_HEADER
+            Mileposts    : markers, lats, longs (float64 arrays, by marker)
+            Bases        : cov_starts, cov_ends, lats, longs (float64 arrays)
+            Coverage     : Each milepost's coverage set index, the sets'
+                           offsets into set items, and the set items, each
+                           a base index (uint32 arrays)
+            Base IDs     : NULL-delimited string
+    """
+    def __init__(self, bases, markers, lats, longs, cov_idx, cov_sets):
+        """ self.bases   : (list) BaseRecords, by base index
+            self.markers : (array) Milepost markers, ascending
+            self.lats    : (array) Milepost latitudes, by milepost index
+            self.longs   : (array) Milepost longitudes, by milepost index
+            self.cov_idx : (array) Coverage set index, by milepost index
+            self.cov_sets: (list) Coverage sets, each a list of the indexes
+                           of the bases covering a milepost
+        """
+        self.bases = bases
+        self.markers = markers
+        self.lats = lats
+        self.longs = longs
+        self.cov_idx = cov_idx
+        self.cov_sets = cov_sets
+
+    @classmethod
+    def from_json(cls, track_file, bases_file):
+        """ Returns the TrackModel of the given track and bases JSON files.
+        """
+        # Populate bases from bases_file
+        try:
+            with open(bases_file) as base_data:
+                base_list = loads(base_data.read())
+        except Exception as e:
+            raise Exception('Error reading ' + bases_file + ': ' + str(e))
+
+        bases = []
+        for base in base_list:
+            try:
+                bases.append(BaseRecord(str(base['id']),
+                                        float(base['coverage'][0]),
+                                        float(base['coverage'][1]),
+                                        float(base['lat']),
+                                        float(base['long'])))
+            except ValueError:
+                raise ValueError('Conversion error in ' + bases_file + '.')
+            except KeyError:
+                raise Exception('Malformed ' + bases_file + ': Key Error.')
+
+        # Populate mileposts from track_file. Of duplicate markers, last wins.
+        try:
+            with open(track_file) as rail_data:
+                locations = loads(rail_data.read())
+        except Exception as e:
+            raise Exception('Error reading ' + track_file + ': ' + str(e))
+
+        mileposts = {}
+        for marker in locations:
+            try:
+                mileposts[float(marker['milemarker'])] = (float(marker['lat']),
+                                                         float(marker['long']))
+            except ValueError:
+                raise ValueError('Conversion error in ' + track_file + '.')
+            except KeyError:
+                raise Exception('Malformed ' + track_file + ': Key Error.')
+
+        markers = array('d', sorted(mileposts.keys()))
+        lats = array('d', [mileposts[m][0] for m in markers])
+        longs = array('d', [mileposts[m][1] for m in markers])
+
+        # Note each milepost's set of covering bases, numbering the sets
+        coverage = CoverageIndex(bases)
+        base_idx = dict((b.ID, i) for i, b in enumerate(bases))
+        set_idx = {}  # { (BASE_INDEX, ...): COV_SET_INDEX }
+        cov_idx = []
+        for m in markers:
+            cov_set = tuple(base_idx[b.ID] for b in coverage.bases_at(m))
+            cov_idx.append(set_idx.setdefault(cov_set, len(set_idx)))
+        cov_idx = array('I', cov_idx)
+        cov_sets = [list(c) for c in sorted(set_idx, key=set_idx.get)]
+
+        return cls(bases, markers, lats, longs, cov_idx, cov_sets)
+
+    @classmethod
+    def load(cls, model_file):
+        """ Returns the TrackModel in the given compiled model file, with its
+            arrays mapped from the file rather than read.
+        """
+        try:
+            with open(model_file, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            header = unpack_from(MODEL_HEADER, buf)
+        except Exception as e:
+            raise Exception('Error reading ' + model_file + ': ' + str(e))
+
+        magic, num_mps, num_bases, num_sets, num_items, ids_size = header
+        if magic != MODEL_MAGIC:
+            raise Exception('Malformed ' + model_file + ': Bad header.')
+
+        layout = [('d', num_mps)] * 3 + [('d', num_bases)] * 4 + \
+                 [('I', num_mps), ('I', num_sets + 1), ('I', num_items)]
+        size = calcsize(MODEL_HEADER) + ids_size
+        size += sum(num * MODEL_TYPES[t][1] for t, num in layout)
+        if len(buf) != size:
+            raise Exception('Malformed ' + model_file + ': Bad size.')
+
+        columns = []
+        offset = calcsize(MODEL_HEADER)
+        for typecode, num in layout:
+            columns.append(_model_array(buf, offset, typecode, num))
+            offset += num * MODEL_TYPES[typecode][1]
+
+        (markers, lats, longs,
+         cov_starts, cov_ends, base_lats, base_longs,
+         cov_idx, set_offsets, set_items) = columns
+
+        base_ids = buf[offset:offset + ids_size].split('\x00')
+        bases = [BaseRecord(base_ids[i],
+                            float(cov_starts[i]),
+                            float(cov_ends[i]),
+                            float(base_lats[i]),
+                            float(base_longs[i])) for i in xrange(num_bases)]
+        cov_sets = [[int(i) for i in set_items[set_offsets[s]:
+                                               set_offsets[s + 1]]]
+                    for s in xrange(num_sets)]
+
+        return cls(bases, markers, lats, longs, cov_idx, cov_sets)
+
+    def save(self, model_file):
+        """ Writes the model to the given compiled model file. The file is
+            replaced atomically, so processes mapping the old are unaffected.
+        """
+        set_offsets = [0]
+        for cov_set in self.cov_sets:
+            set_offsets.append(set_offsets[-1] + len(cov_set))
+
+        base_ids = '\x00'.join(b.ID for b in self.bases)
+        columns = [('d', self.markers),
+                   ('d', self.lats),
+                   ('d', self.longs),
+                   ('d', [b.cov_start for b in self.bases]),
+                   ('d', [b.cov_end for b in self.bases]),
+                   ('d', [b.lat for b in self.bases]),
+                   ('d', [b.long for b in self.bases]),
+                   ('I', self.cov_idx),
+                   ('I', set_offsets),
+                   ('I', [i for cov_set in self.cov_sets for i in cov_set])]
+
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(model_file) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pack(MODEL_HEADER,
+                             MODEL_MAGIC,
+                             len(self.markers),
+                             len(self.bases),
+                             len(self.cov_sets),
+                             set_offsets[-1],
+                             len(base_ids)))
+                for typecode, values in columns:
+                    values = array(typecode, values)
+                    if sys.byteorder == 'big':
+                        values.byteswap()
+                    f.write(values.tostring())
+                f.write(base_ids)
+            os.chmod(tmp_file, 0644)
+            os.rename(tmp_file, model_file)
+        except:
+            os.remove(tmp_file)
+            raise
+
+
+def _model_array(buf, offset, typecode, num):
+    """ Returns the array of num items of the given typecode at the given
+        offset of buf, a model file's mmap. With NumPy, the array is a view
+        of buf, else a copy.
+    """
+    if np is not None:
+        return np.frombuffer(buf, MODEL_TYPES[typecode][0], num, offset)
+
+    values = array(typecode)
+    values.fromstring(buf[offset:offset + num * values.itemsize])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def load_track_model(track_file=TRACK_RAILS,
+                     bases_file=TRACK_BASES,
+                     model_file=TRACK_MODEL):
+    """ Returns the TrackModel of the given track and bases JSON files. If
+        model_file, it is loaded from that compiled model file - first
+        (re)compiling it from the JSON files if it is missing or older than
+        either of them. Else, they are parsed.
+    """
+    if not model_file:
+        return TrackModel.from_json(track_file, bases_file)
+
+    try:
+        model_time = os.path.getmtime(model_file)
+        stale = model_time < max(os.path.getmtime(track_file),
+                                 os.path.getmtime(bases_file))
+    except OSError:
+        stale = True
+
+    if stale:
+        model = TrackModel.from_json(track_file, bases_file)
+        try:
+            model.save(model_file)
+        except Exception as e:
+            track_log.error('Could not write ' + model_file + ': ' + str(e))
+            return model
+        track_log.info('Compiled track model ' + model_file)
+
+    return TrackModel.load(model_file)
+
+
+def compile_track_model(track_file=TRACK_RAILS,
+                        bases_file=TRACK_BASES,
+                        model_file=TRACK_MODEL):
+    """ Compiles the given track and bases JSON files to the given model file
+        and returns its TrackModel.
+    """
+    model = TrackModel.from_json(track_file, bases_file)
+    model.save(model_file)
+    return model
+
+
+# TrackLayouts, by their files. See get_track_layout().
+_track_layouts = {}  # { (TRACK_FILE, BASES_FILE, MODEL_FILE): TrackLayout }
+
+
+def get_track_layout(track_file=TRACK_RAILS,
+                     bases_file=TRACK_BASES,
+                     model_file=TRACK_MODEL):
+    """ Returns the TrackLayout of the given track files, loading it on first
+        request (see load_track_model()). Each is loaded once per process,
+        and inherited by processes forked after, so the track files are not
+        rechecked for changes.
+    """
+    key = (track_file, bases_file, model_file)
+    layout = _track_layouts.get(key)
+    if layout is None:
+        # No lock, as sim processes may fork at any time. At worst, racing
+        # callers each load one and all but the first are discarded.
+        layout = TrackLayout(load_track_model(*key))
+        layout = _track_layouts.setdefault(key, layout)
+    return layout
+
+
+class TrackLayout(object):
+    """ The static portion of a track - its TrackModel, mileposts, and marker
+        lists - shared by every Track built from the same files, as only
+        device state differs between them. Its model's arrays are mapped
+        from the compiled model file, so they are shared between processes
+        as well. All members are read-only.
+    """
+    def __init__(self, model):
+        """ self.model            : The TrackModel
+            self.mileposts        : Mileposts, sorted by marker
+            self.marker_linear    : (list) Milepost markers, ascending
+            self.marker_linear_rev: (list) Milepost markers, descending
+        """
+        self.model = model
+        self.mileposts = Mileposts(model)
+
+        # Markers are bisected per loco per tick, which is fastest on a list
+        self.marker_linear = model.markers.tolist()
+        self.marker_linear_rev = self.marker_linear[::-1]
+
+
+class Mileposts(object):
+    """ A read-only sequence of a track's mileposts, as Locations in ascending
+        marker order, backed by the arrays of its TrackModel. Each Location
+        is built on first access, then kept, so that it is unique. A
+        Location's covered_by lists the BaseRecords of the bases covering it.
+    """
+    def __init__(self, model):
+        """ model: The TrackModel of the mileposts
+        """
+        self._model = model
+        self._cov_sets = [[model.bases[i] for i in cov_set]
+                          for cov_set in model.cov_sets]
+        self._locations = {}  # { INDEX: LOCATION }
+
+    def __len__(self):
+        return len(self._model.markers)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        """ Returns the Location at the given index, or a list of them if
+            given a slice.
+        """
+        try:
+            return self._locations[i]
+        except (KeyError, TypeError):
+            pass
+
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+
+        i = int(i)  # May be a NumPy int
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Milepost index out of range.')
+
+        model = self._model
+        location = Location(float(model.markers[i]),
+                            float(model.lats[i]),
+                            float(model.longs[i]),
+                            self._cov_sets[model.cov_idx[i]])
+        return self._locations.setdefault(i, location)
+
+    def index(self, marker):
+        """ Returns the index of the milepost at the given marker (a float) iff
+            exists.
+        """
+        markers = self._model.markers
+        i = bisect_left(markers, marker)
+        if i < len(markers) and markers[i] == marker:
+            return i
+
+    def get(self, marker):
+        """ Returns the Location at the given marker (a float) iff exists.
+        """
+        i = self.index(marker)
+        if i is not None:
+            return self[i]
+
+
 ##############
 # Track Sim  #
 ##############
 
+class FleetMovement(object):
+    """ A vectorized (NumPy) simulation of every loco's on-track movement.
+        Holds each loco's milepost index, speed, direction, and makeup
+        distance in arrays and advances the whole fleet in one step per tick.
+        Locos are updated from the arrays after each step, so their
+        messaging sims see the same state as with per-loco movement.
+    """
+    def __init__(self, track):
+        """ self.locos      : (list) The Loco objects, by array index
+            self.mp_idx     : (ndarray) Each loco's milepost index
+            self.speed      : (ndarray) Each loco's speed
+            self.direction  : (ndarray) 1 = increasing, -1 = decreasing
+            self.makeup_dist: (ndarray) Dist not yet consumed, by loco
+            self.sim        : The fleet's simulation. Start w/self.sim.start()
+        """
+        if np is None:
+            raise ImportError('FleetMovement requires numpy.')
+
+        self.name = 'Fleet Movement'
+        self.track = track
+        self.locos = sorted(track.locos.values(), key=lambda x: x.ID)
+
+        for l in self.locos:
+            if not l.direction or not l.coords or l.speed is None:
+                raise ValueError('Cannot simulate an unintialized Locomotive.')
+
+        # Milepost arrays, in ascending marker order
+        self._mps = track.mileposts_sorted
+        self._markers = np.asarray(track.marker_linear, dtype=np.float64)
+        self._lats = np.asarray(track.model.lats, dtype=np.float64)
+        self._longs = np.asarray(track.model.longs, dtype=np.float64)
+
+        # Per-loco movement state
+        self.mp_idx = np.array([bisect_left(track.marker_linear, l.coords.marker)
+                                for l in self.locos], dtype=np.intp)
+        self.speed = np.array([l.speed for l in self.locos], dtype=np.float64)
+        self.direction = np.array([-1 if l.direction == 'decreasing' else 1
+                                   for l in self.locos], dtype=np.int8)
+        self.makeup_dist = np.zeros(len(self.locos), dtype=np.float64)
+
+        self.sim = DeviceSim(self, [TrackSim.fleet_movement])
+
+    def step(self, time_iplier=1):
+        """ Advances every loco at speed by one tick, reversing those at the
+            end of the track and updating headings and bases in range. 
+            Mirrors TrackSim.loco_movement, for all locos at once.
+        """
+        markers = self._markers
+        num_mps = len(markers)
+        moving = np.flatnonzero(self.speed > 0)
+        if not len(moving):
+            return
+
+        # Determine signed dist traveled since last tick, incl makeup dist
+        hours = time_iplier * (REFRESH_TIME / 3600.0)
+        dist = self.speed[moving] * hours * 1.0 + self.makeup_dist[moving]
+        dist *= self.direction[moving]
+
+        curr_idx = self.mp_idx[moving]
+        target = markers[curr_idx] + dist
+        incr = dist > 0
+        decr = dist < 0
+
+        # Increasing: Nearest mp at or before target, else end of track
+        i = np.searchsorted(markers, target, side='left')
+        i_exact = (i < num_mps) & (markers[np.minimum(i, num_mps - 1)] == target)
+        i_next = np.where(i_exact, i, np.where(i > 0, i - 1, curr_idx))
+
+        # Decreasing: Nearest mp at or after target, else end of track
+        j = np.searchsorted(markers, target, side='right')
+        j_exact = (j > 0) & (markers[np.maximum(j - 1, 0)] == target)
+        j_next = np.where(j_exact, j - 1, np.where(j < num_mps, j, curr_idx))
+
+        next_idx = np.where(incr, i_next, np.where(decr, j_next, curr_idx))
+        exact = np.where(incr, i_exact, j_exact) | ~(incr | decr)
+        at_end = (incr & (i >= num_mps)) | (decr & (j == 0))
+        dist_diff = np.where(exact, 0.0, np.abs(target - markers[next_idx]))
+
+        # At end of track, reverse
+        ended = moving[at_end]
+        self.direction[ended] *= -1
+        self.makeup_dist[ended] = 0
+
+        # Else advance, noting any makeup distance for next time
+        advanced = moving[~at_end]
+        prev_idx = curr_idx[~at_end]
+        next_idx = next_idx[~at_end]
+        self.mp_idx[advanced] = next_idx
+        self.makeup_dist[advanced] = dist_diff[~at_end]
+        headings = self._headings(prev_idx, next_idx)
+
+        # Update the loco objects
+        for n in ended:
+            loco = self.locos[n]
+            loco.direction = 'increasing'
+            if self.direction[n] < 0:
+                loco.direction = 'decreasing'
+            track_log.info(loco.name + ' - At end of track. Reversing.')
+
+        for n, idx, heading in zip(advanced, next_idx, headings):
+            loco = self.locos[n]
+            loco.heading = float(heading)
+            loco.coords = self._mps[idx]
+            loco.bases_inrange = self.track.coverage.bases_at(loco.coords.marker)
+
+    def _headings(self, prev_idx, curr_idx):
+        """ Returns an array of compass bearings from each milepost in prev_idx
+            to its counterpart in curr_idx.
+        """
+        lat1 = np.radians(self._lats[prev_idx])
+        lat2 = np.radians(self._lats[curr_idx])
+        long_diff = np.radians(self._longs[prev_idx] - self._longs[curr_idx])
+
+        a = np.cos(lat1) * np.sin(lat2)
+        b = np.sin(lat1) * np.cos(lat2) * np.cos(long_diff)
+        x = np.sin(long_diff) * np.cos(lat2)
+        deg = np.degrees(np.arctan2(x, a - b))
+
+        return (deg + 360) % 360
+
+
 class TrackSim(multiprocessing.Process):
     """ The Track Simulator. Simulates a locomotives traveling on the track and
         sending/receiving EMP msgs over on-track communications infrastructure,
         which is also simulated here.
     """
-    def __init__(self):
+    def __init__(self, broker_ports=None):
+        """ broker_ports: If given, the (send, fetch, subscribe, stats) port
+                          tuple of the broker to use instead of that 
+                          configured.
+        """
         multiprocessing.Process.__init__(self)
         self.timeq = multiprocessing.Queue()  # Input queue for "time speed"
+        self.broker_ports = broker_ports
 
+    @flushes_logs
     def run(self):
         track_log.info('Track Sim Starting...')
+        if self.broker_ports:
+            set_broker_ports(*self.broker_ports)
         track = Track()  # The track contains all it's devices and locos.
 
-        # Start each track component-device's simulation thread
+        sims = []  # All device simulations
+
+        # If using the vectorized movement engine, all locos move in a single
+        # fleet simulation and each loco's own sim does messaging only.
+        if MOVEMENT_ENGINE == 'numpy' and np is None:
+            track_log.warn('NumPy not found - Using per-loco movement.')
+        elif MOVEMENT_ENGINE == 'numpy':
+            fleet = FleetMovement(track)
+            for l in track.locos.values():
+                l.sim = DeviceSim(l, [TrackSim.loco_messaging])
+            sims.append(fleet.sim)
+
+        # Start each track component-device's simulation, on the shared
+        # scheduler's worker pool or, if no workers configured, as threads.
         # These devices exists "on" the track and simulate their own 
         # operation.
         # TODO: Bases, Waysides, etc
-        for l in track.locos.values():
-            l.sim.start()
+        scheduler = None
+        if SIM_WORKERS > 0:
+            scheduler = SimScheduler(SIM_WORKERS)
+            scheduler.start()
+
+        sims += [l.sim for l in track.locos.values()]
+        for sim in sims:
+            sim.start(scheduler)
         
         # Update sim time multiplier if needed
         while True:
             try:
                 time_iplier = self.timeq.get(timeout=.1)
-                for l in track.locos.values():
-                    l.sim.time_iplier = time_iplier
+                for sim in sims:
+                    sim.time_iplier = time_iplier
                 track_log.info('Time Multiplier Set: ' + str(time_iplier))
             except Queue.Empty:
                 pass
@@ -519,9 +1185,9 @@ class TrackSim(multiprocessing.Process):
 
     @staticmethod
     def loco_movement(loco):
-        """ Real-time simulation of a locomotive's on-track movement. Also
-            determines base stations in range of locos current position.
-            This function is intended to be run as a Thread.
+        """ One step of the real-time simulation of a locomotive's on-track
+            movement. Also determines base stations in range of locos current
+            position. Intended to be run every MSG_INTERVAL by the loco's sim.
         """
         def _brake():
             """ Apply the adaptive braking algorithm.
@@ -546,117 +1212,118 @@ class TrackSim(multiprocessing.Process):
             loco.heading = compass_bearing
 
         # Start
-        makeup_dist = 0
         if not loco.direction or not loco.coords or loco.speed is None:
             raise ValueError('Cannot simulate an unintialized Locomotive.')
 
-        while loco.sim.running:
-            sleep(MSG_INTERVAL)  # Sleep for specified interval
+        # Move, if at speed
+        if loco.speed > 0:
+            # Determine dist traveled since last iteration, including
+            # makeup distance, if any.
+            hours = REFRESH_TIME / 3600.0  # Seconds to hours, for mph
+            hours = loco.sim.time_iplier * hours  # Apply sim time rate
+            dist = loco.speed * hours * 1.0  # distance = speed * time
+            dist += loco.makeup_dist
 
-            # Move, if at speed
-            if loco.speed > 0:
-                # Determine dist traveled since last iteration, including
-                # makeup distance, if any.
-                hours = REFRESH_TIME / 3600.0  # Seconds to hours, for mph
-                hours = loco.sim.time_iplier * hours  # Apply sim time rate
-                dist = loco.speed * hours * 1.0  # distance = speed * time
-                dist += makeup_dist
+            # Set sign of dist based on dir of travel
+            if loco.direction == 'decreasing':
+                dist *= -1
 
-                # Set sign of dist based on dir of travel
+            # Get next location and any makeup distance
+            new_mp, dist = loco.track._get_next_mp(loco.coords, dist)
+
+            # If no new_mp was returned, assume end of track
+            if not new_mp:
+                err_str = ' - At end of track. Reversing.'
+                track_log.info(loco.name + err_str)
+
+                loco.makeup_dist = 0
                 if loco.direction == 'decreasing':
-                    dist *= -1
-
-                # Get next location and any makeup distance
-                new_mp, dist = loco.track._get_next_mp(loco.coords, dist)
-
-                # If no new_mp was returned, assume end of track
-                if not new_mp:
-                    err_str = ' - At end of track. Reversing.'
-                    track_log.info(loco.name + err_str)
-
-                    makeup_dist = 0
-                    if loco.direction == 'decreasing':
-                        loco.direction = 'increasing'
-                    else:
-                        loco.direction = 'decreasing'
-                        
-                # Else update the loco accordingly
+                    loco.direction = 'increasing'
                 else:
-                    _set_heading(loco.coords, new_mp)
-                    loco.coords = new_mp
-                    makeup_dist = dist
+                    loco.direction = 'decreasing'
+                    
+            # Else update the loco accordingly
+            else:
+                _set_heading(loco.coords, new_mp)
+                loco.coords = new_mp
+                loco.makeup_dist = dist
 
-                    # Determine base stations in range of current position
-                    loco.bases_inrange = [b for b in loco.track.bases.values()
-                                          if b.covers_location(loco.coords)]
+                # Determine base stations in range of current position
+                cov = loco.track.coverage
+                loco.bases_inrange = cov.bases_at(loco.coords.marker)
+
+    @staticmethod
+    def fleet_movement(fleet):
+        """ One step of the real-time simulation of every locomotive's on-track
+            movement, as a FleetMovement. Intended to be run every
+            MSG_INTERVAL by the fleet's sim.
+        """
+        fleet.step(fleet.sim.time_iplier)
 
     @staticmethod
     def loco_messaging(loco):
-        """ Real-time simulation of a locomotives's messaging system. Maintains
-            connections to bases in range of loco's position. 
+        """ One step of the real-time simulation of a locomotives's messaging
+            system. Maintains connections to bases in range of loco's position. 
             # TODO: send/fetch msgs over them. 
-            This function is intended to be run as a Thread.
+            Intended to be run every MSG_INTERVAL by the loco's sim.
         """
-        while loco.sim.running:
-            sleep(MSG_INTERVAL)  # Sleep for specified interval
-
-            # Drop all out of range base connections and keep alive existing
-            # in-range connections
-            lconns = loco.conns.values()
-            for conn in [c for c in lconns if c.connected() is True]:
-                if conn.conn_to not in loco.bases_inrange:
-                    conn.disconnect()
-                else:
-                    conn.keep_alive()
+        # Drop all out of range base connections and keep alive existing
+        # in-range connections
+        lconns = loco.conns.values()
+        for conn in [c for c in lconns if c.connected() is True]:
+            if conn.conn_to not in loco.bases_inrange:
+                conn.disconnect()
+            else:
+                conn.keep_alive()
 
-            open_conns = [c for c in lconns if c.connected() is False]
-            used_bases = [c.conn_to for c in lconns if c.connected() is True]
-            for i, conn in enumerate(open_conns):
-                try:
-                    if loco.bases_inrange[i] not in used_bases:
-                        conn.connect(loco.bases_inrange[i])
-                except IndexError:
-                    break  # No (or no more) bases in range to consider
+        open_conns = [c for c in lconns if c.connected() is False]
+        used_bases = [c.conn_to for c in lconns if c.connected() is True]
+        for i, conn in enumerate(open_conns):
+            try:
+                if loco.bases_inrange[i] not in used_bases:
+                    conn.connect(loco.bases_inrange[i])
+            except IndexError:
+                break  # No (or no more) bases in range to consider
+            
+        # Ensure at least one active connection
+        conns = [c for c in lconns if c.connected() is True]
+        if not conns:
+            track_log.warn('%s skipping msg send/recv - No active comms.',
+                           loco.name)
+            return  # Try again next iteration
+
+        # Send status msg over active connections, breaking on first success.
+        status_msg = get_6000_msg(loco)
+        for conn in conns:
+            try:
+                conn.send(status_msg)
+                track_log.info('%s - Sent status msg over %s',
+                               loco.name, conn.conn_to.name)
+            except Exception as e:
+                track_log.warn('%s send failed: %s', loco.name, e)
                 
-            # Ensure at least one active connection
-            conns = [c for c in lconns if c.connected() is True]
-            if not conns:
-                err_str = ' skipping msg send/recv - No active comms.'
-                track_log.warn(loco.name + err_str)
-                continue  # Try again next iteration
-
-            # Send status msg over active connections, breaking on first success.
-            status_msg = get_6000_msg(loco)
-            for conn in conns:
-                try:
-                    conn.send(status_msg)
-                    info_str = ' - Sent status msg over ' + conn.conn_to.name
-                    track_log.info(loco.name + info_str)
-                except Exception as e:
-                    track_log.warn(loco.name + ' send failed: ' + str(e))
-                    
-            # Fetch incoming cad msgs over active connections, breaking on success.
-            for conn in conns:
-                cad_msg = None
-                try:
-                    cad_msg = conn.fetch(loco.emp_addr)
-                except Queue.Empty:
-                    break  # No msgs (or no more msgs) to receive.
-                except Exception as e:
-                    track_log.warn(loco.name + ' fetch failed: ' + str(e))
-                    continue  # Try the next connecion
-
-                # Process cad msg, if msg and if actually for this loco
-                if cad_msg and cad_msg.payload.get('ID') == loco.ID:
+        # Fetch all waiting cad msgs, in a single request, over active
+        # connections, breaking on success.
+        for conn in conns:
+            try:
+                cad_msgs = conn.fetch_msgs(loco.emp_addr)
+            except Exception as e:
+                track_log.warn('%s fetch failed: %s', loco.name, e)
+                continue  # Try the next connecion
+
+            # Process each cad msg, if actually for this loco
+            for cad_msg in cad_msgs:
+                if cad_msg.payload.get('ID') == loco.ID:
                     try:
                         # TODO: Update track restrictions/loco locations
-                        track_log.info(loco.name + ' - CAD msg processed.')
+                        track_log.info('%s - CAD msg processed.', loco.name)
                     except:
-                        track_log.error(loco.name + ' - Received invalid CAD msg.')
-                    break  # Either way, the msg was fetched # TODO: ACK w/broker
-            else:
-                err_str = ' - active connections exist, but msg fetch/recv failed.'
-                track_log.error(loco.name + err_str)
+                        track_log.error('%s - Received invalid CAD msg.',
+                                        loco.name)
+            break  # Either way, the msgs were fetched # TODO: ACK w/broker
+        else:
+            track_log.error('%s - active connections exist, but msg '
+                            'fetch/recv failed.', loco.name)
 
     @staticmethod
     def base_messaging(self):
@@ -3,9 +3,15 @@
     Author: Dustin Fast, 2018
 """
 
+import Queue
+from time import time, sleep
+from json import dumps
+from math import cos, radians
+from threading import Thread, Lock
 from datetime import datetime, timedelta
 
 from lib_app import dep_install
+from lib_app import REFRESH_TIME
 from lib_track import CONN_TIMEOUT
 
 # Attempt to import 3rd party modules, prompting for install on fail.
@@ -18,6 +24,16 @@ except:
 # HTML constants
 WEBTIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 IMAGE_PATH = '/static/img/'
+FEED_QUEUE_SIZE = 100  # Max events waiting per feed subscriber
+FEED_TICK = 0.25       # Seconds between feed publishes, changes coalescing
+
+# Trackline simplification - Each zoom level's tracklines are simplified to
+# within TRACKLINE_TOLERANCE pixels, at that zoom, of the full track. The
+# client shows the highest level not above its map's zoom.
+TRACKLINE_ZOOMS = [6, 8, 10, 12, 14, 16]
+TRACKLINE_TOLERANCE = 1.0
+METERS_PER_PIXEL = 156543.03392  # Google Maps, at the equator at zoom 0
+METERS_PER_DEGREE = 111320.0     # Per degree of latitude, approximately
 
 GREEN = '#a0f26d'
 RED = '#e60000'
@@ -43,24 +59,6 @@ WARN = 'warn shuffleable'
 DOWN = 'down shuffleable'
 
 
-class Polyline(object):
-    """ A representation of a geometric Polyline, for use with Google Maps.
-    """
-    def __init__(self, path, line_color, line_opacity=1.0, line_wt=2.0):
-        self.path = path
-        self.color = line_color
-        self.opacity = line_opacity
-        self.wt = line_wt
-
-    def repr(self):
-        """ Returns a dict representation of the polyline.
-        """
-        return {'stroke_color': self.color,
-                'stroke_opacity': self.opacity,
-                'stroke_weight': self.wt,
-                'path': list(ln for ln in self.path)}
-
-
 class WebTable:
     """ An HTML Table, with build methods.
     """
@@ -105,23 +103,35 @@ class WebTable:
         """ Adds a row of the given cells (a list of cells) and html properties.
             Ex usage: add_row([cell('hello'), cell('world')], onclick=DoHello())
         """
-        row_str = '<tr'
-        
-        if row_id:
-            row_str += ' id="' + row_id + '"'
-        if not css_class:
-            css_class = ''
-        if onclick:
-            row_str += ' onclick="' + onclick + '"'
-            css_class = 'clickable ' + css_class
-        if css_class:
-            row_str += ' class="' + css_class + '"'
-
-        row_str += '>'
-        row_str += ''.join([c for c in cells])
-        row_str += '</tr>'
-        
-        self._rows.append(row_str)
+        self._rows.append(row(cells, css_class, onclick, row_id))
+
+    def add_rows(self, rows):
+        """ Adds the given list of already built rows (see row()).
+        """
+        self._rows.extend(rows)
+
+
+def row(cells, css_class=None, onclick=None, row_id=None):
+    """ Returns the given cells (a list of cells) and html properties as a 
+        well-formed HTML table row tag.
+    """
+    row_str = '<tr'
+    
+    if row_id:
+        row_str += ' id="' + row_id + '"'
+    if not css_class:
+        css_class = ''
+    if onclick:
+        row_str += ' onclick="' + onclick + '"'
+        css_class = 'clickable ' + css_class
+    if css_class:
+        row_str += ' class="' + css_class + '"'
+
+    row_str += '>'
+    row_str += ''.join([c for c in cells])
+    row_str += '</tr>'
+    
+    return row_str
 
 
 def cell(content, colspan=None, css_class=None, cell_id=None):
@@ -152,73 +162,313 @@ def webtime(datetime_obj):
         return datetime_obj.strftime(WEBTIME_FORMAT)
 
 
-def get_locos_table(track):
-    """ Given a track object, returns two items - The locos html table for
-         web display, and a dict of cell IDs and their contents, from l to r,
-         for use client-side to determine if shuffle txt effect needs applied.
+# Encoded tracklines, by TrackLayout, shared by all WebCaches of its tracks
+_layout_tracklines = {}  # { TrackLayout: { ZOOM: [ POLYLINE, ... ] } }
+
+
+class WebCache(object):
+    """ Caches the given track's web content, for the web poll. Tracklines and
+        base markers are built once, as coverage and bases never change -
+        tracklines once per TrackLayout, for all the tracks sharing it. Each
+        loco's locos table row and map marker are built only when its state
+        version (see TrackDevice.changed()) does, so each poll costs in 
+        proportion to the changes since the last.
+        Each rebuild increments self.version, so a client may ask for only
+        the locos changed since the version it last saw (see locos_delta()).
+        self.epoch distinguishes this cache's versions from any other's.
     """
-    shuffle_data = {}  # { CELLID: value }
-    
-    # Locos table is an outter table consisting of an inner table for each loco
-    outter = WebTable(col_headers=[' ID', ' Status'])
+    def __init__(self, track):
+        self.track = track
+        self.epoch = int(time() * 1000)
+        self.version = 0
+        self._base_markers = None
+        self._map_center = None
+        self._locos = []          # Locos, sorted by ID
+        self._loco_content = {}   # { LOCOID: (KEY, VERSION, ROW, SHUFFLE_DATA,
+                                  #            MARKER, CONNLINES) }
+        self._lock = Lock()       # Serializes refreshes
+
+    def tracklines(self, zoom):
+        """ Returns the track's polylines, simplified for the given map zoom
+            level, and the zoom level they were simplified for. See
+            get_encoded_tracklines().
+        """
+        layout = self.track.layout
+        tracklines = _layout_tracklines.get(layout)
+        if tracklines is None:
+            tracklines = get_encoded_tracklines(self.track)
+            tracklines = _layout_tracklines.setdefault(layout, tracklines)
+
+        levels = [z for z in TRACKLINE_ZOOMS if z <= zoom]
+        level = levels[-1] if levels else TRACKLINE_ZOOMS[0]
+        return tracklines.get(level, []), level
+
+    def base_markers(self):
+        """ Returns the status map markers for the track's bases.
+        """
+        if self._base_markers is None:
+            self._base_markers, self._map_center = _base_markers(self.track)
+        return self._base_markers
 
-    timenow = datetime.now()
+    def bare_map(self):
+        """ Returns the status map, centered on the track's bases, but without
+            markers or tracklines - The client adds those.
+        """
+        self.base_markers()
+        return _status_map([], [], self._map_center)
+
+    def locos_table(self):
+        """ Returns two items - The locos html table for web display, and a
+            dict of cell IDs and their contents, from l to r, for use
+            client-side to determine if shuffle txt effect needs applied.
+        """
+        self._refresh()
+        shuffle_data = {}  # { CELLID: value }
+        rows = []
+        for loco in self._locos:
+            content = self._loco_content[loco.ID]
+            rows.append(content[2])
+            shuffle_data.update(content[3])
+
+        outter = WebTable(col_headers=[' ID', ' Status'])
+        outter.add_rows(rows)
+        return outter.html(), shuffle_data
+
+    def locos_delta(self, epoch, version, locos=None):
+        """ Returns two items - The current version, and the locos' content
+            changed since the given version of the given epoch, as a dict of
+            the form: 
+                { LOCO_NAME: { 'row': LOCOS_TABLE_ROW,
+                               'shuffle_data': SHUFFLE_DATA,
+                               'marker': MAP_MARKER,
+                               'connlines': CONN_LINES } }
+            If the epoch is not this cache's, every loco's content is
+            returned.
+            locos: If given, only these locos are refreshed first, rather than
+                   all - Others' content is as of their last refresh.
+        """
+        self._refresh(locos)
+        curr_version = self.version  # Before the scan, so none are missed
+        if epoch != self.epoch:
+            version = 0
+
+        delta = {}
+        for loco in self._locos:
+            content = self._loco_content[loco.ID]
+            if content[1] > version:
+                delta[loco.name] = {'row': content[2],
+                                    'shuffle_data': content[3],
+                                    'marker': content[4],
+                                    'connlines': content[5]}
+        return curr_version, delta
+
+    def _refresh(self, locos=None):
+        """ Rebuilds the row and marker of each loco whose state changed since
+            the last refresh, among the given locos, or all if None.
+        """
+        with self._lock:
+            if len(self._locos) != len(self.track.locos):
+                self._locos = sorted(self.track.locos.values(),
+                                     key=lambda x: x.ID)
+
+            timenow = datetime.now()
+            for loco in self._locos if locos is None else locos:
+                # Version first, so a change while building is caught next
+                key = (loco.version, _lastseen_css(self.track, loco, timenow))
+                content = self._loco_content.get(loco.ID)
+                if content and content[0] == key:
+                    continue
+
+                loco_row, loco_shuffle = _loco_row(self.track, loco, timenow)
+                self.version += 1
+                self._loco_content[loco.ID] = (key,
+                                               self.version,
+                                               loco_row,
+                                               loco_shuffle,
+                                               _loco_marker(loco),
+                                               get_loco_connlines(self.track,
+                                                                  loco))
+
+
+class WebFeed(object):
+    """ Pushes the given WebCache's loco changes to any number of subscribers
+        (ex: browsers, via server-sent events). While there are subscribers,
+        a publisher thread publishes the locos marked changed (see changed())
+        every FEED_TICK seconds, and refreshes all every REFRESH_TIME, so
+        changes by time alone (ex: a loco going unseen) are pushed too. Each
+        change is serialized once, by publish(), then queued to all.
+    """
+    def __init__(self, web_cache):
+        self.web_cache = web_cache
+        self._version = 0        # Of the content last published
+        self._subscribers = []   # A Queue.Queue of events, per subscriber
+        self._publisher = None   # Thread, while there are subscribers
+        self._changed = set()    # Locos changed since the last publish
+        self._changed_lock = Lock()
+        self._lock = Lock()
+
+    def changed(self, loco):
+        """ Marks the given loco changed, to be published by the next tick.
+            Does nothing without subscribers.
+        """
+        if self._subscribers:
+            with self._changed_lock:
+                self._changed.add(loco)
+
+    def publish(self, locos=None):
+        """ Queues the locos changed since the last publish, if any, to each
+            subscriber as an event. A subscriber too far behind to queue it
+            is instead sent a reset event, and must catch up by other means.
+            Does nothing without subscribers.
+            locos: If given, only these are refreshed, rather than all. See
+                   WebCache.locos_delta().
+        """
+        with self._lock:
+            if not self._subscribers:
+                return
+
+            since = self._version
+            version, locos = self.web_cache.locos_delta(self.web_cache.epoch,
+                                                        since,
+                                                        locos)
+            if not locos:
+                return
+            self._version = version
+
+            event = dumps({'epoch': self.web_cache.epoch,
+                           'since': since,
+                           'version': version,
+                           'locos': locos})
+            event = 'data: ' + event + '\n\n'
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.put_nowait(event)
+                except Queue.Full:
+                    with subscriber.mutex:
+                        subscriber.queue.clear()
+                    subscriber.put_nowait('event: reset\ndata: \n\n')
+
+    def stream(self):
+        """ Yields each event published from now on, as server-sent events,
+            and a keep-alive comment every REFRESH_TIME seconds without one.
+            Ends when closed, ex: by the subscriber disconnecting.
+        """
+        subscriber = Queue.Queue(FEED_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.append(subscriber)
+            if not self._publisher:
+                self._publisher = Thread(target=self._publish_ticks)
+                self._publisher.daemon = True
+                self._publisher.start()
+
+        try:
+            while True:
+                try:
+                    yield subscriber.get(timeout=REFRESH_TIME)
+                except Queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            with self._lock:
+                self._subscribers.remove(subscriber)
+
+    def _publish_ticks(self):
+        """ Publishes the locos changed every FEED_TICK seconds, and all every
+            REFRESH_TIME, until there are no subscribers. Intended to run as a
+            thread.
+        """
+        last_full = time()
+        while True:
+            sleep(FEED_TICK)
+            with self._lock:
+                if not self._subscribers:
+                    self._publisher = None
+                    break
+
+            with self._changed_lock:
+                changed, self._changed = self._changed, set()
+
+            if time() - last_full >= REFRESH_TIME:
+                self.publish()
+                last_full = time()
+            elif changed:
+                self.publish(changed)
+
+        with self._changed_lock:
+            self._changed.clear()
+
+
+def _lastseen_css(track, loco, timenow):
+    """ Returns the css class of the given loco's last seen cell, at the given
+        time.
+    """
+    lastseentime = track.get_lastseen(loco)
     delta = timedelta(seconds=CONN_TIMEOUT)  # TODO: Move timeout to Connection
-    for loco in sorted(track.locos.values(), key=lambda x: x.ID):
-        # Connection interface row values and css class
-        one_flag = False  # denotes at least one conn up
-        conn_disp = {UP: [], DOWN: [], WARN: []}
-        for c in loco.conns.values():
-            conn_html_id = loco.name + ' ' + c.ID
-            if c.conn_to:
-                shuffle_data[conn_html_id] = c.conn_to.ID
-                conn_disp[UP].append((conn_html_id, c.conn_to.ID))
-                one_flag = True
-            else:
-                shuffle_data[conn_html_id] = 'N/A'
-
-                if one_flag:
-                    conn_disp[WARN].append((conn_html_id, 'N/A'))
-                else:
-                    conn_disp[DOWN].append((conn_html_id, 'N/A'))
-
-        # Last seen cell value and css class
-        lastseentime = track.get_lastseen(loco) 
-        lastseen_html_id = loco.name + ' lastseen'
-        if lastseentime:
-            lastseen = webtime(lastseentime)
-            lastseen += ' @ ' + str(loco.coords.marker)
-
-            if delta < timenow - lastseentime:
-                lastseen_css = DOWN
-                loco.disconnect()
-            else:
-                lastseen_css = UP
+    if lastseentime and not delta < timenow - lastseentime:
+        return UP
+    return DOWN
+
+
+def _loco_row(track, loco, timenow):
+    """ Returns the given loco's locos table row, as of the given time, and 
+        its shuffle data. See WebCache.locos_table().
+    """
+    shuffle_data = {}  # { CELLID: value }
+    delta = timedelta(seconds=CONN_TIMEOUT)  # TODO: Move timeout to Connection
+
+    # Connection interface row values and css class
+    one_flag = False  # denotes at least one conn up
+    conn_disp = {UP: [], DOWN: [], WARN: []}
+    for c in loco.conns.values():
+        conn_html_id = loco.name + ' ' + c.ID
+        if c.conn_to:
+            shuffle_data[conn_html_id] = c.conn_to.ID
+            conn_disp[UP].append((conn_html_id, c.conn_to.ID))
+            one_flag = True
         else:
-            lastseen = 'N/A'
+            shuffle_data[conn_html_id] = 'N/A'
+
+            if one_flag:
+                conn_disp[WARN].append((conn_html_id, 'N/A'))
+            else:
+                conn_disp[DOWN].append((conn_html_id, 'N/A'))
+
+    # Last seen cell value and css class
+    lastseentime = track.get_lastseen(loco) 
+    lastseen_html_id = loco.name + ' lastseen'
+    if lastseentime:
+        lastseen = webtime(lastseentime)
+        lastseen += ' @ ' + str(loco.coords.marker)
+
+        if delta < timenow - lastseentime:
             lastseen_css = DOWN
+            loco.disconnect()
+        else:
+            lastseen_css = UP
+    else:
+        lastseen = 'N/A'
+        lastseen_css = DOWN
 
-        shuffle_data[lastseen_html_id] = lastseen
+    shuffle_data[lastseen_html_id] = lastseen
 
-        # Begin building inner table --
-        inner = WebTable(col_headers=[c for c in loco.conns.keys()])
+    # Begin building inner table --
+    inner = WebTable(col_headers=[c for c in loco.conns.keys()])
 
-        # -- Connection status row
-        connrow_cells = [cell(conn[1], 1, UP, conn[0]) for conn in conn_disp[UP]]
-        connrow_cells += [cell(conn[1], 1, WARN, conn[0]) for conn in conn_disp[WARN]]
-        connrow_cells += [cell(conn[1], 1, DOWN, conn[0]) for conn in conn_disp[DOWN]]
-        max_colspan = len(connrow_cells)
-        inner.add_row(connrow_cells)
+    # -- Connection status row
+    connrow_cells = [cell(conn[1], 1, UP, conn[0]) for conn in conn_disp[UP]]
+    connrow_cells += [cell(conn[1], 1, WARN, conn[0]) for conn in conn_disp[WARN]]
+    connrow_cells += [cell(conn[1], 1, DOWN, conn[0]) for conn in conn_disp[DOWN]]
+    max_colspan = len(connrow_cells)
+    inner.add_row(connrow_cells)
 
-        # -- Last seen row (colspan=all cols of connection status row)
-        inner.add_row([cell('<b>Last Msg Recveived @ MP</b>', colspan=2)])
-        inner.add_row([cell(lastseen, max_colspan, lastseen_css, lastseen_html_id)])
+    # -- Last seen row (colspan=all cols of connection status row)
+    inner.add_row([cell('<b>Last Msg Recveived @ MP</b>', colspan=2)])
+    inner.add_row([cell(lastseen, max_colspan, lastseen_css, lastseen_html_id)])
 
-        outter.add_row([cell(loco.ID), cell(inner.html())],
-                       onclick="locosTableOnclick('" + loco.name + "')",
-                       row_id=loco.name)
+    loco_row = row([cell(loco.ID), cell(inner.html())],
+                   onclick="locosTableOnclick('" + loco.name + "')",
+                   row_id=loco.name)
 
-    return outter.html(), shuffle_data
+    return loco_row, shuffle_data
 
 
 def get_loco_connlines(track, loco):
@@ -238,89 +488,164 @@ def get_loco_connlines(track, loco):
     return loco_connlines
 
 
-def get_tracklines(track):
-    """ Returns a list of polylines representating the given track, based on
-        its mileposts and colored according to radio coverage.
+def get_encoded_tracklines(track):
+    """ Returns a dict of polylines representing the given track, colored by
+        radio coverage, for each of TRACKLINE_ZOOMS. Each level's paths are
+        simplified to that zoom's tolerance and given in Google's encoded
+        polyline format. Ex: { ZOOM: [ {'path': ENCODED, ...}, ... ], ... }
+        Section end points are kept at every level, so coverage colors change
+        at exactly the same points as on the full track.
     """
-    lines = []      # A list of tuples: [ (path, color), ... ]
-    templines = []  # Temp container of lines: [ line, ... ]
-    mps = track.mileposts_sorted  # For convenience
-    
-    # Aggregate mps in order, building a line for each "connected" track section
-    num_mps = len(mps) - 1
-    prev_conn_level = None
-    for i, mp in enumerate(mps):
-        conn_level = len(mp.covered_by)
-
-        # If next item is OOB or of different level, push aggregation to lines
-        if i == num_mps or len(mps[i + 1].covered_by) != conn_level:
-            if prev_conn_level == 0:
-                line_color = MAP_TRACKLINE_DOWN
-            elif prev_conn_level == 1:
-                line_color = MAP_TRACKLINE_WARN
-            else:
-                line_color = MAP_TRACKLINE_OK
-            lines.append((templines, line_color))
-            templines = []
+    sections = _track_sections(track)
+    if not sections:
+        return {}
+
+    # Tolerances are in degrees of latitude at the track's mean latitude
+    lats = [p[0] for path, _ in sections for p in path]
+    lat_scale = cos(radians(sum(lats) / len(lats)))
+
+    tracklines = {}
+    for zoom in TRACKLINE_ZOOMS:
+        tolerance = TRACKLINE_TOLERANCE * METERS_PER_PIXEL * lat_scale
+        tolerance /= METERS_PER_DEGREE * 2 ** zoom
+
+        polylines = []
+        for path, color in sections:
+            path = encode_polyline(simplify_path(path, tolerance))
+            polylines.append({'stroke_color': color,
+                              'stroke_opacity': 1.0,
+                              'stroke_weight': 2.0,
+                              'path': path})
+        tracklines[zoom] = polylines
+
+    return tracklines
+
+
+def _track_sections(track):
+    """ Returns the given track's mileposts as a list of paths, one per
+        section of equal radio coverage, with the color of its coverage. Each
+        section ends on the first point of the next, so that they meet.
+        Ex: [ ([ (lat, lng), ... ], color), ... ]
+    """
+    sections = []  # [ (conn_level, path), ... ]
+    for mp in track.mileposts_sorted:
+        conn_level = min(len(mp.covered_by), 2)
+        point = (mp.lat, mp.long)
+        if sections and sections[-1][0] == conn_level:
+            sections[-1][1].append(point)
         else:
-            prev_conn_level = conn_level
-            templines.append({'lat': mp.lat, 'lng': mp.long})
+            if sections:
+                sections[-1][1].append(point)
+            sections.append((conn_level, [point]))
 
-    # Build polylines from lines
-    polylines = []
-    for tup in lines:
-        polylines.append(Polyline(tup[0], tup[1]).repr())
-    
-    return polylines  # Note: only one item in this list
+    colors = {0: MAP_TRACKLINE_DOWN, 1: MAP_TRACKLINE_WARN, 2: MAP_TRACKLINE_OK}
+    return [(path, colors[level]) for level, path in sections]
 
 
-def get_status_map(track, tracklines, loco=None):
-    """ Gets the main status map for the given track. If not loco, all locos
-        are added to the map. Else only the given loco is added.
+def simplify_path(path, tolerance):
+    """ Returns the given path, a list of (lat, lng) points, simplified by
+        the Douglas-Peucker algorithm to within the given tolerance, in
+        degrees of latitude. The first and last points are always kept.
+    """
+    if len(path) < 3:
+        return list(path)
+
+    # Project to a plane where a degree of longitude is as long as one of lat
+    lng_scale = cos(radians(path[0][0]))
+    xs = [p[1] * lng_scale for p in path]
+    ys = [p[0] for p in path]
+
+    keep = [False] * len(path)
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance ** 2
+    stack = [(0, len(path) - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        seg_len_sq = dx * dx + dy * dy
+
+        # Find the point farthest from the segment first -> last
+        max_dist_sq = tolerance_sq
+        farthest = None
+        for i in xrange(first + 1, last):
+            px, py = xs[i] - x1, ys[i] - y1
+            if seg_len_sq:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / seg_len_sq))
+                px, py = px - t * dx, py - t * dy
+            dist_sq = px * px + py * py
+            if dist_sq > max_dist_sq:
+                max_dist_sq = dist_sq
+                farthest = i
+
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+
+    return [p for p, k in zip(path, keep) if k]
+
+
+def encode_polyline(path):
+    """ Returns the given path, a list of (lat, lng) points, as a string in
+        Google's encoded polyline format, at its precision of 1e-5 degrees.
+    """
+    chars = []
+    prev_lat = prev_lng = 0
+    for lat, lng in path:
+        lat = int(round(lat * 1e5))
+        lng = int(round(lng * 1e5))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+
+    return ''.join(chars)
+
+
+def _loco_marker(l):
+    """ Returns the status map marker for the given loco.
     """
-    map_markers = []  # Map markers, for the Google.map.markers property.
-    base_points = []  # All base station points, (p1, p2). For map centering.   
     headings = list(range(0, 360, 45))  # List of headings in 45 deg increments
 
-    # Build map markers for --
-    # -- Loco(s):
-    if loco:
-        locos = [loco]
-    else:
-        locos = track.locos.values()
-
-    for l in locos:
-        # Infobox contents
-        tbl_title = l.name
-        tbl_headers = ['MP', 'Speed', 'Direction', 'BPP']
-        info_tbl = WebTable(col_headers=tbl_headers, title=tbl_title, css_class=INFOBOX)
-        info_tbl.add_row([cell(str(l.coords.marker)),
-                         cell(str(l.speed)), 
-                         cell(l.direction.title()),
-                         cell(str(l.bpp))])
-
-        # Denote client-side svg fill, based on loco status
-        # Note: Loco icons displayed as client-side SVG for all but 1st refresh
-        status = GREEN
-        if not l.connected():
-            status = RED
-        elif [c for c in l.conns.values() if not c.connected()]:
-            status = ORANGE
-
-        # Determine heading to nearest 45 degree angle, for marker rotation
-        rotate = min(headings, key=lambda x: abs(x - float(l.heading)))
-
-        marker = {'title': l.name,
-                  'icon': MAP_LOCO_DEFAULT,
-                  'lat': l.coords.lat,
-                  'lng': l.coords.long,
-                  'status': status,
-                  'rotation': rotate,
-                  'infobox': info_tbl.html()}
-        
-        map_markers.append(marker)
-
-    # -- Bases:
+    # Infobox contents
+    tbl_title = l.name
+    tbl_headers = ['MP', 'Speed', 'Direction', 'BPP']
+    info_tbl = WebTable(col_headers=tbl_headers, title=tbl_title, css_class=INFOBOX)
+    info_tbl.add_row([cell(str(l.coords.marker)),
+                     cell(str(l.speed)), 
+                     cell(l.direction.title()),
+                     cell(str(l.bpp))])
+
+    # Denote client-side svg fill, based on loco status
+    # Note: Loco icons displayed as client-side SVG for all but 1st refresh
+    status = GREEN
+    if not l.connected():
+        status = RED
+    elif [c for c in l.conns.values() if not c.connected()]:
+        status = ORANGE
+
+    # Determine heading to nearest 45 degree angle, for marker rotation
+    rotate = min(headings, key=lambda x: abs(x - float(l.heading)))
+
+    return {'title': l.name,
+            'icon': MAP_LOCO_DEFAULT,
+            'lat': l.coords.lat,
+            'lng': l.coords.long,
+            'status': status,
+            'rotation': rotate,
+            'infobox': info_tbl.html()}
+
+
+def _base_markers(track):
+    """ Returns the status map markers for the given track's bases, and the
+        centroid of their coords, for map centering.
+    """
+    map_markers = []
+    base_points = []  # All base station points, (p1, p2). For map centering.   
     for base in track.bases.values():
         # Infobox contents
         tbl_headers = ['Location', 'Last Seen']
@@ -344,13 +669,19 @@ def get_status_map(track, tracklines, loco=None):
         map_markers.append(marker)
         base_points.append((base.coords.lat, base.coords.long))
 
-    # If a loco was initially passed, center the resulting map on it.
-    if loco:
-        center = (loco.coords.lat, loco.coords.long)
-    # Else, center map on the centroid of all base station coords
-    else:
+    center = None
+    if base_points:
         x, y = zip(*base_points)
         center = (max(x) + min(x)) / 2.0, (max(y) + min(y)) / 2.0
+    return map_markers, center
+
+
+def _status_map(map_markers, tracklines, center, loco=None):
+    """ Returns the status map of the given markers and tracklines. If a loco
+        is given, the map is centered on it, else on the given center.
+    """
+    if loco:
+        center = (loco.coords.lat, loco.coords.long)
 
     status_map = Map(identifier='status_map',
                      varname='status_map',
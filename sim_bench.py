@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+""" PTC-Sim's micro-benchmarks. Each benchmark prints its results to the
+    console. Run all of them with `./sim_bench.py`, or just the ones given by
+    name. Ex: `./sim_bench.py next_mp`
+
+    Author: Dustin Fast, 2018
+"""
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import multiprocessing
+from json import dumps
+from binascii import crc32
+from struct import pack, unpack
+from random import Random
+from time import sleep
+from timeit import default_timer
+
+import lib_messaging
+from lib_track import Track, TrackLayout, TRACK_BASES, load_track_model
+from lib_messaging import Message, ReprCodec, JSONCodec, StructCodec
+from lib_messaging import Client, MsgBroker, MsgLog, QueueMap, enqueue_msg
+from lib_messaging import WAL_SYNC_COUNT
+
+BENCH_TRACK_SIZES = [1000, 10000, 100000]  # Num mileposts per synthetic track
+BENCH_LOCOS = 100                          # Simulated locos per tick
+BENCH_TICKS = 200                          # Ticks per timing run
+BENCH_ROUNDS = 20000                       # Encode/decode round trips per run
+BENCH_REPEATS = 5                          # Header timing runs, best one kept
+BENCH_WAL_MSGS = 2000                      # Msgs enqueued per log timing run
+BENCH_SHARDS = [1, 2, 4]                   # Broker shard counts to compare
+BENCH_SHARD_CLIENTS = 4                    # Client processes sending at once
+BENCH_SHARD_MSGS = 5000                    # Msgs sent per client per run
+BENCH_SHARD_BATCH = 10                     # Msgs per send request
+BENCH_BROKER_PORTS = 18900                 # Each run's broker ports from here
+
+
+def _timeit(func, runs):
+    """ Returns the mean seconds per call of func over the given num of runs.
+    """
+    start = default_timer()
+    for _ in xrange(runs):
+        func()
+    return (default_timer() - start) / runs
+
+
+def _synthetic_track(num_mps, tmp_dir, model_file=None):
+    """ Writes a straight track of num_mps mileposts, and an empty locos list,
+        to tmp_dir and returns a Track built from them - and from the given
+        compiled track model file, if any.
+    """
+    rails_file = os.path.join(tmp_dir, 'rails_' + str(num_mps) + '.json')
+    locos_file = os.path.join(tmp_dir, 'locos.json')
+    step = 500.0 / num_mps  # Spread mps over the same 500 mile territory
+    rails = [{'milemarker': round(i * step, 4),
+              'lat': 60.0 + i * step / 100.0,
+              'long': -149.0 - i * step / 100.0} for i in xrange(num_mps)]
+
+    with open(rails_file, 'w') as f:
+        f.write(dumps(rails))
+    with open(locos_file, 'w') as f:
+        f.write('[]')
+
+    return Track(rails_file, locos_file, TRACK_BASES, model_file)
+
+
+def _linear_next_mp(track, curr_mp, distance):
+    """ The previous, linear-scan implementation of Track._get_next_mp. Kept
+        here only as a benchmark baseline.
+    """
+    mp = curr_mp.marker
+    target_mp = mp + distance
+    mps = track.marker_linear if distance > 0 else track.marker_linear_rev
+    for i, marker in enumerate(mps):
+        if marker == target_mp:
+            return track.get_location_at(marker), 0
+        elif (distance > 0 and marker > target_mp) or \
+             (distance < 0 and marker < target_mp):
+            next_mp = mps[i - 1] if i > 0 else mp
+            return track.get_location_at(next_mp), abs(target_mp - next_mp)
+    return None, 0
+
+
+def bench_next_mp():
+    """ Per-tick cost of stepping BENCH_LOCOS locos along tracks of increasing
+        size, for both the bisect and the linear-scan milepost lookups.
+    """
+    print('Track._get_next_mp - usecs per loco per tick:')
+    print('  %10s %12s %12s' % ('mileposts', 'bisect', 'linear scan'))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for num_mps in BENCH_TRACK_SIZES:
+            track = _synthetic_track(num_mps, tmp_dir)
+            rand = Random(num_mps)
+            fleet = [(rand.choice(track.mileposts_sorted),
+                      rand.choice([-1, 1]) * rand.uniform(.01, .1))
+                     for _ in xrange(BENCH_LOCOS)]
+
+            def tick():
+                for loc, dist in fleet:
+                    track._get_next_mp(loc, dist)
+
+            def linear_tick():
+                for loc, dist in fleet:
+                    _linear_next_mp(track, loc, dist)
+
+            bisect_secs = _timeit(tick, BENCH_TICKS) / BENCH_LOCOS
+            linear_secs = _timeit(linear_tick, 2) / BENCH_LOCOS
+            print('  %10d %12.2f %12.2f' % (num_mps,
+                                           bisect_secs * 1e6,
+                                           linear_secs * 1e6))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _sample_6000_payload():
+    """ Returns a typical 6000 (loco status) msg payload.
+    """
+    return {'loco': '1001',
+            'speed': 45.0,
+            'heading': 12.345678,
+            'direction': 'increasing',
+            'milepost': 2.022,
+            'lat': 60.12608627,
+            'long': -149.4349891,
+            'bpp': 90.0,
+            'conns': {'Radio 1': '50', 'Radio 2': '100'}}
+
+
+def bench_codec():
+    """ Round-trip cost of each msg payload codec, for a 6000 msg payload,
+        against the original str()/eval round trip.
+    """
+    payload = _sample_6000_payload()
+    codecs = [('str/eval (orig)', lambda t, p: str(p), lambda t, d: eval(d)),
+              ('repr', ReprCodec.encode, ReprCodec.decode),
+              ('json', JSONCodec.encode, JSONCodec.decode),
+              ('struct', StructCodec.encode, StructCodec.decode)]
+
+    print('Msg payload codecs - usecs per 6000 payload round trip:')
+    print('  %16s %10s %10s' % ('codec', 'usecs', 'bytes'))
+    for name, encode, decode in codecs:
+        def round_trip():
+            decode(6000, encode(6000, payload))
+
+        size = len(encode(6000, payload))
+        secs = _timeit(round_trip, BENCH_ROUNDS)
+        print('  %16s %10.2f %10d' % (name, secs * 1e6, size))
+
+
+def _legacy_to_raw(msg_type, sender_addr, dest_addr, payload_str):
+    """ The previous, field-at-a-time Message._to_raw, minus payload encoding.
+        Kept here only as a benchmark baseline.
+    """
+    body_size = 4 + len(payload_str)
+    var_headsize = len(sender_addr) + len(dest_addr) + 2
+    raw_msg = pack(">B", 4)
+    raw_msg += pack(">H", msg_type)
+    raw_msg += pack(">B", 1)
+    raw_msg += pack(">B", 0)
+    raw_msg += pack(">I", body_size)[1:]
+    raw_msg += pack(">B", var_headsize)
+    raw_msg += pack(">H", 120)
+    raw_msg += pack(">H", 0)
+    raw_msg += sender_addr
+    raw_msg += '\x00'
+    raw_msg += dest_addr
+    raw_msg += '\x00'
+    raw_msg += payload_str
+    raw_msg += pack(">i", crc32(raw_msg))
+    return raw_msg
+
+
+def _legacy_to_tuple(raw_msg):
+    """ The previous, field-at-a-time Message._to_tuple, minus payload 
+        decoding. Kept here only as a benchmark baseline.
+    """
+    if not raw_msg or len(raw_msg) < 20:
+        raise Exception("Invalid message format")
+    msg_crc = unpack(">i", raw_msg[-4::])[0]
+    if msg_crc != crc32(raw_msg[:-4]):
+        raise Exception("CRC Mismatch - message may be corrupt.")
+    msg_type = unpack('>H', raw_msg[1:3])[0]
+    vhead_size = unpack('>B', raw_msg[8:9])[0]
+    vhead_end = 13 + vhead_size
+    vhead = raw_msg[13:vhead_end].split('\x00')
+    payload = raw_msg[vhead_end:len(raw_msg) - 4]
+    return (msg_type, vhead[0], vhead[1], payload)
+
+
+def bench_header():
+    """ Encode and decode cost of the EMP headers, excluding the payload
+        codec, against the previous field-at-a-time implementation. Also the
+        cost of the CRC check alone, the floor for any validating decode.
+    """
+    payload_str = JSONCodec.encode(6000, _sample_6000_payload())
+    msg_tuple = (6000, 'sim.l.1001', 'sim.bos', payload_str)
+    raw_msg = _legacy_to_raw(*msg_tuple)
+
+    def encode():
+        Message._pack_fields(6000, 1, 'sim.l.1001', 'sim.bos', payload_str)
+
+    def best(func):
+        """ Returns the least secs per call of func over BENCH_REPEATS runs,
+            as these runs are short enough for noise to swamp a mean.
+        """
+        return min([_timeit(func, BENCH_ROUNDS) for _ in range(BENCH_REPEATS)])
+
+    encode_secs = best(encode)
+    decode_secs = best(lambda: Message._unpack_fields(raw_msg))
+    legacy_encode_secs = best(lambda: _legacy_to_raw(*msg_tuple))
+    legacy_decode_secs = best(lambda: _legacy_to_tuple(raw_msg))
+    crc_secs = best(lambda: crc32(raw_msg[:-4]))
+
+    print('EMP headers - usecs per msg:')
+    print('  %8s %10s %10s %8s' % ('', 'Struct', 'previous', 'speedup'))
+    for name, secs, legacy_secs in [('encode', encode_secs, legacy_encode_secs),
+                                    ('decode', decode_secs, legacy_decode_secs)]:
+        print('  %8s %10.2f %10.2f %7.1fx' % (name,
+                                              secs * 1e6,
+                                              legacy_secs * 1e6,
+                                              legacy_secs / secs))
+    print('  %8s %10.2f' % ('crc only', crc_secs * 1e6))
+
+
+def bench_wal():
+    """ Enqueue cost with the broker's write-ahead log, fsync'ing every msg
+        and every WAL_SYNC_COUNT msgs, against no log.
+    """
+    msgs = [Message((6000, 'sim.l.' + str(i), 'sim.bos', {'loco': str(i)}))
+            for i in xrange(BENCH_WAL_MSGS)]
+
+    def enqueue_all(sync_count):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            queues = QueueMap()
+            if sync_count:
+                queues.msg_log = MsgLog(tmp_dir, sync_count=sync_count)
+                queues.msg_log.replay(queues)
+            start = default_timer()
+            for msg in msgs:
+                enqueue_msg(queues, msg)
+            return (default_timer() - start) / len(msgs)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    print('Broker write-ahead log - usecs per enqueued msg:')
+    print('  %16s %10s' % ('fsync every', 'usecs'))
+    for sync_count in [1, WAL_SYNC_COUNT, 0]:
+        label = str(sync_count) + ' msgs' if sync_count else 'no log'
+        print('  %16s %10.2f' % (label, enqueue_all(sync_count) * 1e6))
+
+
+def bench_track_load():
+    """ Track load cost for tracks of increasing size: Loading its layout by
+        parsing the JSON files, and by mapping their compiled track model,
+        against building a Track that shares an already loaded layout.
+    """
+    print('Track load - msecs per load:')
+    print('  %10s %12s %12s %12s' % ('mileposts', 'json', 'model', 'shared'))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for num_mps in BENCH_TRACK_SIZES:
+            size = str(num_mps)
+            rails_file = os.path.join(tmp_dir, 'rails_' + size + '.json')
+            locos_file = os.path.join(tmp_dir, 'locos.json')
+            model_file = os.path.join(tmp_dir, 'track_' + size + '.bin')
+            _synthetic_track(num_mps, tmp_dir, model_file)
+
+            def load(model_file):
+                return TrackLayout(load_track_model(rails_file,
+                                                    TRACK_BASES,
+                                                    model_file))
+
+            json_secs = _timeit(lambda: load(None), 3)
+            model_secs = _timeit(lambda: load(model_file), 3)
+            shared_secs = _timeit(lambda: Track(rails_file,
+                                                locos_file,
+                                                TRACK_BASES,
+                                                model_file), 3)
+            print('  %10d %12.2f %12.2f %12.2f' % (num_mps,
+                                                   json_secs * 1e3,
+                                                   model_secs * 1e3,
+                                                   shared_secs * 1e3))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+# Available benchmarks, by name
+def _send_load(ports, client_num):
+    """ Sends BENCH_SHARD_MSGS msgs to the broker on the given ports, in
+        batches of BENCH_SHARD_BATCH, to addresses spread over all shards.
+        Intended to run as a process, one of several sending at once.
+    """
+    client = Client(broker_send_port=ports[0],
+                    broker_fetch_port=ports[1],
+                    broker_subscribe_port=ports[2],
+                    broker_stats_port=ports[3])
+    msgs = [Message((6001, 'sim.l.' + str(client_num),
+                     'sim.b.' + str(i % 64), {'i': i}))
+            for i in xrange(BENCH_SHARD_BATCH)]
+    for _ in xrange(BENCH_SHARD_MSGS / BENCH_SHARD_BATCH):
+        client.send_msgs(msgs)
+
+
+def _wait_for_port(port):
+    """ Blocks until something listens on the given local port.
+    """
+    while True:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except socket.error:
+            sleep(.05)
+
+
+def bench_shards():
+    """ Send throughput of an async mode broker of each of BENCH_SHARDS shard
+        counts, with BENCH_SHARD_CLIENTS client processes sending at once.
+        Shards only scale with free cores, so the num of cores is given too.
+    """
+    lib_messaging.FRAMED = True  # Shards run in async mode only
+
+    print('Sharded broker send throughput - ' + str(BENCH_SHARD_CLIENTS) +
+          ' clients, ' + str(multiprocessing.cpu_count()) + ' cores:')
+    print('  %8s %12s %8s' % ('shards', 'msgs/sec', 'speedup'))
+    base_rate = None
+    for run, num_shards in enumerate(BENCH_SHARDS):
+        first_port = BENCH_BROKER_PORTS + run * 10  # Fresh ports per run
+        ports = (first_port, first_port + 1, first_port + 2, first_port + 3)
+        lib_messaging.BROKER_SHARDS = num_shards
+        broker = MsgBroker(ports)
+        broker.start()
+        try:
+            _wait_for_port(ports[0])
+            clients = [multiprocessing.Process(target=_send_load,
+                                               args=(ports, i))
+                       for i in range(BENCH_SHARD_CLIENTS)]
+            start = default_timer()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            secs = default_timer() - start
+        finally:
+            broker.terminate()
+            broker.join()
+
+        rate = BENCH_SHARD_CLIENTS * BENCH_SHARD_MSGS / secs
+        base_rate = base_rate or rate
+        print('  %8d %12.0f %7.1fx' % (num_shards, rate, rate / base_rate))
+
+
+BENCHMARKS = {'next_mp': bench_next_mp,
+              'codec': bench_codec,
+              'header': bench_header,
+              'wal': bench_wal,
+              'shards': bench_shards,
+              'track_load': bench_track_load}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        try:
+            bench = BENCHMARKS[name]
+        except KeyError:
+            print('Unknown benchmark: ' + name)
+            continue
+        bench()
+        print('')
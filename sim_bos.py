@@ -10,18 +10,22 @@
     Author: Dustin Fast, 2018
 """
 
-from time import sleep
+import socket
+from time import sleep, time
+from ast import literal_eval
 from datetime import timedelta
 from random import randrange
-from threading import Thread
+from collections import deque
+from threading import Thread, Lock, Event
 from multiprocessing import Process
     
-from lib_messaging import MsgBroker, Client, Queue
-from lib_messaging import BOS_EMP
-from lib_app import bos_log, dep_install
+from lib_messaging import MsgBroker, Client
+from lib_messaging import BOS_EMP, BROKER, BROKER_SHARDS, NET_TIMEOUT
+from lib_app import bos_log, dep_install, flushes_logs
 from lib_app import APP_NAME, REFRESH_TIME, WEB_EXPIRE
+from lib_app import SANDBOX_POOL, SANDBOX_MAX, SANDBOX_PORTS
 from lib_track import Track, TrackSim, Loco, Location
-from lib_web import get_locos_table, get_status_map, get_tracklines, get_loco_connlines
+from lib_web import WebCache, WebFeed
 
 
 # Attempt to import 3rd party modules, prompting for install on fail.
@@ -50,12 +54,10 @@ bos_sessions = {}  # { BOS_ID: BOS_OBJ }
 @bos_web.before_request
 def before_request():
     """ Before each client request is processed, refresh the session.
-        If the session is new, instantiate a BOS for the client.
+        If the session is new, claim a BOS for the client from bos_pool.
         Note: Each session gets its own sandbox. I.e. it's own BOS and sims.
         so that each web client can have it's own "sandbox" BOS.
     """
-    global bos_sessions
-    
     def refresh_sess():
         bos_web.permanent_session_lifetime = timedelta(minutes=WEB_EXPIRE)
         flask.session.permanent = True
@@ -64,23 +66,26 @@ def before_request():
     
     # If session exists, refresh it to prevent expire
     bos_ID = flask.session.get('bos_id')
-    if bos_ID and bos_sessions.get(bos_ID):
+    bos = bos_sessions.get(bos_ID)
+    if bos_ID and bos:
         # print('Request from existing client received: ' + str(bos_ID))  # debug
+        bos.last_access = time()
         refresh_sess()
 
-    # Else, init a new BOS & flag session as dirty so change is registered.
-    # The association is necessary because the BOS obj is not serializable.
+    # Else, claim a started BOS & flag session as dirty so change is 
+    # registered. The association is necessary because the BOS obj is not
+    # serializable.
     else:
-        # Init a new boss associated with a random 16 bit ID
-        bos_ID = randrange(65536)  
-        bos_sessions[bos_ID] = BOS()
-        bos_sessions[bos_ID].start()
-        sleep(.5)  # Ample time to start
+        try:
+            bos_ID = bos_pool.claim()
+        except Exception as e:
+            bos_log.error(e)
+            return 'Sandbox unavailable: ' + str(e) + ' Try again later.'
 
         # Associate session with it's BOS
         flask.session['bos_id'] = bos_ID
         refresh_sess()
-        bos_log.info('New client session started: ' + str(bos_ID))
+        bos_log.info('New client session started: %s', bos_ID)
         
 
 @bos_web.route('/')
@@ -92,9 +97,8 @@ def home():
     except:
         return 'BOS association failure. Try restarting your browser.'
 
-    # Get a fresh status map
-    tracklines = get_tracklines(bos.track)
-    status_map = get_status_map(bos.track, tracklines)
+    # Get the status map - Its markers and tracklines are added client-side
+    status_map = bos.web_cache.bare_map()
 
     # convert time iplier from decimal to percent
     iplier = bos.time_iplier * 100
@@ -105,30 +109,97 @@ def home():
                                  time_iplier=iplier)
 
 
+@bos_web.route('/_home_get_static_content')
+def _home_get_static_content():
+    """ Serves the content that never changes for a track, the base markers.
+        Cacheable client-side.
+    """
+    bos = bos_sessions[flask.session['bos_id']]
+
+    resp = flask.jsonify(base_markers=bos.web_cache.base_markers())
+    resp.cache_control.private = True
+    resp.cache_control.max_age = WEB_EXPIRE * 60
+    return resp
+
+
+@bos_web.route('/_home_get_tracklines')
+def _home_get_tracklines():
+    """ Serves the tracklines, simplified for the map zoom level given by the
+        'zoom' request arg. Cacheable client-side, per zoom level.
+    """
+    bos = bos_sessions[flask.session['bos_id']]
+    zoom = flask.request.args.get('zoom', 0, type=int)
+
+    tracklines, level = bos.web_cache.tracklines(zoom)
+    resp = flask.jsonify(tracklines=tracklines, zoom=level)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = WEB_EXPIRE * 60
+    return resp
+
+
 @bos_web.route('/_home_get_async_content', methods=['POST'])
 def _home_get_async_content():
-    """ Serves updated asynchronous content, the locos table and status map.
+    """ Serves updated asynchronous content - The locos table row, map
+        marker, and connection lines of each loco changed since the content
+        version the client gives. If the version is not of the session's 
+        BOS's current content (ex: on first request), the whole locos table
+        is sent too.
     """
     # Get the session's associated BOS
     # print('** ' + str(flask.session['bos_id']))  # Debug
     bos = bos_sessions[flask.session['bos_id']]
 
-    locos_table, shuffle_data = get_locos_table(bos.track)
-    tracklines = get_tracklines(bos.track)
-    loco_name = flask.request.json['loco_name']  # 'Loco XXXX'
-    conn_lines = []
+    epoch = flask.request.json.get('epoch')
+    version = flask.request.json.get('version', 0)
+    locos_table = None
 
-    if loco_name:
-        loco = bos.track.locos[loco_name.replace('Loco ', '')]
-        status_map = get_status_map(bos.track, tracklines, loco)
-        conn_lines = get_loco_connlines(bos.track, loco)
-    else:
-        status_map = get_status_map(bos.track, tracklines)
+    version, locos = bos.web_cache.locos_delta(epoch, version)
+    if epoch != bos.web_cache.epoch:
+        locos_table, _ = bos.web_cache.locos_table()
+
+    return flask.jsonify(epoch=bos.web_cache.epoch,
+                         version=version,
+                         locos=locos,
+                         locos_table=locos_table)
 
-    return flask.jsonify(locos_table=locos_table,
-                         shuffle_data=shuffle_data,
-                         status_map=status_map.as_json(),
-                         loco_connlines=conn_lines)
+
+@bos_web.route('/_home_stream')
+def _home_stream():
+    """ Streams loco changes, of the same form as /_home_get_async_content's
+        locos, as server-sent events as the session's BOS applies status 
+        msgs. Each event also gives the content versions it spans - A client
+        whose version is behind an event's "since" must catch up by polling.
+    """
+    bos = bos_sessions[flask.session['bos_id']]
+
+    def events():
+        """ The feed's events, each keeping the session alive, as the page
+            stops polling while streaming.
+        """
+        stream = bos.web_feed.stream()
+        try:
+            for event in stream:
+                bos.last_access = time()
+                yield event
+        finally:
+            stream.close()
+
+    resp = flask.Response(events(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+@bos_web.route('/_broker_stats')
+def _broker_stats():
+    """ Serves the session's msg broker metrics (queue depths, msg rates and
+        ages, etc.), as JSON.
+    """
+    try:
+        bos = bos_sessions[flask.session['bos_id']]
+        return flask.jsonify(bos.msg_client.fetch_stats())
+    except Exception as e:
+        bos_log.error(e)
+        return 'ERROR: ' + str(e)
 
 
 @bos_web.route('/_set_sessionvar', methods=['POST'])
@@ -168,18 +239,29 @@ class BOS(Thread):
         Message Broker sims, but as subprocesses. This is to demonstrate their
         isolation, as well as assure optimal sim performance.
     """
-    def __init__(self):
+    def __init__(self, broker_ports=None):
+        """ broker_ports: If given, the (send, fetch, subscribe, stats) port
+                          tuple for this BOS's broker, in place of those
+                          configured. Each concurrent BOS needs its own.
+        """
         Thread.__init__(self)
+        self.daemon = True
         self.track = Track()
-        self.msg_client = Client()  # TODO: Random ports to allow multi sandboxes
+        self.web_cache = WebCache(self.track)  # The track's web content
+        self.web_feed = WebFeed(self.web_cache)  # Its changes, pushed to web
+        self.msg_client = Client(BROKER, *(broker_ports or ()))
         self.time_iplier = 1        # Rate at which to speed the sime up/down
+        self.broker_ports = broker_ports
+        self.last_access = time()   # Of its web session, for expiry
+        self.running = True
+        self.ready = Event()        # Set once its broker accepts connections
 
         # Each BOS gets it's own Message Broker.
-        self.broker_sim = MsgBroker()
+        self.broker_sim = MsgBroker(broker_ports)
 
         # Each BOS gets it's own Track Sim. Note: The track sim has a
         # multiprocessing queue so we can send it the time multipliplier.
-        self.track_sim = TrackSim()
+        self.track_sim = TrackSim(broker_ports)
 
     def set_tplier(self, time_iplier):
         """ Sets the sim time multiplier for self and passes it to track sim.
@@ -188,63 +270,211 @@ class BOS(Thread):
         self.track_sim.timeq.put_nowait(time_iplier)
 
     def run(self):
-        """ Checks msg broker for new status msgs every REFRESH_TIME sec.
+        """ Subscribes to the msg broker's BOS queue and processes each status
+            msg as the broker pushes it. Resubscribes every REFRESH_TIME sec
+            while the broker is unreachable.
         """
         bos_log.info('Starting Sandbox...')
         self.broker_sim.start()
         self.track_sim.start()
+        self._wait_for_broker()
+        self.ready.set()
         bos_log.info('BOS Started.')
 
-        while True:
-            # Fetch the next available status msg, if any
-            msg = None
+        while self.running:
             try:
-                msg = self.msg_client.fetch_next_msg(BOS_EMP)
-            except Queue.Empty:
-                bos_log.info('Msg queue empty.')
-            except Exception:
-                bos_log.warn('Could not connect to broker.')
-
-            # Process loco status msg. Msg should be of form given in 
-            # docs/app_messaging_spec.md, Msg ID 6000.
-            if msg and msg.msg_type == 6000:
-                try:
-                    locoID = msg.payload['loco']
-                    location = Location(msg.payload['milepost'],
-                                        msg.payload['lat'],
-                                        msg.payload['long'])
-                    active_conns = eval(msg.payload['conns'])  # evals to dict
-
-                    # Eiter reference or instantiate loco with the given ID
-                    loco = self.track.locos.get(locoID)
-                    if not loco:
-                        loco = Loco(locoID, self.track)
-
-                    # Update the BOS's loco object with status msg params
-                    loco.update(msg.payload['speed'],
-                                msg.payload['heading'],
-                                msg.payload['direction'],
-                                location,
-                                msg.payload['bpp'],
-                                active_conns)
-
-                    # Update the last seen time for this loco
-                    self.track.set_lastseen(loco)
-                    
-                    bos_log.info('Processed status msg for ' + loco.name)
-                except KeyError:
-                    bos_log.error('Malformed status msg: ' + str(msg.payload))
-            elif msg:
-                bos_log.error('Fetched unhandled msg type: ' + str(msg.msg_type))
-                
+                for msg in self.msg_client.subscribe(BOS_EMP):
+                    loco = self._process_msg(msg)
+                    if loco:
+                        self.web_feed.changed(loco)
+            except Exception as e:
+                if self.running:
+                    bos_log.warn('Broker subscription lost: %s', e)
             sleep(REFRESH_TIME)
 
+    def stop(self):
+        """ Stops the BOS and its sims, and discards its broker's msg log so
+            the next BOS on its ports doesn't restore them. The BOS's thread
+            exits once its broker subscription drops.
+        """
+        self.running = False
+        for sim in (self.track_sim, self.broker_sim):
+            if sim.is_alive():
+                sim.terminate()
+                sim.join()
+        self.broker_sim.discard_log()
+
+    def _wait_for_broker(self):
+        """ Blocks until the BOS's broker accepts subscribers, or the BOS
+            is stopped.
+        """
+        addr = (self.msg_client.broker, self.msg_client.subscribe_port)
+        while self.running:
+            try:
+                socket.create_connection(addr, NET_TIMEOUT).close()
+                return
+            except socket.error:
+                sleep(.05)
+
+    def _process_msg(self, msg):
+        """ Updates the BOS's track model from the given msg. Returns the loco
+            updated, if any, else None.
+        """
+        # Process loco status msg. Msg should be of form given in 
+        # docs/app_messaging_spec.md, Msg ID 6000.
+        if msg.msg_type == 6000:
+            try:
+                locoID = msg.payload['loco']
+                location = Location(msg.payload['milepost'],
+                                    msg.payload['lat'],
+                                    msg.payload['long'])
+                active_conns = msg.payload['conns']
+                if isinstance(active_conns, basestring):
+                    active_conns = literal_eval(active_conns)  # Legacy
+
+                # Eiter reference or instantiate loco with the given ID
+                loco = self.track.locos.get(locoID)
+                if not loco:
+                    loco = Loco(locoID, self.track)
+
+                # Update the BOS's loco object with status msg params
+                loco.update(msg.payload['speed'],
+                            msg.payload['heading'],
+                            msg.payload['direction'],
+                            location,
+                            msg.payload['bpp'],
+                            active_conns)
+
+                # Update the last seen time for this loco
+                self.track.set_lastseen(loco)
+                
+                bos_log.info('Processed status msg for %s', loco.name)
+                return loco
+            except KeyError:
+                bos_log.error('Malformed status msg: %s', msg.payload)
+        else:
+            bos_log.error('Fetched unhandled msg type: %s', msg.msg_type)
+
+
+class SandboxPool(Thread):
+    """ Keeps SANDBOX_POOL BOS sandboxes started and ready for new web
+        sessions to claim, so a new session needn't wait for a Track parse
+        and its sims to start. Each sandbox's broker gets its own block of
+        ports, from SANDBOX_PORTS up, so up to SANDBOX_MAX may run at once.
+        Claimed sandboxes whose session is idle for WEB_EXPIRE minutes are
+        stopped and their ports reused.
+    """
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.ready = deque()  # Started, unclaimed BOSs
+        self.lock = Lock()
+        self.wake = Event()   # Set on claim, to top the pool back up
+
+        # Each block is a send, fetch, subscribe, and a stats port per shard
+        block_size = 3 + BROKER_SHARDS
+        self.free_ports = deque([SANDBOX_PORTS + i * block_size
+                                 for i in range(SANDBOX_MAX)])
+
+    def claim(self):
+        """ Associates a started sandbox with a new session in bos_sessions,
+            and returns the session's BOS ID. If none are ready, starts one,
+            waiting up to REFRESH_TIME for its broker to be up.
+            Raises an Exception if all ports are in use.
+        """
+        with self.lock:
+            bos = self.ready.popleft() if self.ready else None
+        if not bos:
+            bos = self._start_bos()
+        bos.ready.wait(REFRESH_TIME)
+
+        with self.lock:
+            bos_ID = randrange(65536)  # A random 16 bit ID
+            while bos_ID in bos_sessions:
+                bos_ID = randrange(65536)
+            bos.last_access = time()
+            bos_sessions[bos_ID] = bos
+
+        self.wake.set()
+        return bos_ID
+
+    def run(self):
+        while True:
+            self._reclaim()
+            try:
+                while len(self.ready) < SANDBOX_POOL:
+                    bos = self._start_bos()
+                    with self.lock:
+                        self.ready.append(bos)
+            except Exception as e:
+                bos_log.warn('Sandbox pool not filled: %s', e)
+
+            self.wake.wait(REFRESH_TIME)
+            self.wake.clear()
+
+    def _start_bos(self):
+        """ Starts and returns a BOS on the next free block of ports. Raises
+            an Exception if there are none.
+        """
+        with self.lock:
+            for _ in range(len(self.free_ports)):
+                port = self.free_ports.popleft()
+                if _ports_free(port, 3 + BROKER_SHARDS):
+                    break
+                self.free_ports.append(port)  # In use elsewhere. Retry later.
+            else:
+                raise Exception('No free sandbox ports.')
+
+        bos = BOS((port, port + 1, port + 2, port + 3))
+        bos.start()
+        return bos
+
+    def _reclaim(self):
+        """ Stops the sandboxes of expired sessions, freeing their ports.
+        """
+        expire_time = time() - WEB_EXPIRE * 60
+        with self.lock:
+            expired = [(bos_ID, bos) for bos_ID, bos in bos_sessions.items()
+                       if bos.last_access < expire_time]
+            for bos_ID, _ in expired:
+                del bos_sessions[bos_ID]
+
+        for bos_ID, bos in expired:
+            bos.stop()
+            with self.lock:
+                self.free_ports.append(bos.broker_ports[0])
+            bos_log.info('Session expired, sandbox stopped: %s', bos_ID)
+
+
+def _ports_free(first_port, num_ports):
+    """ Returns True if the broker may listen on each of the given num of
+        ports, from first_port up, else False.
+    """
+    socks = []
+    try:
+        for port in range(first_port, first_port + num_ports):
+            sock = socket.socket()
+            socks.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((BROKER, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+bos_pool = SandboxPool()  # Started by Web, in the web interface's process
+
 
 class Web(Process):
     def __init__(self):
         Process.__init__(self)
 
+    @flushes_logs
     def run(self):
+        bos_pool.start()
         bos_web.run(debug=True, use_reloader=False)  # Blocks
 
 
@@ -25,6 +25,14 @@ var time_iplier = 1              // Simulation speed multipliplier
 var refresh_interval = 5000     // Async refresh interval
 var on_interval = null;         // Ref to the active setInterval function
 var persist_infobox = null;     // The map infobox to persist between refreshes
+var content_epoch = null;       // Epoch of the server's content version...
+var content_version = 0;        // ... and the version last received
+var loco_markers = {};          // Map markers, by loco name
+var loco_connlines = {};        // Loco to base connection lines, by loco name
+var base_markers = [];          // Base station map markers
+var live_feed = null;           // The server-sent events feed, if supported
+var trackline_zoom = null;      // Zoom level of the tracklines shown...
+var tracklines = {};            // ... and the track's polylines, by zoom level
 
 // A Maps infobox & associated marker that persists across async updates.
 class PersistInfobox {
@@ -70,25 +78,181 @@ $(document).ready(function () {
 
     var refresh_slider = $('#refresh-range');
     refresh_slider.on('input', function () {
-        clearInterval(on_interval);                             // Nullify current interval
-        on_interval = setAsynchInterval($(this).val() * 1000);  // Start new interval (s to ms)
+        if (on_interval) {
+            clearInterval(on_interval);                             // Nullify current interval
+            on_interval = setAsynchInterval($(this).val() * 1000);  // Start new interval (s to ms)
+        }
         doCPViewUpdate();
 
     });
 
+    // The static content needs the map, which is initialized on window load
+    google.maps.event.addDomListener(window, 'load', getStaticContent);
+
     // Start asynch refresh, noting the interval so it can be cleared later.
+    // If the live feed connects, it replaces the interval refresh.
     on_interval = setAsynchInterval(refresh_slider.val() * 1000) // s to ms
+    startLiveFeed();
     doCPViewUpdate();
 });
 
 
+// Subscribe to the server's live feed of loco changes, if the browser
+// supports server-sent events. While connected, interval refresh is stopped.
+// On error, the browser reconnects on its own, and we refresh on the interval
+// until it does.
+function startLiveFeed() {
+    if (!window.EventSource) {
+        return;
+    }
+    live_feed = new EventSource($SCRIPT_ROOT + '/_home_stream');
+
+    live_feed.onopen = function () {
+        clearInterval(on_interval);
+        on_interval = null;
+        updateContentAsync();  // Catch up on any changes before the feed
+    };
+
+    live_feed.onerror = function () {
+        if (!on_interval) {
+            on_interval = setAsynchInterval($('#refresh-range').val() * 1000);
+        }
+    };
+
+    live_feed.onmessage = function (e) {
+        var data = JSON.parse(e.data);
+
+        // If we missed changes, apply these but keep our version until polled
+        if (data.epoch != content_epoch || data.since > content_version) {
+            applyContent(data.locos);
+            updateContentAsync();
+        } else {
+            applyContent(data.locos);
+            content_version = Math.max(content_version, data.version);
+        }
+    };
+
+    // The server dropped events we were too slow to take. Poll to catch up.
+    live_feed.addEventListener('reset', function () {
+        updateContentAsync();
+    });
+}
+
+
+// Get the map content that never changes, the base markers, and add it to
+// the map, along with the loco markers already received. Tracklines are added
+// per zoom level, by updateTracklines(). Must be called once the map is
+// initialized.
+function getStaticContent() {
+    if (!status_map) {
+        console.warn('Status map not initialized.');
+        return;
+    }
+
+    $.ajax({
+        url: $SCRIPT_ROOT + '/_home_get_static_content',
+        type: 'GET',
+
+        error: function (jqXHR, textStatus, errorThrown) {
+            console.warn('Error contacting server for static content.');
+        },
+
+        success: function (data) {
+            $.each(data.base_markers, function (i) {
+                base_markers.push(addMarker(data.base_markers[i]));
+            });
+        }
+    });
+
+    // Tracklines are simplified per zoom level, so update them on zoom
+    status_map.addListener('zoom_changed', updateTracklines);
+    updateTracklines();
+
+    // Show the loco markers of any refresh before the map was initialized.
+    // Later refreshes send only changed locos, so they'd not be resent.
+    showSelection();
+}
+
+
+// Get the tracklines simplified for the map's current zoom level, if not
+// already shown, and show them in place of the previous level's.
+function updateTracklines() {
+    if (!status_map) {
+        return;
+    }
+    var zoom = status_map.getZoom();
+    $.ajax({
+        url: $SCRIPT_ROOT + '/_home_get_tracklines',
+        type: 'GET',
+        data: { zoom: zoom },
+
+        error: function (jqXHR, textStatus, errorThrown) {
+            console.warn('Error contacting server for tracklines.');
+        },
+
+        success: function (data) {
+            // Ignore stale responses, and levels already shown
+            if (zoom != status_map.getZoom() || data.zoom == trackline_zoom) {
+                return;
+            }
+            if (!tracklines[data.zoom]) {
+                tracklines[data.zoom] = data.tracklines.map(function (line) {
+                    return new google.maps.Polyline({
+                        path: decodePolyline(line.path),
+                        strokeColor: line.stroke_color,
+                        strokeOpacity: line.stroke_opacity,
+                        strokeWeight: line.stroke_weight
+                    });
+                });
+            }
+            $.each(tracklines[trackline_zoom] || [], function (i, line) {
+                line.setMap(null);
+            });
+            $.each(tracklines[data.zoom], function (i, line) {
+                line.setMap(status_map);
+            });
+            trackline_zoom = data.zoom;
+        }
+    });
+}
+
+
+// Returns the given path, in Google's encoded polyline format, as a list of
+// lat/lng literals.
+function decodePolyline(encoded) {
+    var path = [];
+    var index = 0, lat = 0, lng = 0;
+    while (index < encoded.length) {
+        var deltas = [0, 0];
+        for (var i = 0; i < 2; i++) {
+            var shift = 0, result = 0, b;
+            do {
+                b = encoded.charCodeAt(index++) - 63;
+                result |= (b & 0x1f) << shift;
+                shift += 5;
+            } while (b >= 0x20);
+            deltas[i] = (result & 1) ? ~(result >> 1) : (result >> 1);
+        }
+        lat += deltas[0];
+        lng += deltas[1];
+        path.push({ lat: lat / 1e5, lng: lng / 1e5 });
+    }
+    return path;
+}
+
+
 // Locos table click handler -
 // Onclick currently selected loco, toggles selection off, else toggle it on.
 function locosTableOnclick(loco_name) {
+    if (curr_loco) {
+        document.getElementById(curr_loco).className = 'clickable';
+    }
+
     if (curr_loco == loco_name) {
         curr_loco = null;
     } else {
         curr_loco = loco_name;
+        document.getElementById(curr_loco).className = 'clicked';
 
         // If selected a loco and another's infobox is open, clear it.
         if (persist_infobox.is_loco() && !persist_infobox.is_for_device(loco_name)) {
@@ -96,20 +260,21 @@ function locosTableOnclick(loco_name) {
         }
     }
 
-    updateContentAsync(); // Refresh the page's dynamic content
+    showSelection(); // Show the selection on the map
 }
 
 
 // Refresh pages asynchronous content -
-// If curr_loco, only that loco is shown. Else, all locos shown
+// Gets only the locos changed since the last refresh and applies them.
 // Note: Don't use JQuery shorthand here, it trashes the JSON.
 function updateContentAsync() {
-    // Post curr loco selection and get back dynamic content
+    // Post our content version and get back changes
     $.ajax({
         url: $SCRIPT_ROOT + '/_home_get_async_content',
         type: 'POST',
         contentType: 'application/json;charset=UTF-8',
-        data: JSON.stringify({ 'loco_name': curr_loco }),
+        data: JSON.stringify({ 'epoch': content_epoch,
+                               'version': content_version }),
         timeout: 1000,
 
         error: function (jqXHR, textStatus, errorThrown) {
@@ -121,152 +286,207 @@ function updateContentAsync() {
                 console.warn('Server-server content refresh error.')
                 return;
             }
-            start_time = performance.now();  // debug
-
-            // Note fields for txt shuffle if having new data since last refresh
-            needs_txtshuffle = []
-            $('.shuffleable').each(function (i, obj) {
-                id = $(this).attr('id')
-                if ($(this).text() != data.shuffle_data[id]) {
-                    needs_txtshuffle.push(id);
-                }
-            });
-            
-            // Refresh locos table, setting loco selection border if needed
-            $('#locos-table').html(data.locos_table);
-            if (curr_loco) {
-                document.getElementById(curr_loco).className = 'clicked';
+            content_epoch = data.epoch;
+            content_version = data.version;
+
+            // Replace the whole locos table, if sent
+            if (data.locos_table) {
+                $('#locos-table').html(data.locos_table);
             }
+            applyContent(data.locos);
+        }
+    });
+}
 
-            // Do txt shuffle effect for each element id in needs_txtshuffle
-            $('.shuffleable').each(function (i, obj) {
-                if (needs_txtshuffle.indexOf($(this).attr('id')) != -1) {
-                    $(this).shuffleLetters({
-                        'step': 6,
-                        'fps': 35
-                    });
-                }
-            });
 
-            //Remove all existing map markers & polylines before replacing
-            status_map_markers.forEach(function (marker) {
-                    marker.setMap(null);
-                });
-            status_map_markers = []
+// Applies the given changed locos content, from either a refresh or the live
+// feed, replacing the locos' table rows and map markers.
+function applyContent(locos) {
+    start_time = performance.now();  // debug
 
-            curr_polylines.forEach(function (pline) {
-                pline.setMap(null);
-            });
-            curr_polylines = []
-
-            // Add loco conn polylines to map
-            $.each(data.loco_connlines, function (i) {
-                var line = new google.maps.Polyline({
-                    path: data.loco_connlines[i],
-                    strokeOpacity: 0,
-                    icons: [{
-                        icon: LOCO_CONNLINE,
-                        offset: '0px',
-                        repeat: '10px'
-                    }],
-                    map: status_map
-                });
-                curr_polylines.push(line)
+    // Note fields for txt shuffle if having new data since last refresh
+    shuffle_data = {}
+    $.each(locos, function (loco_name) {
+        $.extend(shuffle_data, locos[loco_name].shuffle_data);
+    });
+    needs_txtshuffle = []
+    $('.shuffleable').each(function (i, obj) {
+        id = $(this).attr('id')
+        if (id in shuffle_data && $(this).text() != shuffle_data[id]) {
+            needs_txtshuffle.push(id);
+        }
+    });
+    
+    // Replace changed locos table rows
+    $.each(locos, function (loco_name) {
+        var row = document.getElementById(loco_name);
+        if (row) {
+            $(row).replaceWith(locos[loco_name].row);
+        } else {
+            content_epoch = null;  // Get whole table next refresh
+        }
+    });
+    
+    // Set loco selection border if needed
+    if (curr_loco) {
+        document.getElementById(curr_loco).className = 'clicked';
+    }
+
+    // Do txt shuffle effect for each element id in needs_txtshuffle
+    $('.shuffleable').each(function (i, obj) {
+        if (needs_txtshuffle.indexOf($(this).attr('id')) != -1) {
+            $(this).shuffleLetters({
+                'step': 6,
+                'fps': 35
             });
-            
-            // Set map loco and base markers
-            $.each(data.status_map.markers, function (i) {
-                // Note: marker_title matches curr_loco's table ID.
-                var marker_title = data.status_map.markers[i].title
-                var marker_icon = data.status_map.markers[i].icon
-                is_draggable = false;  // Non-loco icons are not draggable
-
-                // Loco icons are SVG and get rotated for heading
-                if (marker_title.includes('Loco')) {
-                    is_draggable = true;
-                    
-                    // Adjust anchor based on rotation so it sits on trackline
-                    rotate_deg = data.status_map.markers[i].rotation - 90;
-                    anchor_x = 250; anchor_y = 0;
-                    
-                    // TODO: Adjust anchor for each possible degree
-                    console.log(marker_title + ': ' + rotate_deg.toString());
-                    if (rotate_deg == -90) {
-                        anchor_y += 200;  // seems good
-                    } else if (rotate_deg == -45) {
-                        anchor_x -= 150;
-                    } else if (rotate_deg == 0) {
-                        anchor_x -= 200;
-                    } else if (rotate_deg == 45) {
-                        anchor_x += 20;
-                        anchor_y += 200;
-                    } else if (rotate_deg == 90) {
-                        anchor_x -= 50;  
-                        anchor_y += 200;
-                    } else if (rotate_deg == 135) {
-                    } else if (rotate_deg == 180) {
-                    } else if (rotate_deg == 225) {
-                        anchor_x += 100
-                        anchor_y += 200
-                    } else if (rotate_deg == 270) {
-                        anchor_y += 200 // seems good
-                    } else {
-                        console.warn('Unhandled rotation: ' + rotate_deg.toString());
-                    }
-                        
-                    marker_icon = {
-                        path: LOCO_SVG,
-                        // origin: new google.maps.Point(0, 0),
-                        anchor: new google.maps.Point(anchor_y, anchor_x),
-                        rotation: rotate_deg,
-                        fillOpacity: 0.9,
-                        scale: .07,
-                        strokeColor: 'black',
-                        fillColor: data.status_map.markers[i].status,
-                        strokeWeight: 1,
-                    }
-                }
-                
-                // Init the marker object
-                var marker = new google.maps.Marker({
-                    position: new google.maps.LatLng(
-                        data.status_map.markers[i].lat,
-                        data.status_map.markers[i].lng
-                    ),
-                    icon: marker_icon,
-                    title: marker_title,
-                    draggable: is_draggable, // TODO: helicoptering
-                    map: status_map
-                });
-                
-                // Marker's infobox. Note it is only 'attached' on open
-                var infobox = new google.maps.InfoWindow({
-                    content: data.status_map.markers[i].infobox,
-                });
+        }
+    });
 
-                // Define onclick behavior for the marker (toggle open/close)
-                // Note that we only ever allow one open infobox at a time
-                marker.addListener('click', function () {
-                    if (persist_infobox.is_for_device(marker.title)) {
-                        persist_infobox.close();
-                    } else {
-                        persist_infobox.close();
-                        persist_infobox.set(infobox, marker); 
-                        persist_infobox.open(status_map);
-                    }
-                });
+    // Replace changed locos' map markers and connection lines
+    $.each(locos, function (loco_name) {
+        if (loco_markers[loco_name]) {
+            loco_markers[loco_name].setMap(null);
+        }
+        var marker = addMarker(locos[loco_name].marker);
+        loco_markers[loco_name] = marker;
+        loco_connlines[loco_name] = locos[loco_name].connlines;
+
+        // Move the persisting infobox, if any, to the new marker
+        if (persist_infobox.is_for_device(loco_name)) {
+            persist_infobox.close();
+            persist_infobox.set(marker.infobox, marker);
+        }
+    });
+
+    showSelection();
+
+    // debug
+    duration = performance.now() - start_time;
+    console.log('Home Refreshed - client side took: ' + duration);
+}
+
+
+// Shows only the selected loco's map marker and connection lines, if a loco
+// is selected, else all locos' markers.
+function showSelection() {
+    $.each(loco_markers, function (loco_name, marker) {
+        if (!curr_loco || curr_loco == loco_name) {
+            marker.setMap(status_map);
+        } else {
+            marker.setMap(null);
+        }
+    });
+
+    // Replace loco conn polylines
+    curr_polylines.forEach(function (pline) {
+        pline.setMap(null);
+    });
+    curr_polylines = []
+
+    $.each(loco_connlines[curr_loco] || [], function (i, linepath) {
+        var line = new google.maps.Polyline({
+            path: linepath,
+            strokeOpacity: 0,
+            icons: [{
+                icon: LOCO_CONNLINE,
+                offset: '0px',
+                repeat: '10px'
+            }],
+            map: status_map
+        });
+        curr_polylines.push(line)
+    });
+
+    // Reopen current persisting infobox, if any
+    persist_infobox.open(status_map)
+}
 
-                status_map_markers.push(marker); // Attach new marker to the map
-            });
 
-            // Reopen current persisting infobox, if any
-            persist_infobox.open(status_map)
+// Adds the given server-side map marker to the map and returns it. Its
+// infobox is returned as the marker's infobox property.
+function addMarker(marker_data) {
+    // Note: marker_title matches curr_loco's table ID.
+    var marker_title = marker_data.title
+    var marker_icon = marker_data.icon
+    is_draggable = false;  // Non-loco icons are not draggable
+
+    // Loco icons are SVG and get rotated for heading
+    if (marker_title.includes('Loco')) {
+        is_draggable = true;
+        
+        // Adjust anchor based on rotation so it sits on trackline
+        rotate_deg = marker_data.rotation - 90;
+        anchor_x = 250; anchor_y = 0;
+        
+        // TODO: Adjust anchor for each possible degree
+        console.log(marker_title + ': ' + rotate_deg.toString());
+        if (rotate_deg == -90) {
+            anchor_y += 200;  // seems good
+        } else if (rotate_deg == -45) {
+            anchor_x -= 150;
+        } else if (rotate_deg == 0) {
+            anchor_x -= 200;
+        } else if (rotate_deg == 45) {
+            anchor_x += 20;
+            anchor_y += 200;
+        } else if (rotate_deg == 90) {
+            anchor_x -= 50;  
+            anchor_y += 200;
+        } else if (rotate_deg == 135) {
+        } else if (rotate_deg == 180) {
+        } else if (rotate_deg == 225) {
+            anchor_x += 100
+            anchor_y += 200
+        } else if (rotate_deg == 270) {
+            anchor_y += 200 // seems good
+        } else {
+            console.warn('Unhandled rotation: ' + rotate_deg.toString());
+        }
             
-            // debug
-            duration = performance.now() - start_time;
-            console.log('Home Refreshed - client side took: ' + duration);
+        marker_icon = {
+            path: LOCO_SVG,
+            // origin: new google.maps.Point(0, 0),
+            anchor: new google.maps.Point(anchor_y, anchor_x),
+            rotation: rotate_deg,
+            fillOpacity: 0.9,
+            scale: .07,
+            strokeColor: 'black',
+            fillColor: marker_data.status,
+            strokeWeight: 1,
+        }
+    }
+    
+    // Init the marker object
+    var marker = new google.maps.Marker({
+        position: new google.maps.LatLng(
+            marker_data.lat,
+            marker_data.lng
+        ),
+        icon: marker_icon,
+        title: marker_title,
+        draggable: is_draggable, // TODO: helicoptering
+        map: status_map
+    });
+    
+    // Marker's infobox. Note it is only 'attached' on open
+    var infobox = new google.maps.InfoWindow({
+        content: marker_data.infobox,
+    });
+    marker.infobox = infobox;
+
+    // Define onclick behavior for the marker (toggle open/close)
+    // Note that we only ever allow one open infobox at a time
+    marker.addListener('click', function () {
+        if (persist_infobox.is_for_device(marker.title)) {
+            persist_infobox.close();
+        } else {
+            persist_infobox.close();
+            persist_infobox.set(infobox, marker); 
+            persist_infobox.open(status_map);
         }
     });
+
+    return marker;
 }
 
 